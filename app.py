@@ -1,12 +1,13 @@
-from typing import List
+import time
+from typing import Any, List, Optional
 
 import streamlit as st
 from dotenv import load_dotenv
-from langchain.callbacks import StreamlitCallbackHandler
 from langchain.schema import ChatMessage, Document
 
 from workshop_oai_qa.chain import AssistantMessage
-from workshop_oai_qa.resources import conversation_chain
+from workshop_oai_qa.resources import conversation_chain, history_compactor, metrics
+from workshop_oai_qa.streaming import ReplyCallbackHandler
 from workshop_oai_qa.utils import role_from_message
 
 st.set_page_config(
@@ -40,32 +41,42 @@ def main():
 
 
 def chat_window():
+    follow_up = None
     with st.session_state.chat_window_container:
         # Display chat messages
         for i, message in enumerate(st.session_state.messages):
-            role = role_from_message(message)
+            with st.chat_message(role_from_message(message)):
+                follow_up = message_block(message, id=i) or follow_up
 
-            with st.chat_message(role):
-                if isinstance(message, AssistantMessage):
-                    st.write(message.formatted_content)
-                    followup_block(message.follow_ups, id=i)
-                    citations_block(message.citations, id=i)
-                else:
-                    st.write(message.content)
+    # Answer a clicked follow-up after the history, so it is rendered below it
+    if follow_up:
+        on_followup_click(follow_up)
 
     # User-provided prompt
     if prompt := st.chat_input(disabled=False):
         on_chat_input(prompt)
 
 
-def followup_block(follow_ups: List[str], id=None):
+def message_block(message: ChatMessage, id: int) -> Optional[str]:
+    # Answers are formatted once when they are parsed, reruns only draw the stored markdown
+    if not isinstance(message, AssistantMessage):
+        st.markdown(message.content)
+        return None
+    st.markdown(message.formatted_content)
+    citations_block(message.citations, id=id)
+    return followup_block(message.follow_ups, id=id)
+
+
+def followup_block(follow_ups: List[str], id=None) -> Optional[str]:
+    clicked = None
     for j, follow_up in enumerate(follow_ups):
         if st.button(
             follow_up,
             type='secondary',
             key=f'followup-{id}-{j}',
         ):
-            on_followup_click(follow_up)
+            clicked = follow_up
+    return clicked
 
 
 def citations_block(citations: List[Document], id=None):
@@ -94,29 +105,63 @@ def on_citation_click(citation):
 def on_chat_input(prompt):
     st.session_state.messages.append(ChatMessage(role='user', content=prompt))
     with st.chat_message("user"):
-        st.write(prompt)
+        st.markdown(prompt)
 
-    # Generate a new response if last message is not from assistant
+    # Stream the response into its chat message, no rerun is needed to render it
     with st.chat_message("assistant"):
         message = on_generate_response(st.session_state.messages)
         st.session_state.messages.append(message)
+        id = len(st.session_state.messages) - 1
+        # Same keys as when the message is rendered with the history, so clicks are handled on the next run
+        citations_block(message.citations, id=id)
+        followup_block(message.follow_ups, id=id)
+
+
+class StreamlitReplyHandler(ReplyCallbackHandler):
+    """
+    Writes the reply into a placeholder while it is streamed, with citations already renumbered and follow-up
+    questions left out. Updates are throttled, as every update sends the full text to the browser.
+    """
+
+    def __init__(self, placeholder, interval: float = 0.05):
+        self.placeholder = placeholder
+        self.interval = interval
+        self.text = ''
+        self._updated = 0.
+
+    def _update(self, force: bool = False):
+        now = time.monotonic()
+        if force or now - self._updated >= self.interval:
+            self._updated = now
+            self.placeholder.markdown(self.text + ('' if force else ' ▌'))
+
+    def on_reply_text(self, text: str, **kwargs: Any):
+        self.text += text
+        self._update()
 
-    # Rerender the chat now messages have been updated
-    st.rerun()
+    def finish(self, text: str):
+        self.text = text
+        self._update(force=True)
 
 
 def on_generate_response(messages) -> AssistantMessage:
-    message_placeholder = st.empty()
+    handler = StreamlitReplyHandler(st.empty())
+    handler.placeholder.markdown('▌')
 
-    st_cb = StreamlitCallbackHandler(message_placeholder.container(), expand_new_thoughts=False)
+    # Summarize older turns, keeping the summary with the conversation so it is only extended every few turns
+    history, st.session_state.history_summary = history_compactor().compact(
+        messages[:-1], st.session_state.get('history_summary'),
+    )
 
     chain = conversation_chain()
     output = chain({
         'input': messages[-1].content,
-        'callbacks': [st_cb],
-        'history': messages[:-1],
+        'callbacks': [handler],
+        'history': history,
     })
 
+    handler.finish(output['reply'].formatted_content)
+    metrics().export()
     return output['reply']
 
 
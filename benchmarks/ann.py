@@ -0,0 +1,112 @@
+"""
+Measure recall@k against queries per second of the approximate nearest neighbour index on a synthetic corpus.
+
+    python benchmarks/ann.py --size 200000 --dimensions 1536
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from workshop_oai_qa.vectorstores.ann import DTYPES, IVFIndex  # noqa: E402
+
+
+def synthetic_corpus(size: int, dimensions: int, topics: int, seed: int = 0):
+    """Unit vectors scattered around random topic directions, like embeddings of documents on related subjects."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((topics, dimensions), dtype=np.float32)
+    labels = rng.integers(0, topics, size)
+    vectors = centers[labels] + rng.standard_normal(
+        (size, dimensions), dtype=np.float32
+    )
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def measure(search, queries, truth, k):
+    start = time.perf_counter()
+    results = [search(query) for query in queries]
+    seconds = time.perf_counter() - start
+
+    recall = np.mean(
+        [
+            len(set(result.tolist()) & set(expected.tolist())) / k
+            for result, expected in zip(results, truth)
+        ]
+    )
+    return {"recall": float(recall), "qps": len(queries) / seconds}
+
+
+def main(args):
+    vectors = synthetic_corpus(args.size + args.queries, args.dimensions, args.topics)
+    vectors, queries = vectors[: args.size], vectors[args.size :]
+    k = args.k
+
+    def exact(query):
+        scores = vectors @ query
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    truth = [exact(query) for query in queries]
+    results = [
+        {"index": "exact", "bytes": vectors.nbytes, **measure(exact, queries, truth, k)}
+    ]
+
+    for dtype in args.dtypes:
+        start = time.perf_counter()
+        index = IVFIndex.build(vectors, n_lists=args.n_lists, dtype=dtype)
+        build_seconds = time.perf_counter() - start
+
+        for n_probe in args.n_probe:
+            for rescore in args.rescore:
+
+                def search(query):
+                    return index.search(
+                        query, k, n_probe=n_probe, rescore=rescore, vectors=vectors
+                    )[0]
+
+                results.append(
+                    {
+                        "index": f"ivf-{dtype}",
+                        "n_lists": index.n_lists,
+                        "n_probe": n_probe,
+                        "rescore": rescore,
+                        "bytes": index.nbytes,
+                        "build_seconds": build_seconds,
+                        **measure(search, queries, truth, k),
+                    }
+                )
+
+    print(
+        f"{'index':<12}{'n_probe':>8}{'rescore':>8}{'memory':>10}{f'recall@{k}':>11}{'QPS':>10}"
+    )
+    for result in results:
+        print(
+            f"{result['index']:<12}{result.get('n_probe', ''):>8}{result.get('rescore', ''):>8}"
+            f"{result['bytes'] / 2 ** 20:>7.0f} MB{result['recall']:>11.3f}{result['qps']:>10.0f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100_000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--topics", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--n-lists", type=int, default=None)
+    parser.add_argument("--n-probe", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--rescore", type=int, nargs="+", default=[0, 4])
+    parser.add_argument("--dtypes", nargs="+", choices=DTYPES, default=DTYPES)
+    parser.add_argument("--output", type=str, help="Write results to a JSON file")
+    args = parser.parse_args()
+
+    main(args)
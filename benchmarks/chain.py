@@ -0,0 +1,214 @@
+"""
+Measure the overhead and concurrency scaling of DocumentAssistantChain with deterministic fake chat model,
+embeddings and retriever stand-ins with injected latencies. With zero latencies, this measures our own overhead:
+prompt assembly, reply parsing and chain dispatch.
+
+    python benchmarks/chain.py --turns 200 --concurrency 1 2 4 8 16 --output chain.json
+    python benchmarks/chain.py --llm-latency 0.5 --token-latency 0.01 --retriever-latency 0.1
+    python benchmarks/chain.py --rerank-k 40 --rerank-max-tokens 3000
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.schema import ChatMessage, Document  # noqa: E402
+
+from workshop_oai_qa.chain import DocumentAssistantChain  # noqa: E402
+from workshop_oai_qa.fakes import (  # noqa: E402
+    FakeChatModel,
+    FakeEmbeddings,
+    FakeVectorStore,
+    fake_num_tokens,
+)
+from workshop_oai_qa.metrics import MetricsRegistry  # noqa: E402
+from workshop_oai_qa.prompts.retrieval_qa import RetrievalQAPrompt  # noqa: E402
+from workshop_oai_qa.rerank import EmbeddingReranker  # noqa: E402
+
+QUESTIONS = [
+    "How do I install the library?",
+    "How do I load a pretrained model?",
+    "What is a tokenizer?",
+    "How do I fine-tune a model on my own dataset?",
+    "Which frameworks are supported?",
+    "How do I run a pipeline on a GPU?",
+]
+
+
+def load_documents(path: str) -> List[Document]:
+    """
+    Split the Markdown documents into sections, without the tokenizer the chunkers need. Token counts are stored in
+    the metadata, as the indexer does.
+    """
+    documents = []
+    for source in sorted(Path(path).glob("**/*.md")):
+        text = source.read_text(encoding="utf-8")
+        for section in re.split(r"\n(?=#)", text):
+            if section.strip():
+                metadata = {"source": source.name, "tokens": fake_num_tokens(section)}
+                documents.append(Document(page_content=section, metadata=metadata))
+    return documents
+
+
+def make_chain(documents: List[Document], args, metrics=None) -> DocumentAssistantChain:
+    vector_store = FakeVectorStore(
+        documents,
+        latency=args.retriever_latency,
+        embedding=FakeEmbeddings(latency=args.embedding_latency),
+    )
+    # Retrieve wide and rerank down to the token budget
+    reranker = EmbeddingReranker(FakeEmbeddings()) if args.rerank_k else None
+    return DocumentAssistantChain(
+        llm=FakeChatModel(latency=args.llm_latency, token_latency=args.token_latency),
+        retriever=vector_store.as_retriever(
+            search_kwargs={"k": args.rerank_k or args.k}
+        ),
+        prompt=RetrievalQAPrompt(
+            max_tokens=args.max_tokens, length_function=fake_num_tokens
+        ),
+        metrics=metrics,
+        reranker=reranker,
+        rerank_max_tokens=args.rerank_max_tokens,
+    )
+
+
+def inputs(turn: int):
+    question = QUESTIONS[turn % len(QUESTIONS)]
+    history = [
+        ChatMessage(role="user", content=QUESTIONS[(turn + 1) % len(QUESTIONS)]),
+        ChatMessage(role="assistant", content="This is an earlier answer. " * 20),
+    ]
+    return {"input": question, "history": history, "callbacks": None}
+
+
+def summarize(latencies: List[float], seconds: float) -> dict:
+    return {
+        "turns": len(latencies),
+        "seconds": seconds,
+        "turns_per_second": len(latencies) / seconds,
+        "p50_ms": float(np.percentile(latencies, 50)) * 1000,
+        "p99_ms": float(np.percentile(latencies, 99)) * 1000,
+    }
+
+
+def run_sequential(chain: DocumentAssistantChain, turns: int) -> dict:
+    latencies = []
+    start = time.perf_counter()
+    for turn in range(turns):
+        turn_start = time.perf_counter()
+        chain(inputs(turn))
+        latencies.append(time.perf_counter() - turn_start)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def run_concurrent(
+    chain: DocumentAssistantChain, turns: int, concurrency: int
+) -> dict:
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def turn(i: int):
+        async with semaphore:
+            turn_start = time.perf_counter()
+            await chain.acall(inputs(i))
+            latencies.append(time.perf_counter() - turn_start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(turn(i) for i in range(turns)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def main(args):
+    documents = load_documents(args.documents_path)
+
+    # Warm up caches of the prompt, e.g. the prefix messages, before measuring
+    make_chain(documents, args)(inputs(0))
+
+    metrics = MetricsRegistry()
+    sequential = run_sequential(make_chain(documents, args, metrics), args.turns)
+    stages = {
+        dict(labels)["stage"]: histogram
+        for (name, labels), histogram in metrics.histograms.items()
+        if name == "stage_seconds"
+    }
+    print(
+        f"sequential: {sequential['turns_per_second']:.1f} turns/s, "
+        f"p50 {sequential['p50_ms']:.1f} ms, p99 {sequential['p99_ms']:.1f} ms"
+    )
+    for stage, histogram in stages.items():
+        print(f"  {stage:>17}: p50 {histogram.percentile(0.5) * 1000:.2f} ms")
+    prompt_tokens = metrics.histogram("prompt_tokens", stage="prompt_assembly")
+    saved_tokens = metrics.histogram("prompt_tokens_saved", stage="rerank")
+    print(f"prompt tokens: p50 {prompt_tokens.percentile(0.5):.0f}", end="")
+    print(
+        f", saved by reranking p50 {saved_tokens.percentile(0.5):.0f}"
+        if saved_tokens
+        else ""
+    )
+
+    concurrency = {}
+    for c in args.concurrency:
+        result = asyncio.run(run_concurrent(make_chain(documents, args), args.turns, c))
+        concurrency[c] = result
+        print(
+            f"concurrency {c:>3}: {result['turns_per_second']:.1f} turns/s, "
+            f"p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "benchmark": "chain",
+                    "time": time.time(),
+                    "python": platform.python_version(),
+                    "args": vars(args),
+                    "documents": len(documents),
+                    "sequential": sequential,
+                    "stages_p50_ms": {
+                        stage: histogram.percentile(0.5) * 1000
+                        for stage, histogram in stages.items()
+                    },
+                    "prompt_tokens_p50": prompt_tokens.percentile(0.5),
+                    "prompt_tokens_saved_p50": (
+                        saved_tokens.percentile(0.5) if saved_tokens else None
+                    ),
+                    "concurrency": concurrency,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--documents-path", type=str, default="data/transformers_docs_medium"
+    )
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--max-tokens", type=int, default=12000)
+    parser.add_argument(
+        "--rerank-k",
+        type=int,
+        default=None,
+        help="Retrieve this many documents and rerank them",
+    )
+    parser.add_argument("--rerank-max-tokens", type=int, default=3000)
+    parser.add_argument("--llm-latency", type=float, default=0.0)
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    parser.add_argument("--embedding-latency", type=float, default=0.0)
+    parser.add_argument("--retriever-latency", type=float, default=0.0)
+    parser.add_argument("--output", type=str, default=None)
+    main(parser.parse_args())
@@ -0,0 +1,98 @@
+"""
+Compare throughput and peak memory of the document chunkers used by scripts/indexing.py.
+
+Each chunker runs in a fresh subprocess, so peak RSS includes the libraries it imports.
+
+    python benchmarks/chunking.py --documents-path data/transformers_docs_full
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from workshop_oai_qa.indexing.loading import CHUNKERS  # noqa: E402
+
+
+def run(args):
+    from workshop_oai_qa.indexing.loading import load_and_split
+
+    sources = sorted(str(path) for path in Path(args.documents_path).glob("**/*.md"))
+
+    start = time.perf_counter()
+    chunks = 0
+    for source in sources:
+        chunks += len(load_and_split(source, args.chunk_size, chunker=args.run).chunks)
+    seconds = time.perf_counter() - start
+
+    print(
+        json.dumps(
+            {
+                "chunker": args.run,
+                "files": len(sources),
+                "chunks": chunks,
+                "seconds": seconds,
+                "chunks_per_second": chunks / seconds,
+                # ru_maxrss is reported in kilobytes on Linux
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                / 1024,
+            }
+        )
+    )
+
+
+def main(args):
+    results = []
+    for chunker in args.chunkers:
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--documents-path",
+                args.documents_path,
+                "--chunk-size",
+                str(args.chunk_size),
+                "--run",
+                chunker,
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(
+        f"{'chunker':<14}{'files':>7}{'chunks':>8}{'seconds':>9}{'chunks/s':>10}{'peak RSS':>11}"
+    )
+    for result in results:
+        print(
+            f"{result['chunker']:<14}{result['files']:>7}{result['chunks']:>8}"
+            f"{result['seconds']:>9.2f}{result['chunks_per_second']:>10.1f}"
+            f"{result['peak_rss_mb']:>8.0f} MB"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--documents-path", type=str, default="data/transformers_docs_full"
+    )
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunkers", nargs="+", choices=CHUNKERS, default=CHUNKERS)
+    parser.add_argument("--output", type=str, help="Write results to a JSON file")
+    parser.add_argument("--run", choices=CHUNKERS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(args)
+    else:
+        main(args)
@@ -0,0 +1,112 @@
+"""
+Simulate long conversations with fake chat model and retriever stand-ins, and report the prompt tokens per turn
+with and without compacting the conversation history.
+
+    python benchmarks/history.py --turns 50 --keep-turns 3 --summarize-every 3
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.schema import ChatMessage, Document  # noqa: E402
+
+from workshop_oai_qa.chain import DocumentAssistantChain  # noqa: E402
+from workshop_oai_qa.fakes import (  # noqa: E402
+    FakeChatModel,
+    FakeVectorStore,
+    fake_num_tokens,
+    fake_response,
+)
+from workshop_oai_qa.history import HistoryCompactor  # noqa: E402
+from workshop_oai_qa.prompts.retrieval_qa import RetrievalQAPrompt  # noqa: E402
+
+DOCUMENTS = [
+    Document(
+        page_content=f"Document {i} about the transformers library. " * 20,
+        metadata={"source": f"{i}.md"},
+    )
+    for i in range(20)
+]
+
+
+def respond(messages):
+    """Answers padded with an html table, like the long answers that make the history grow."""
+    response = fake_response(messages)
+    if response.startswith("This is the answer."):
+        table = "<table>" + "<tr><td>cell</td><td>value</td></tr>" * 40 + "</table>"
+        response = table + "\n" + response
+    return response
+
+
+def simulate(turns: int, compactor: HistoryCompactor = None):
+    chain = DocumentAssistantChain(
+        llm=FakeChatModel(respond=respond),
+        retriever=FakeVectorStore(DOCUMENTS).as_retriever(search_kwargs={"k": 5}),
+        prompt=RetrievalQAPrompt(length_function=fake_num_tokens),
+    )
+
+    messages = [ChatMessage(role="assistant", content="How may I help you?")]
+    summary = None
+    results = []
+    for turn in range(turns):
+        messages.append(
+            ChatMessage(role="user", content=f"Question {turn} about the library?")
+        )
+
+        start = time.perf_counter()
+        history = messages[:-1]
+        if compactor:
+            history, summary = compactor.compact(history, summary)
+        output = chain(
+            {"input": messages[-1].content, "history": history, "callbacks": None}
+        )
+        seconds = time.perf_counter() - start
+
+        messages.append(output["reply"])
+        results.append(
+            {
+                "turn": turn + 1,
+                "prompt_tokens": output["prompt_tokens"],
+                "seconds": seconds,
+            }
+        )
+    return results
+
+
+def main(args):
+    runs = {
+        "full history": simulate(args.turns),
+        "compacted": simulate(
+            args.turns,
+            HistoryCompactor(
+                FakeChatModel(),
+                keep_turns=args.keep_turns,
+                summarize_every=args.summarize_every,
+            ),
+        ),
+    }
+
+    for name, results in runs.items():
+        tokens = [result["prompt_tokens"] for result in results]
+        print(
+            f"{name:>13}: prompt tokens turn 1 {tokens[0]}, turn 10 {tokens[min(9, len(tokens) - 1)]}, "
+            f"turn {len(tokens)} {tokens[-1]}, max {max(tokens)}, mean {statistics.mean(tokens):.0f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(runs, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--keep-turns", type=int, default=3)
+    parser.add_argument("--summarize-every", type=int, default=3)
+    parser.add_argument("--output", type=str, default=None)
+    main(parser.parse_args())
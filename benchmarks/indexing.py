@@ -0,0 +1,119 @@
+"""
+Measure the indexing throughput of scripts/indexing.py in chunks/s, with deterministic fake embeddings and
+index writer stand-ins for Azure OpenAI and Azure Cognitive Search with injected latencies. Tokens are counted with
+`fake_num_tokens`, as tiktoken needs to download its encodings.
+
+    python benchmarks/indexing.py --chunker markdown --output indexing.json
+    python benchmarks/indexing.py --embedding-latency 0.2 --writer-latency 0.05 --datasets data/minimal
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripts import indexing  # noqa: E402
+from workshop_oai_qa.fakes import (  # noqa: E402
+    FakeEmbeddings,
+    FakeIndexWriter,
+    fake_num_tokens,
+)
+from workshop_oai_qa.indexing.loading import CHUNKERS  # noqa: E402
+
+DATASETS = [
+    "data/minimal",
+    "data/transformers_docs_medium",
+    "data/transformers_docs_full",
+]
+
+
+def run(documents_path: str, cache_dir: str, args) -> dict:
+    index_args = argparse.Namespace(
+        documents_path=documents_path,
+        chunk_size=args.chunk_size,
+        chunker=args.chunker,
+        vector_store="azure",
+        ann_dtype=None,
+        ann_lists=None,
+        dedup_threshold=None,
+        incremental=False,
+        manifest=None,
+        # A fresh embedding cache, so every chunk is embedded
+        embedding_cache=os.path.join(cache_dir, "embeddings.sqlite"),
+        batch_size=args.batch_size,
+        max_workers=args.max_workers,
+        workers=args.workers,
+        buffer_size=8,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        rate_limit_path=None,
+    )
+    embeddings = FakeEmbeddings(latency=args.embedding_latency)
+    writer = FakeIndexWriter(latency=args.writer_latency)
+
+    start = time.perf_counter()
+    stats = indexing.main(
+        index_args,
+        embeddings=embeddings,
+        writer=writer,
+        length_function=fake_num_tokens,
+    )
+    seconds = time.perf_counter() - start
+
+    return {
+        "documents_path": documents_path,
+        "sources": stats.sources,
+        "chunks": stats.chunks,
+        "seconds": seconds,
+        "chunks_per_second": stats.chunks / seconds,
+        "first_upload_seconds": stats.first_upload,
+        "embedding_requests": embeddings.requests,
+        "writer_requests": writer.requests,
+    }
+
+
+def main(args):
+    results = []
+    for documents_path in args.datasets:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            result = run(documents_path, cache_dir, args)
+        results.append(result)
+        print(
+            f"{documents_path}: {result['chunks']} chunks of {result['sources']} files in "
+            f"{result['seconds']:.1f}s, {result['chunks_per_second']:.0f} chunks/s"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "benchmark": "indexing",
+                    "time": time.time(),
+                    "python": platform.python_version(),
+                    "args": vars(args),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datasets", type=str, nargs="+", default=DATASETS)
+    parser.add_argument("--chunker", choices=CHUNKERS, default="markdown")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--embedding-latency", type=float, default=0.0)
+    parser.add_argument("--writer-latency", type=float, default=0.0)
+    # No quota by default, to measure our own overhead
+    parser.add_argument("--requests-per-minute", type=float, default=None)
+    parser.add_argument("--tokens-per-minute", type=float, default=None)
+    parser.add_argument("--output", type=str, default=None)
+    main(parser.parse_args())
@@ -0,0 +1,92 @@
+"""
+Measure the latency of a turn with and without speculative retrieval, using fake chat model and retriever
+stand-ins with fixed latencies. Each strategy is forced by how much the generated query differs from the input.
+
+    python benchmarks/speculative.py --llm-latency 0.8 --retriever-latency 0.3
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.schema import Document  # noqa: E402
+
+from workshop_oai_qa.chain import DocumentAssistantChain  # noqa: E402
+from workshop_oai_qa.fakes import FakeChatModel, FakeVectorStore  # noqa: E402
+
+INPUT = "How do I install the library?"
+
+# Generated queries leading to each way of handling the speculative results
+QUERIES = {
+    "reuse": "How do I install the library",
+    "discard": "pip installation instructions",
+}
+
+DOCUMENTS = [
+    Document(
+        page_content=f"Document {i} about installing the library",
+        metadata={"source": f"{i}.md"},
+    )
+    for i in range(20)
+]
+
+
+def make_chain(query: str, speculative: bool, args) -> DocumentAssistantChain:
+    def respond(messages):
+        if messages[-1].content.startswith("Generate search query for: "):
+            return query
+        return "This is the answer. [0.md]\n<<Can you tell me more?>>"
+
+    return DocumentAssistantChain(
+        llm=FakeChatModel(respond=respond, latency=args.llm_latency),
+        retriever=FakeVectorStore(
+            DOCUMENTS, latency=args.retriever_latency
+        ).as_retriever(search_kwargs={"k": 5}),
+        speculative_retrieval=speculative,
+    )
+
+
+def measure(chain: DocumentAssistantChain, turns: int):
+    """Seconds until the answer prompt is ready, i.e. the time to first token minus the answer latency."""
+    seconds = []
+    for _ in range(turns):
+        start = time.perf_counter()
+        chain.retrieve(INPUT)
+        seconds.append(time.perf_counter() - start)
+    return {"mean_ms": 1000 * statistics.mean(seconds)}
+
+
+def main(args):
+    results = []
+    for strategy, query in QUERIES.items():
+        for speculative in (False, True):
+            chain = make_chain(query, speculative, args)
+            results.append(
+                {
+                    "strategy": strategy if speculative else "sequential",
+                    "query": query,
+                    **measure(chain, args.turns),
+                }
+            )
+
+    for result in results:
+        print(
+            f"{result['strategy']:>10}  {result['mean_ms']:7.0f} ms  query: {result['query']}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--llm-latency", type=float, default=0.8)
+    parser.add_argument("--retriever-latency", type=float, default=0.3)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--output", type=str, default=None)
+    main(parser.parse_args())
@@ -0,0 +1,110 @@
+"""
+Answer questions from a JSON lines file with the document assistant chain, e.g. for evaluation or to warm up
+the caches. Results are appended to the output as they finish, and an interrupted run resumes where it stopped
+when started again with the same output.
+
+    python scripts/batch_qa.py questions.jsonl answers.jsonl --concurrency 8 --requests-per-minute 300
+    python scripts/batch_qa.py questions.jsonl answers.jsonl --fake
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+from dotenv import load_dotenv
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from workshop_oai_qa.batch import BatchRunner, read_questions  # noqa: E402
+from workshop_oai_qa.ratelimit import RateLimiter  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+def fake_chain(args):
+    """Chain with fake chat model and retriever stand-ins, for trying out the batch runner offline."""
+    from pathlib import Path
+
+    from langchain.schema import Document
+
+    from workshop_oai_qa.chain import DocumentAssistantChain
+    from workshop_oai_qa.fakes import FakeChatModel, FakeVectorStore, fake_num_tokens
+    from workshop_oai_qa.prompts.retrieval_qa import RetrievalQAPrompt
+
+    documents = [
+        Document(
+            page_content=path.read_text(encoding="utf-8"),
+            metadata={"source": path.name},
+        )
+        for path in sorted(Path(args.documents_path).glob("**/*.md"))
+    ]
+    return DocumentAssistantChain(
+        llm=FakeChatModel(latency=args.fake_latency),
+        retriever=FakeVectorStore(documents, latency=args.fake_latency).as_retriever(
+            search_kwargs={"k": 5}
+        ),
+        prompt=RetrievalQAPrompt(length_function=fake_num_tokens),
+    )
+
+
+def main(args):
+    if args.fake:
+        chain = fake_chain(args)
+    else:
+        from workshop_oai_qa.resources import conversation_chain
+
+        chain = conversation_chain()
+
+    runner = BatchRunner(
+        chain,
+        concurrency=args.concurrency,
+        rate_limiter=RateLimiter(
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+            # Shares the quota with the app when it uses the same RATE_LIMIT_PATH
+            path=args.rate_limit_path,
+            name=f"chat/{os.getenv('OPENAI_DEPLOYMENT_COMPLETION')}",
+        ),
+        max_retries=args.max_retries,
+    )
+    stats = runner.run(read_questions(args.input), args.output)
+    print(json.dumps(stats.summary(), indent=2))
+
+    if args.stats:
+        with open(args.stats, "w") as f:
+            json.dump(stats.summary(), f, indent=2)
+
+
+if __name__ == "__main__":
+    load_dotenv(override=True)
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "input", type=str, help="JSON lines with a question, id and history per line"
+    )
+    parser.add_argument("output", type=str, help="JSON lines with the answers")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests-per-minute", type=float, default=None)
+    parser.add_argument("--tokens-per-minute", type=float, default=None)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument(
+        "--rate-limit-path",
+        type=str,
+        default=os.getenv("RATE_LIMIT_PATH") or None,
+        help="SQLite database holding the quota shared with the app, defaults to RATE_LIMIT_PATH",
+    )
+    parser.add_argument(
+        "--stats", type=str, default=None, help="Write throughput and latency as JSON"
+    )
+    parser.add_argument(
+        "--fake",
+        action="store_true",
+        help="Answer with fake chat model and retriever stand-ins instead of Azure",
+    )
+    parser.add_argument("--fake-latency", type=float, default=0.0)
+    parser.add_argument("--documents-path", type=str, default="data/minimal")
+    args = parser.parse_args()
+
+    main(args)
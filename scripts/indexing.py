@@ -1,7 +1,11 @@
 import os
-import time
+import sys
 import argparse
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Callable
 
 from azure.search.documents.indexes.models import (
     SearchableField,
@@ -10,53 +14,51 @@ from azure.search.documents.indexes.models import (
     SearchField,
 )
 from dotenv import load_dotenv
-from langchain.document_loaders import DirectoryLoader
-from langchain.document_loaders import UnstructuredMarkdownLoader
-from langchain.text_splitter import CharacterTextSplitter
 from langchain.embeddings import OpenAIEmbeddings
+from langchain.schema.embeddings import Embeddings
 from langchain.vectorstores.azuresearch import AzureSearch
 
-logger = logging.getLogger(__name__)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from workshop_oai_qa.embeddings import BatchEmbedder, CachedEmbeddings  # noqa: E402
+from workshop_oai_qa.indexing.manifest import (  # noqa: E402
+    diff_chunks,
+    file_hash,
+    open_manifest,
+)
+from workshop_oai_qa.indexing.dedup import MinHashDeduplicator  # noqa: E402
+from workshop_oai_qa.indexing.loading import (  # noqa: E402
+    CHUNKERS,
+    ParseTimes,
+    load_and_split,
+)
+from workshop_oai_qa.indexing.pipeline import (  # noqa: E402
+    IndexingStats,
+    SourceChanges,
+    buffered,
+    index_documents,
+    ordered_map,
+)
+from workshop_oai_qa.indexing.writers import (  # noqa: E402
+    AzureSearchWriter,
+    IndexWriter,
+    LocalVectorStoreWriter,
+)
+from workshop_oai_qa.ratelimit import RateLimiter  # noqa: E402
+from workshop_oai_qa.utils import num_tokens  # noqa: E402
+from workshop_oai_qa.vectorstores.ann import DTYPES  # noqa: E402
+from workshop_oai_qa.vectorstores.local import LocalVectorStore  # noqa: E402
 
-def main(args):
-    # Load Markdown documents recursively from a directory
-    logger.info("Loading documents...")
-    loader = DirectoryLoader(
-        path=args.documents_path, loader_cls=UnstructuredMarkdownLoader, glob="**/*.md"
-    )
-    docs = loader.load()
+logger = logging.getLogger(__name__)
 
-    # Split documents into chunks
-    logger.info("Splitting documents...")
-    text_splitter = CharacterTextSplitter.from_tiktoken_encoder(
-        chunk_size=args.chunk_size,
-        chunk_overlap=0,
-        add_start_index=True,
-    )
-    docs = text_splitter.split_documents(docs)
 
-    # Create Azure OpenAI Embedding Model Client
-    logger.info("Connecting to Azure Cognitive Services...")
-    os.environ["OPENAI_API_TYPE"] = "azure"
-    assert "OPENAI_API_KEY" in os.environ, "OPENAI_API_KEY not set"
-    assert "OPENAI_API_BASE" in os.environ, "OPENAI_API_BASE not set"
-    embeddings = OpenAIEmbeddings(
-        model="text-embedding-ada-002",
-        deployment=os.getenv("OPENAI_DEPLOYMENT_EMBEDDING"),
-    )
-
-    # Throttle embedding requests to 5 per second due to Azure OpenAI Services rate limits
-    def embed_query_throttled(query: str):
-        time.sleep(args.throttle)
-        return embeddings.embed_query(query)
-
-    # Create Azure Search Vector Store Client and define index schema
-    vector_store: AzureSearch = AzureSearch(
+def create_azure_search(embedding_function) -> AzureSearch:
+    """Create Azure Search Vector Store Client and define index schema"""
+    return AzureSearch(
         azure_search_endpoint=os.getenv("AZURE_SEARCH_ENDPOINT"),
         azure_search_key=os.getenv("AZURE_SEARCH_KEY"),
         index_name=os.getenv("AZURE_SEARCH_INDEX"),
-        embedding_function=embed_query_throttled,
+        embedding_function=embedding_function,
         search_type="hybrid",
         fields=[
             SimpleField(
@@ -87,21 +89,295 @@ def main(args):
         ],
     )
 
-    # Index documents
+
+def main(
+    args,
+    embeddings: Embeddings = None,
+    writer: IndexWriter = None,
+    length_function: Callable[[str], int] = None,
+) -> IndexingStats:
+    """
+    Index the Markdown documents in `args.documents_path`.
+    :param args:
+    :param embeddings: Embeddings model, Azure OpenAI by default
+    :param writer: Index writer, for the vector store in `args.vector_store` by default
+    :param length_function: Token counter for chunking, the embedding quota and deduplication, tiktoken by default
+    :return:
+    """
+    # Find Markdown documents recursively in a directory
+    sources = sorted(str(path) for path in Path(args.documents_path).glob("**/*.md"))
+
+    # Only reindex source files that changed since the last incremental run,
+    # or all of them when they are chunked differently
+    manifest = open_manifest(args.manifest) if args.incremental else None
+    settings = f"{args.chunker}:{args.chunk_size}"
+    hashes = {source: file_hash(source, settings) for source in sources}
+    removed = []
+    if manifest:
+        removed = [source for source in manifest.sources() if source not in hashes]
+        sources = [
+            source for source in sources if manifest.file_hash(source) != hashes[source]
+        ]
+        logger.info(f"{len(sources)} changed and {len(removed)} removed files")
+
+    # Create Azure OpenAI Embedding Model Client
+    if embeddings is None:
+        logger.info("Connecting to Azure Cognitive Services...")
+        os.environ["OPENAI_API_TYPE"] = "azure"
+        assert "OPENAI_API_KEY" in os.environ, "OPENAI_API_KEY not set"
+        assert "OPENAI_API_BASE" in os.environ, "OPENAI_API_BASE not set"
+        embeddings = OpenAIEmbeddings(
+            model="text-embedding-ada-002",
+            deployment=os.getenv("OPENAI_DEPLOYMENT_EMBEDDING"),
+            chunk_size=args.batch_size,
+            # Rate limits are handled by the batch embedder instead of per-request retries
+            max_retries=1,
+        )
+
+    # Embed chunks within the deployment's requests and tokens per minute quota,
+    # skipping chunks that were embedded before
+    batch_embedder = BatchEmbedder(
+        embeddings,
+        batch_size=args.batch_size,
+        max_workers=args.max_workers,
+        rate_limiter=RateLimiter(
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+            # Shares the quota with the app when it uses the same RATE_LIMIT_PATH
+            path=args.rate_limit_path,
+            name=f"embedding/{os.getenv('OPENAI_DEPLOYMENT_EMBEDDING')}",
+        ),
+        length_function=length_function or num_tokens,
+    )
+    embedder = CachedEmbeddings(
+        batch_embedder,
+        path=args.embedding_cache,
+        namespace=f"text-embedding-ada-002/{os.getenv('OPENAI_DEPLOYMENT_EMBEDDING')}",
+    )
+
+    # Write to Azure Cognitive Search or to a local vector store
+    if writer is None and args.vector_store == "local":
+        writer = LocalVectorStoreWriter(
+            LocalVectorStore(path=args.local_path, embedding=embedder)
+        )
+    elif writer is None:
+        writer = AzureSearchWriter(create_azure_search(embedder.embed_query))
+
+    # Skip chunks that are near-duplicates of chunks indexed earlier in this run,
+    # or in earlier runs when indexing incrementally
+    deduplicator = None
+    if args.dedup_threshold:
+        deduplicator = MinHashDeduplicator(
+            threshold=args.dedup_threshold,
+            length_function=length_function or num_tokens,
+        )
+        if manifest:
+            deduplicator.seed(manifest)
+
+    # Remove chunks of deleted source files
+    for source in removed:
+        ids = list(manifest.chunks(source).values())
+        writer.delete(ids)
+        manifest.remove(source)
+        if deduplicator:
+            deduplicator.forget(source)
+            deduplicator.remove(ids)
+
+    # Load and split documents in a background thread, buffering a few files ahead.
+    # With multiple workers, files are parsed in a process pool, keeping the order of the files
+    parse_times = ParseTimes()
+    executor = (
+        ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    )
+
+    def loaded_sources(sources):
+        for loaded in ordered_map(
+            partial(
+                load_and_split,
+                chunk_size=args.chunk_size,
+                chunker=args.chunker,
+                length_function=length_function,
+            ),
+            sources,
+            executor=executor,
+            max_pending=2 * args.workers,
+        ):
+            parse_times.record(loaded.source, loaded.seconds)
+            yield loaded.source, loaded.chunks
+
+    # Remove stale chunks and record progress once all new chunks of a source are uploaded
+    def on_source_indexed(source: SourceChanges):
+        if source.changes.deleted_ids:
+            writer.delete(source.changes.deleted_ids)
+        if manifest and deduplicator:
+            manifest.update(
+                source.source,
+                source.file_hash,
+                source.changes.chunks,
+                duplicates=deduplicator.duplicate_chunks(source.source),
+                signatures=deduplicator.signatures(source.changes.added_ids),
+            )
+        elif manifest:
+            manifest.update(source.source, source.file_hash, source.changes.chunks)
+
+    def index_sources(sources) -> IndexingStats:
+        # Determine which chunks are new and which index entries no longer exist
+        changes = (
+            SourceChanges(
+                source=source,
+                file_hash=hashes[source],
+                changes=diff_chunks(
+                    manifest.chunks(source) if manifest else {}, source, chunks
+                ),
+            )
+            for source, chunks in buffered(
+                loaded_sources(sources), maxsize=args.buffer_size
+            )
+        )
+        if deduplicator:
+            changes = map(deduplicator.filter, changes)
+
+        # Embed and upload chunks while documents are still being loaded
+        return index_documents(
+            changes,
+            embeddings=embedder,
+            writer=writer,
+            batch_size=args.batch_size,
+            max_in_flight=args.max_workers,
+            on_source_indexed=on_source_indexed,
+        )
+
     logger.info("Indexing documents...")
-    vector_store.add_documents(docs)
+    try:
+        stats = index_sources(sources)
+        # Index the duplicates of canonical chunks that were deleted, from files that did not change
+        while deduplicator and deduplicator.orphaned:
+            orphaned = sorted(deduplicator.orphaned)
+            logger.info(
+                f"Reindexing {len(orphaned)} files with duplicates of deleted chunks"
+            )
+            reindexed = index_sources(orphaned)
+            stats.sources += reindexed.sources
+            stats.chunks += reindexed.chunks
+            stats.batches += reindexed.batches
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    parse_times.log()
+
+    # Record the sources of skipped duplicates on their canonical chunks
+    if deduplicator:
+        writer.update_metadata(
+            {id: deduplicator.metadata(id) for id in deduplicator.updated_ids}
+        )
+        deduplicator.log()
+
+    logger.info(f"Embedded {batch_embedder.stats}")
+    logger.info(
+        f"Embedding cache: {embedder.hits} hits, {embedder.misses} misses "
+        f"({embedder.hit_rate:.0%} hit rate)"
+    )
+
+    # Build the keyword index for hybrid search over the local vector store
+    if args.vector_store == "local":
+        bm25 = writer.vector_store.build_keyword_index()
+        logger.info(f"Built keyword index of {len(bm25.terms)} terms")
+
+    # Build an approximate nearest neighbour index over the local vector store
+    if args.vector_store == "local" and args.ann_dtype:
+        logger.info("Building approximate nearest neighbour index...")
+        ann = writer.vector_store.build_index(
+            n_lists=args.ann_lists, dtype=args.ann_dtype
+        )
+        logger.info(
+            f"Indexed {len(ann)} vectors in {ann.n_lists} lists "
+            f"({ann.nbytes / 2 ** 20:.0f} MB)"
+        )
+
+    if manifest:
+        manifest.close()
     logger.info("Done!")
+    return stats
 
 
 if __name__ == "__main__":
     load_dotenv(override=True)
+    logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--documents-path", type=str, default="data/transformers_docs_full"
     )
     parser.add_argument("--chunk-size", type=int, default=1000)
-    parser.add_argument("--throttle", type=float, default=1.2)
+    parser.add_argument(
+        "--vector-store",
+        choices=["azure", "local"],
+        default=os.getenv("VECTOR_STORE", "azure"),
+    )
+    parser.add_argument(
+        "--local-path",
+        type=str,
+        default=os.getenv("LOCAL_VECTOR_STORE_PATH", ".index"),
+        help="Directory of the local vector store",
+    )
+    parser.add_argument(
+        "--ann-dtype",
+        choices=DTYPES,
+        default=None,
+        help="Build an approximate nearest neighbour index over the local vector store, "
+        "storing vectors with this precision",
+    )
+    parser.add_argument(
+        "--ann-lists",
+        type=int,
+        default=None,
+        help="Number of inverted lists of the approximate index, 4 * sqrt(n) by default",
+    )
+    parser.add_argument(
+        "--chunker",
+        choices=CHUNKERS,
+        default="unstructured",
+        help="Parse with Unstructured or split along the Markdown structure",
+    )
+    parser.add_argument(
+        "--dedup-threshold",
+        type=float,
+        default=None,
+        help="Skip chunks whose estimated similarity to an earlier chunk is at least this value, e.g. 0.9",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only index changed chunks and delete removed ones, tracked in --manifest",
+    )
+    parser.add_argument("--manifest", type=str, default=".index-manifest.sqlite")
+    parser.add_argument(
+        "--embedding-cache",
+        type=str,
+        default=os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite"),
+    )
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of processes parsing and splitting documents",
+    )
+    parser.add_argument(
+        "--buffer-size",
+        type=int,
+        default=8,
+        help="Number of split files buffered ahead of embedding",
+    )
+    parser.add_argument("--requests-per-minute", type=float, default=720)
+    parser.add_argument("--tokens-per-minute", type=float, default=120_000)
+    parser.add_argument(
+        "--rate-limit-path",
+        type=str,
+        default=os.getenv("RATE_LIMIT_PATH") or None,
+        help="SQLite database to share the embedding quota with other processes",
+    )
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,54 @@
+from typing import Callable, List, Optional
+
+import pytest
+from langchain.schema import BaseMessage, Document
+
+from workshop_oai_qa.chain import DocumentAssistantChain
+from workshop_oai_qa.fakes import FakeChatModel, FakeVectorStore, fake_num_tokens, fake_response
+from workshop_oai_qa.prompts.retrieval_qa import RetrievalQAPrompt
+
+DOCUMENTS = [
+    Document(page_content=f'Document {i} about transformers', metadata={'source': f'{i}.md'}) for i in range(5)
+]
+
+LIBRARY_DOCUMENTS = [
+    Document(page_content='Load a pretrained model with from_pretrained', metadata={'source': 'models.md'}),
+    Document(page_content='The tokenizer splits text into tokens', metadata={'source': 'tokenizers.md'}),
+    Document(page_content='Install the library with pip', metadata={'source': 'installation.md'}),
+    Document(page_content='Fine-tune a pretrained model on a dataset', metadata={'source': 'training.md'}),
+]
+
+
+@pytest.fixture
+def documents() -> List[Document]:
+    return DOCUMENTS
+
+
+@pytest.fixture
+def library_documents() -> List[Document]:
+    return LIBRARY_DOCUMENTS
+
+
+@pytest.fixture
+def make_chain() -> Callable[..., DocumentAssistantChain]:
+    """
+    Factory of chains over fake models that answer from `documents`, the numbered transformers documents by default.
+    Other keyword arguments are passed on to the chain.
+    """
+
+    def make(
+            documents: Optional[List[Document]] = None,
+            k: int = 3,
+            respond: Callable[[List[BaseMessage]], str] = fake_response,
+            latency: float = 0.0,
+            **kwargs,
+    ) -> DocumentAssistantChain:
+        vectorstore = FakeVectorStore(DOCUMENTS if documents is None else documents, latency=latency)
+        return DocumentAssistantChain(
+            llm=FakeChatModel(respond=respond, latency=latency),
+            retriever=vectorstore.as_retriever(search_kwargs={'k': k}),
+            prompt=RetrievalQAPrompt(length_function=fake_num_tokens),
+            **kwargs,
+        )
+
+    return make
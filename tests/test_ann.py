@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from workshop_oai_qa.fakes import FakeEmbeddings
+from workshop_oai_qa.vectorstores.ann import IVFIndex
+from workshop_oai_qa.vectorstores.local import LocalVectorStore
+
+
+@pytest.fixture(scope='module')
+def vectors():
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((20, 32), dtype=np.float32)
+    vectors = centers[rng.integers(0, 20, 2000)] + rng.standard_normal((2000, 32), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def exact(vectors, query, k):
+    return set(np.argsort(-(vectors @ query))[:k].tolist())
+
+
+@pytest.mark.parametrize('dtype', ['int8', 'float16'])
+def test_ivf_recall(vectors, dtype):
+    index = IVFIndex.build(vectors, n_lists=16, dtype=dtype)
+    assert len(index) == len(vectors)
+    assert index.nbytes < vectors.nbytes
+
+    recall = []
+    for query in vectors[:50]:
+        rows, scores = index.search(query, 10, n_probe=4, rescore=4, vectors=vectors)
+        assert list(scores) == sorted(scores, reverse=True)
+        recall.append(len(set(rows.tolist()) & exact(vectors, query, 10)) / 10)
+    assert np.mean(recall) > 0.9
+
+    # Scanning every list with rescoring is exact
+    rows, _ = index.search(vectors[0], 10, n_probe=16, rescore=4, vectors=vectors)
+    assert set(rows.tolist()) == exact(vectors, vectors[0], 10)
+
+
+def test_ivf_mask(vectors):
+    index = IVFIndex.build(vectors, n_lists=16)
+    mask = np.zeros(len(vectors), dtype=bool)
+    mask[::2] = True
+
+    rows, _ = index.search(vectors[1], 10, n_probe=16, mask=mask)
+    assert all(row % 2 == 0 for row in rows)
+
+
+def test_ivf_save_load(vectors, tmp_path):
+    index = IVFIndex.build(vectors, n_lists=16)
+    index.save(str(tmp_path / 'ivf.npz'))
+    loaded = IVFIndex.load(str(tmp_path / 'ivf.npz'))
+
+    assert np.array_equal(index.search(vectors[0], 5)[0], loaded.search(vectors[0], 5)[0])
+
+
+def test_store_with_index(tmp_path):
+    embeddings = FakeEmbeddings(size=16)
+    store = LocalVectorStore(path=str(tmp_path / 'index'), embedding=embeddings, n_probe=64)
+    texts = [f'document {i}' for i in range(300)]
+    store.add_texts(texts, ids=[str(i) for i in range(300)])
+
+    store.build_index(n_lists=8)
+    assert store.similarity_search('document 42', k=1)[0].page_content == 'document 42'
+
+    # Rows added after building the index are still found
+    store.add_texts(['added later'], ids=['later'])
+    store = LocalVectorStore(path=str(tmp_path / 'index'), embedding=embeddings)
+    assert store.ann is not None
+    assert store.similarity_search('added later', k=1)[0].page_content == 'added later'
+
+    store.compact()
+    assert store.ann is None
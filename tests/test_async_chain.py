@@ -0,0 +1,50 @@
+import asyncio
+import time
+from functools import partial
+
+import pytest
+
+from workshop_oai_qa.chain import AssistantMessage
+
+LATENCY = 0.05
+
+
+@pytest.fixture
+def make_chain(make_chain, library_documents):
+    return partial(make_chain, documents=library_documents, k=2)
+
+
+def inputs(input: str):
+    return {'input': input, 'history': [], 'callbacks': None}
+
+
+def test_acall_matches_call(make_chain):
+    chain = make_chain()
+
+    sync_outputs = chain(inputs('How do I install the library?'))
+    async_outputs = asyncio.run(chain.acall(inputs('How do I install the library?')))
+
+    for key in ('query', 'follow_ups', 'citations'):
+        assert async_outputs[key] == sync_outputs[key]
+    assert isinstance(async_outputs['reply'], AssistantMessage)
+    assert async_outputs['reply'].formatted_content == sync_outputs['reply'].formatted_content
+    assert async_outputs['citations'][0].metadata['source'] == 'installation.md'
+    assert async_outputs['reply'].formatted_content == 'This is the answer. [1]'
+    assert async_outputs['follow_ups'] == ['Can you tell me more?']
+
+
+@pytest.mark.parametrize('concurrency', [1, 10])
+def test_concurrent_conversations(concurrency, make_chain):
+    chain = make_chain(latency=LATENCY)
+
+    async def run():
+        return await asyncio.gather(*(chain.acall(inputs(f'Question {i} about pip')) for i in range(concurrency)))
+
+    start = time.perf_counter()
+    outputs = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+
+    # Three sequential round trips per turn, overlapping across conversations on a single event loop
+    assert len(outputs) == concurrency
+    assert elapsed < 3 * LATENCY * 2
+    assert chain.llm.calls == 2 * concurrency
@@ -0,0 +1,82 @@
+import json
+
+from openai.error import RateLimitError
+
+from workshop_oai_qa.batch import BatchRunner, completed_ids, read_questions
+from workshop_oai_qa.fakes import fake_response
+
+
+def write_questions(path, count: int):
+    with open(path, 'w') as f:
+        for i in range(count):
+            f.write(json.dumps({'question': f'Question {i} about transformers?'}) + '\n')
+
+
+def read_output(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_batch(tmp_path, make_chain):
+    write_questions(tmp_path / 'questions.jsonl', 20)
+
+    runner = BatchRunner(make_chain(), concurrency=4)
+    stats = runner.run(read_questions(tmp_path / 'questions.jsonl'), str(tmp_path / 'answers.jsonl'))
+
+    results = read_output(tmp_path / 'answers.jsonl')
+    assert sorted(result['id'] for result in results) == list(range(20))
+    assert all(result['answer'] == 'This is the answer. [1]' for result in results)
+    assert all(result['follow_ups'] == ['Can you tell me more?'] for result in results)
+    assert stats.answered == 20
+    assert stats.summary()['p99_seconds'] >= stats.summary()['p50_seconds'] > 0
+
+
+def test_resume(tmp_path, make_chain):
+    write_questions(tmp_path / 'questions.jsonl', 10)
+    output = tmp_path / 'answers.jsonl'
+    BatchRunner(make_chain(), concurrency=2).run(list(read_questions(tmp_path / 'questions.jsonl'))[:6], str(output))
+    # A result cut off by an interruption is answered again
+    with open(output, 'a') as f:
+        f.write('{"id": 6, "quest')
+
+    chain = make_chain()
+    stats = BatchRunner(chain, concurrency=1).run(read_questions(tmp_path / 'questions.jsonl'), str(output))
+
+    assert stats.skipped == 6
+    assert stats.answered == 4
+    # Query generation and answer for each of the remaining questions
+    assert chain.llm.calls == 8
+    assert completed_ids(str(output)) == {str(i) for i in range(10)}
+
+
+def test_rate_limited_questions_are_retried(tmp_path, make_chain):
+    calls = []
+
+    def respond(messages):
+        calls.append(messages)
+        if len(calls) == 1:
+            raise RateLimitError('Rate limit exceeded', http_status=429, headers={'retry-after': '0'})
+        return fake_response(messages)
+
+    write_questions(tmp_path / 'questions.jsonl', 1)
+    runner = BatchRunner(make_chain(respond=respond), concurrency=1, backoff=0)
+    stats = runner.run(read_questions(tmp_path / 'questions.jsonl'), str(tmp_path / 'answers.jsonl'))
+
+    assert stats.answered == 1 and stats.retries == 1
+    assert 'error' not in read_output(tmp_path / 'answers.jsonl')[0]
+
+
+def test_failed_questions_are_asked_again(tmp_path, make_chain):
+    def respond(messages):
+        raise ValueError('Model unavailable')
+
+    write_questions(tmp_path / 'questions.jsonl', 2)
+    output = str(tmp_path / 'answers.jsonl')
+    stats = BatchRunner(make_chain(respond=respond)).run(read_questions(tmp_path / 'questions.jsonl'), output)
+
+    assert stats.failed == 2
+    assert [result['error'] for result in read_output(output)] == ['Model unavailable'] * 2
+    assert completed_ids(output) == set()
+
+    stats = BatchRunner(make_chain()).run(read_questions(tmp_path / 'questions.jsonl'), output)
+    assert stats.answered == 2
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from workshop_oai_qa.fakes import FakeEmbeddings
+from workshop_oai_qa.utils import reciprocal_rank_fusion
+from workshop_oai_qa.vectorstores.bm25 import BM25Index, tokenize
+from workshop_oai_qa.vectorstores.local import LocalVectorStore
+
+TEXTS = [
+    'The tokenizer splits text into tokens',
+    'Load a pretrained model with from_pretrained',
+    'Fine-tune a pretrained model on your dataset',
+    'The pipeline wraps a tokenizer and a model',
+    'Install the library with pip',
+]
+
+
+def test_tokenize():
+    assert tokenize('Load a pretrained Model, from_pretrained!') == ['load', 'a', 'pretrained', 'model', 'from_pretrained']
+
+
+def test_search():
+    index = BM25Index.build(TEXTS)
+
+    results = index.search('pretrained model', k=3)
+
+    assert [doc_id for doc_id, _ in results][:2] == [1, 2]
+    assert [score for _, score in results] == sorted((score for _, score in results), reverse=True)
+    assert index.search('unknown words', k=3) == []
+
+
+def test_search_mask():
+    index = BM25Index.build(TEXTS)
+    mask = np.ones(len(TEXTS), dtype=bool)
+    mask[1] = False
+
+    assert [doc_id for doc_id, _ in index.search('pretrained', k=3, mask=mask)] == [2]
+
+
+def test_rare_terms_score_higher():
+    index = BM25Index.build(TEXTS)
+
+    # "tokenizer" occurs in two documents and "pip" in one
+    assert index.search('pip', k=1)[0][1] > index.search('tokenizer', k=1)[0][1]
+
+
+def test_save_load(tmp_path):
+    index = BM25Index.build(TEXTS)
+    index.save(str(tmp_path / 'bm25.npz'))
+
+    loaded = BM25Index.load(str(tmp_path / 'bm25.npz'))
+
+    assert loaded.search('tokenizer model', k=5) == index.search('tokenizer model', k=5)
+
+
+def test_terms_are_stored_as_utf8(tmp_path):
+    index = BM25Index.build(TEXTS + ['Überblick über die Modelle', 'a' * 200])
+
+    # One byte per ASCII character rather than four per character of the longest term
+    assert index.terms.dtype == np.uint8
+    assert index.terms.nbytes < 400
+    index.save(str(tmp_path / 'bm25.npz'))
+    loaded = BM25Index.load(str(tmp_path / 'bm25.npz'))
+    assert [doc_id for doc_id, _ in loaded.search('überblick', k=1)] == [5]
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([['a', 'b'], ['b', 'c']], k=60)
+
+    assert [item for item, _ in fused] == ['b', 'a', 'c']
+    assert fused[0][1] == pytest.approx(1 / 62 + 1 / 61)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalVectorStore(path=str(tmp_path / 'index'), embedding=FakeEmbeddings(size=16), search_type='hybrid')
+    store.add_texts(TEXTS, metadatas=[{'source': f'{i}.md'} for i in range(len(TEXTS))], ids=[str(i) for i in range(5)])
+    return store
+
+
+def test_hybrid_search(store):
+    docs = store.similarity_search('install with pip', k=2)
+
+    # Fake embeddings are unrelated to the content, so the keyword match is fused to the top
+    assert docs[0].page_content == 'Install the library with pip'
+    assert len(docs) == 2
+
+
+def test_keyword_search_skips_deleted(store):
+    store.delete(['4'])
+
+    assert store.keyword_search_with_score('pip', k=2) == []
+
+
+def test_keyword_index_persisted(store, tmp_path):
+    store.build_keyword_index()
+
+    reopened = LocalVectorStore(path=str(tmp_path / 'index'), embedding=FakeEmbeddings(size=16))
+    assert reopened.keyword_search_with_score('pip', k=1)[0][0].page_content == 'Install the library with pip'
+
+    reopened.add_texts(['Upgrade pip first'], ids=['5'])
+    assert len(reopened.keyword_index) == 6
+
+
+def test_unexpected_search_type(tmp_path):
+    with pytest.raises(ValueError):
+        LocalVectorStore(path=str(tmp_path / 'index'), embedding=FakeEmbeddings(size=16), search_type='mmr')
@@ -0,0 +1,228 @@
+import asyncio
+from typing import List
+
+import numpy as np
+import pytest
+from langchain.schema import ChatMessage
+from langchain.schema.embeddings import Embeddings
+
+from workshop_oai_qa.cache import MemoryCache, SemanticCache, SemanticCacheChain, SqliteCache, normalize_input
+from workshop_oai_qa.chain import AssistantMessage
+from workshop_oai_qa.metrics import MetricsRegistry
+
+WORDS = ['install', 'library', 'pip', 'model', 'load', 'pretrained']
+
+
+class BagOfWordsEmbeddings(Embeddings):
+    """Embeds texts by the known words they contain, so paraphrases get similar vectors."""
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = np.array([word in text.lower() for word in WORDS], dtype=np.float32) + 1e-3
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def embeddings():
+    return BagOfWordsEmbeddings()
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_lookup(embeddings):
+    cache = SemanticCache(threshold=0.95)
+    cache.store('How do I install the library?', embeddings.embed_query('How do I install the library?'), 'A', 2.0)
+
+    assert cache.lookup(embeddings.embed_query('How can the library be installed?')).value == 'A'
+    assert cache.lookup(embeddings.embed_query('How do I load a pretrained model?')) is None
+    assert (cache.hits, cache.misses, cache.hit_rate, cache.seconds_saved) == (1, 1, 0.5, 2.0)
+
+
+def test_lookup_normalizes_vectors(embeddings):
+    cache = SemanticCache(threshold=0.95)
+    cache.store('install', embeddings.embed_query('install'), 'A', 1.0)
+
+    # Only the direction counts: a long vector of another question does not pass the threshold by its length
+    assert cache.lookup((1000 * np.array(embeddings.embed_query('model'))).tolist()) is None
+    assert cache.lookup((0.5 * np.array(embeddings.embed_query('install'))).tolist()).value == 'A'
+
+
+def test_ttl(embeddings, clock):
+    cache = SemanticCache(ttl=10, clock=clock)
+    vector = embeddings.embed_query('install')
+    cache.store('install', vector, 'A', 1.0)
+
+    clock.now = 11
+    assert cache.lookup(vector) is None
+    assert len(cache) == 0
+
+
+def test_lru_eviction(embeddings):
+    cache = SemanticCache(max_entries=2)
+    for word in ('install', 'model', 'pip'):
+        if word == 'pip':
+            # Accessing the oldest entry makes the middle one least recently used
+            assert cache.lookup(embeddings.embed_query('install')).value == 'install'
+        cache.store(word, embeddings.embed_query(word), word, 1.0)
+
+    assert cache.lookup(embeddings.embed_query('model')) is None
+    assert cache.lookup(embeddings.embed_query('install')).value == 'install'
+
+
+def test_version_invalidates(embeddings):
+    versions = iter(['1', '1', '2'])
+    cache = SemanticCache(version=lambda: next(versions))
+    cache.store('install', embeddings.embed_query('install'), 'A', 1.0)
+
+    assert cache.lookup(embeddings.embed_query('install')) is None
+    assert len(cache) == 0
+
+
+@pytest.fixture
+def make_cached_chain(make_chain, library_documents, embeddings):
+    def make(max_history=0, metrics=None):
+        return SemanticCacheChain(
+            chain=make_chain(documents=library_documents, k=1),
+            embeddings=embeddings,
+            cache=SemanticCache(threshold=0.95),
+            max_history=max_history,
+            metrics=metrics,
+        )
+
+    return make
+
+
+def test_chain_answers_paraphrases_from_cache(make_cached_chain):
+    chain = make_cached_chain()
+    history = [ChatMessage(role='assistant', content='How may I help you?')]
+
+    first = chain({'input': 'How do I install the library?', 'history': history, 'callbacks': None})
+    second = chain({'input': 'How can the library be installed?', 'history': history, 'callbacks': None})
+
+    assert chain.chain.llm.calls == 2
+    assert isinstance(second['reply'], AssistantMessage)
+    assert second['reply'] == first['reply']
+    assert second['citations'][0].metadata['source'] == 'installation.md'
+    assert second['follow_ups'] == first['follow_ups']
+    assert chain.cache.hits == 1
+
+
+def test_chain_records_cache_metrics(make_cached_chain):
+    metrics = MetricsRegistry()
+    chain = make_cached_chain(metrics=metrics)
+
+    for question in ['How do I install the library?', 'How can the library be installed?', 'How to load a model?']:
+        chain({'input': question, 'history': [], 'callbacks': None})
+
+    assert metrics.counter('cache_hits_total', cache='semantic') == 1
+    assert metrics.counter('cache_misses_total', cache='semantic') == 2
+    assert metrics.counter('cache_seconds_saved_total', cache='semantic') == chain.cache.seconds_saved > 0
+
+
+def test_chain_skips_long_history(make_cached_chain):
+    chain = make_cached_chain()
+    history = [ChatMessage(role='user', content='Hi'), ChatMessage(role='assistant', content='Hello')]
+
+    chain({'input': 'How do I install the library?', 'history': history, 'callbacks': None})
+    chain({'input': 'How do I install the library?', 'history': history, 'callbacks': None})
+
+    assert chain.chain.llm.calls == 4
+    assert len(chain.cache) == 0
+
+
+def test_async_chain(make_cached_chain):
+    chain = make_cached_chain()
+
+    async def run():
+        for _ in range(2):
+            outputs = await chain.acall({'input': 'How do I install the library?', 'history': [], 'callbacks': None})
+        return outputs
+
+    assert asyncio.run(run())['citations'][0].metadata['source'] == 'installation.md'
+    assert chain.chain.llm.calls == 2
+
+
+def test_normalize_input():
+    assert normalize_input('  How do I  install\nthe library?? ') == 'how do i install the library'
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_cache(request, tmp_path, clock):
+    def make(**kwargs):
+        if request.param == 'memory':
+            return MemoryCache(clock=clock, **kwargs)
+        return SqliteCache(str(tmp_path / 'cache.sqlite'), namespace='test', clock=clock, **kwargs)
+    return make
+
+
+def test_exact_cache(make_cache, clock):
+    cache = make_cache(ttl=10, max_entries=2)
+    cache.set('a', 'query a')
+    clock.now = 1
+    cache.set('b', ['documents', {'source': 'b.md'}])
+
+    assert cache.get('a') == 'query a'
+    assert cache.get('b') == ['documents', {'source': 'b.md'}]
+    assert cache.get('c') is None
+    assert cache.hit_rate == pytest.approx(2 / 3)
+
+    # Reading a refreshes it, so b is least recently used
+    clock.now = 2
+    cache.get('a')
+    clock.now = 3
+    cache.set('c', 'query c')
+    assert cache.get('b') is None
+    assert len(cache) == 2
+
+    clock.now = 12
+    assert cache.get('c') == 'query c'
+    assert cache.get('a') is None
+
+
+def test_sqlite_cache_shared(tmp_path):
+    SqliteCache(str(tmp_path / 'cache.sqlite'), namespace='queries').set('a', 'query a')
+
+    assert SqliteCache(str(tmp_path / 'cache.sqlite'), namespace='queries').get('a') == 'query a'
+    assert SqliteCache(str(tmp_path / 'cache.sqlite'), namespace='retrieval').get('a') is None
+
+
+def test_chain_query_and_retrieval_cache(tmp_path, make_chain, library_documents):
+    version = ['1']
+    chain = make_chain(
+        documents=library_documents,
+        k=1,
+        query_cache=MemoryCache(),
+        retrieval_cache=SqliteCache(str(tmp_path / 'cache.sqlite'), namespace='retrieval'),
+        index_version=lambda: version[0],
+        metrics=MetricsRegistry(),
+    )
+
+    first = chain.retrieve('How do I install the library?')
+    second = chain.retrieve('how do I install the library')
+
+    assert second == first
+    assert second[1][0].metadata == {'source': 'installation.md'}
+    assert chain.llm.calls == 1
+    assert chain.retriever.vectorstore.searches == 1
+    assert (chain.query_cache.hit_rate, chain.retrieval_cache.hit_rate) == (0.5, 0.5)
+    assert chain.metrics.counter('cache_hits_total', cache='queries') == 1
+    assert chain.metrics.counter('cache_misses_total', cache='retrieval') == 1
+
+    # Reindexing invalidates retrieved documents, but not generated queries
+    version[0] = '2'
+    chain.retrieve('How do I install the library?')
+    assert chain.llm.calls == 1
+    assert chain.retriever.vectorstore.searches == 2
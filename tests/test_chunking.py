@@ -0,0 +1,72 @@
+from workshop_oai_qa.indexing.chunking import MarkdownChunker, split_blocks
+
+TEXT = """<!--Copyright 2022 The HuggingFace Team.
+
+Licensed under the Apache License.
+-->
+
+# Accelerate
+
+Intro paragraph.
+
+## Setup
+
+Install it:
+
+```bash
+# not a heading
+pip install accelerate
+```
+
+### Details
+
+More text.
+
+## Train
+
+Training text.
+"""
+
+
+def words(text):
+    return len(text.split())
+
+
+def test_split_blocks():
+    blocks = split_blocks(TEXT)
+
+    assert [block.headings for block in blocks] == [
+        ('Accelerate',),
+        ('Accelerate', 'Setup'),
+        ('Accelerate', 'Setup'),
+        ('Accelerate', 'Setup', 'Details'),
+        ('Accelerate', 'Train'),
+    ]
+    # License comment is dropped, code blocks are kept whole
+    assert 'Copyright' not in ''.join(block.text for block in blocks)
+    assert blocks[2].text.startswith('```bash\n# not a heading')
+    # Offsets point into the original text
+    for block in blocks:
+        assert TEXT[block.start:block.start + len(block.text)] == block.text
+
+
+def test_chunker_packs_sections():
+    chunks = MarkdownChunker(chunk_size=12, length_function=words).split_text(TEXT, metadata={'source': 'a.md'})
+
+    assert all(chunk.metadata['tokens'] <= 12 for chunk in chunks)
+    assert chunks[0].metadata == {'source': 'a.md', 'start_index': TEXT.index('# Accelerate'),
+                                  'headings': 'Accelerate', 'tokens': 8}
+    assert chunks[1].page_content.startswith('```bash')
+    assert chunks[-1].metadata['headings'] == 'Accelerate > Setup > Details'
+    assert 'Training text.' in chunks[-1].page_content
+
+
+def test_chunker_splits_oversized_blocks():
+    text = '# Title\n\n' + ''.join(f'line {i} with some words\n' for i in range(20))
+    chunks = MarkdownChunker(chunk_size=20, length_function=words).split_text(text)
+
+    assert len(chunks) > 1
+    assert all(chunk.metadata['tokens'] <= 20 for chunk in chunks)
+    assert ''.join(chunk.page_content for chunk in chunks).count('line') == 20
+    for chunk in chunks:
+        assert text[chunk.metadata['start_index']:].startswith(chunk.page_content[:10])
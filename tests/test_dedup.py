@@ -0,0 +1,94 @@
+from langchain.schema import Document
+
+from workshop_oai_qa.fakes import fake_num_tokens
+from workshop_oai_qa.indexing.dedup import MinHashDeduplicator, shingles
+from workshop_oai_qa.indexing.manifest import chunk_hash, diff_chunks, open_manifest
+from workshop_oai_qa.indexing.pipeline import SourceChanges
+
+INSTALL = ' '.join(f'word{i}' for i in range(200))
+
+
+def source_changes(source, *texts, tokens=True):
+    chunks = [Document(page_content=text, metadata={'source': source}) for text in texts]
+    if tokens:
+        for chunk in chunks:
+            chunk.metadata['tokens'] = len(chunk.page_content.split())
+    return SourceChanges(source=source, file_hash=source, changes=diff_chunks({}, source, chunks))
+
+
+def test_shingles():
+    assert len(shingles('a b c d e f', size=5)) == 2
+    assert len(shingles('a b', size=5)) == 1
+
+
+def test_similarity_threshold():
+    deduplicator = MinHashDeduplicator(threshold=0.8)
+    deduplicator.filter(source_changes('a.md', INSTALL))
+
+    near = INSTALL.replace('word100', 'changed')
+    assert deduplicator.find(near)[0] is not None
+    assert deduplicator.find(' '.join(f'other{i}' for i in range(200)))[0] is None
+
+
+def test_filter_keeps_canonical_chunk():
+    deduplicator = MinHashDeduplicator(threshold=0.8)
+
+    first = deduplicator.filter(source_changes('a.md', INSTALL, 'unique to a'))
+    second = deduplicator.filter(source_changes('b.md', INSTALL.replace('word100', 'changed'), 'unique to b'))
+    third = deduplicator.filter(source_changes('c.md', INSTALL))
+
+    assert len(first.changes.added) == 2
+    assert [doc.page_content for doc in second.changes.added] == ['unique to b']
+    assert third.changes.added == []
+    # Duplicates are not recorded as chunks of their own source
+    assert third.changes.chunks == {}
+
+    canonical = first.changes.added_ids[0]
+    assert deduplicator.updated_ids == {canonical}
+    assert deduplicator.metadata(canonical)['duplicates'] == ['b.md', 'c.md']
+    assert first.changes.added[0].metadata['duplicates'] == ['b.md', 'c.md']
+    assert deduplicator.duplicates == 2
+    assert deduplicator.tokens_avoided == 400
+
+
+def test_tokens_avoided_without_token_metadata():
+    deduplicator = MinHashDeduplicator(threshold=0.8, length_function=fake_num_tokens)
+
+    deduplicator.filter(source_changes('a.md', INSTALL, tokens=False))
+    deduplicator.filter(source_changes('b.md', INSTALL, tokens=False))
+
+    assert deduplicator.tokens_avoided == fake_num_tokens(INSTALL) > 0
+
+
+def test_incremental_runs(tmp_path):
+    near = INSTALL.replace('word100', 'changed')
+
+    def index(deduplicator, manifest, source, *texts):
+        chunks = [Document(page_content=text, metadata={'source': source}) for text in texts]
+        changes = deduplicator.filter(SourceChanges(
+            source=source, file_hash=source, changes=diff_chunks(manifest.chunks(source), source, chunks)
+        ))
+        manifest.update(source, source, changes.changes.chunks, duplicates=deduplicator.duplicate_chunks(source),
+                        signatures=deduplicator.signatures(changes.changes.added_ids))
+        return changes.changes
+
+    with open_manifest(str(tmp_path / 'manifest.sqlite')) as manifest:
+        deduplicator = MinHashDeduplicator(threshold=0.8, length_function=fake_num_tokens)
+        canonical = index(deduplicator, manifest, 'a.md', INSTALL, 'unique to a').added_ids[0]
+        assert index(deduplicator, manifest, 'b.md', near).added == []
+
+        # A later run compares new chunks against the chunks of unchanged files
+        deduplicator = MinHashDeduplicator(threshold=0.8, length_function=fake_num_tokens)
+        deduplicator.seed(manifest)
+        assert index(deduplicator, manifest, 'c.md', INSTALL).added == []
+        assert manifest.duplicates('c.md') == {chunk_hash(INSTALL, {'source': 'c.md'}): canonical}
+
+        # Deleting the canonical chunk orphans its duplicates, which are indexed once their files are reindexed
+        changes = index(deduplicator, manifest, 'a.md', 'unique to a')
+        assert changes.deleted_ids == [canonical]
+        assert deduplicator.orphaned == {'b.md', 'c.md'}
+
+        assert [doc.page_content for doc in index(deduplicator, manifest, 'b.md', near).added] == [near]
+        assert index(deduplicator, manifest, 'c.md', INSTALL).added == []
+        assert deduplicator.orphaned == set()
+        assert set(manifest.duplicates('c.md').values()) == set(manifest.chunks('b.md').values())
@@ -0,0 +1,174 @@
+import time
+from typing import List
+
+import numpy as np
+import openai
+from langchain.schema.embeddings import Embeddings
+
+from workshop_oai_qa.embeddings import BatchEmbedder, CachedEmbeddings
+from workshop_oai_qa.fakes import FakeEmbeddings, FakeEmbeddingsServer
+from workshop_oai_qa.ratelimit import RateLimiter, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class EndpointEmbeddings(Embeddings):
+    """Embeds with the OpenAI client against a local endpoint, as `OpenAIEmbeddings` needs tiktoken encodings."""
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        response = openai.Embedding.create(
+            input=texts, model='text-embedding-ada-002', api_base=self.url, api_key='test', api_type='open_ai',
+            api_version=None, request_timeout=5,
+        )
+        return [item['embedding'] for item in sorted(response['data'], key=lambda item: item['index'])]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(60, period=60, clock=clock, sleep=clock.sleep)
+
+    assert bucket.try_acquire(60) == 0
+    assert bucket.try_acquire(1) == 1.0
+
+    bucket.acquire(30)
+    assert clock.now == 30.0
+
+    # Requests larger than the capacity are clamped instead of waiting forever
+    bucket.acquire(1000)
+    assert clock.now == 90.0
+
+
+def test_rate_limiter_pause():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=600, clock=clock, sleep=clock.sleep)
+
+    limiter.pause(5)
+    limiter.acquire()
+    # The quota is not drained, so the request is admitted right after the pause
+    assert clock.now == 5.0
+
+
+def test_batch_embedder_order():
+    embeddings = FakeEmbeddings(size=8)
+    embedder = BatchEmbedder(embeddings, batch_size=3, max_workers=4, length_function=len)
+
+    texts = [f'chunk {i}' for i in range(10)]
+    vectors = embedder.embed_documents(texts)
+
+    assert vectors == [embeddings.vector(text) for text in texts]
+    assert embeddings.requests == 4
+    assert embedder.stats.chunks == 10
+    assert embedder.stats.tokens == sum(map(len, texts))
+
+
+def test_batch_embedder_rate_limited():
+    embeddings = FakeEmbeddings(size=8, rate_limit_every=3, retry_after=0.01)
+    embedder = BatchEmbedder(embeddings, batch_size=2, max_workers=4, length_function=len)
+
+    texts = [f'chunk {i}' for i in range(20)]
+    vectors = embedder.embed_documents(texts)
+
+    assert vectors == [embeddings.vector(text) for text in texts]
+    assert embeddings.rate_limited > 0
+    assert embedder.stats.retries == embeddings.rate_limited
+    assert embedder.stats.chunks == 20
+
+
+def test_batch_embedder_against_rate_limited_endpoint():
+    embeddings = FakeEmbeddings(size=8, rate_limit_every=2, retry_after=0.2)
+    texts = [f'chunk {i}' for i in range(4)]
+
+    with FakeEmbeddingsServer(embeddings) as server:
+        embedder = BatchEmbedder(EndpointEmbeddings(server.url), batch_size=2, max_workers=1, length_function=len)
+        start = time.monotonic()
+        vectors = embedder.embed_documents(texts)
+        elapsed = time.monotonic() - start
+
+    assert np.allclose(vectors, [embeddings.vector(text) for text in texts])
+    assert embeddings.rate_limited == embedder.stats.retries == 1
+    # Backed off for the Retry-After of the 429 response
+    assert 0.2 <= elapsed < 1.0
+
+
+def test_batch_embedder_concurrency():
+    embeddings = FakeEmbeddings(size=8, latency=0.05)
+    texts = [f'chunk {i}' for i in range(16)]
+
+    start = time.monotonic()
+    BatchEmbedder(embeddings, batch_size=2, max_workers=8, length_function=len).embed_documents(texts)
+    elapsed = time.monotonic() - start
+
+    # Eight batches of 50ms each run in parallel rather than taking 400ms
+    assert elapsed < 0.3
+
+
+def test_cached_embeddings(tmp_path):
+    embeddings = FakeEmbeddings(size=8)
+    cache = CachedEmbeddings(embeddings, path=str(tmp_path / 'cache.sqlite'), namespace='fake')
+
+    vectors = cache.embed_documents(['a', 'b', 'a'])
+    assert embeddings.texts == 2
+    assert cache.misses == 2 and cache.hits == 1
+    assert np.allclose(vectors[0], embeddings.vector('a'))
+
+    # Vectors persist across instances and are shared with query embedding
+    cache = CachedEmbeddings(embeddings, path=str(tmp_path / 'cache.sqlite'), namespace='fake')
+    assert np.allclose(cache.embed_query('b'), embeddings.vector('b'))
+    assert cache.hits == 1 and embeddings.texts == 2
+
+    # Vectors of another model or deployment are not reused
+    other = CachedEmbeddings(embeddings, path=str(tmp_path / 'cache.sqlite'), namespace='other')
+    other.embed_query('b')
+    assert other.misses == 1 and embeddings.texts == 3
+
+
+def test_cached_embeddings_eviction(tmp_path):
+    embeddings = FakeEmbeddings(size=8)
+    # Room for three float32 vectors of size 8
+    cache = CachedEmbeddings(embeddings, path=str(tmp_path / 'cache.sqlite'), namespace='fake', max_bytes=3 * 32)
+
+    cache.embed_query('a')
+    cache.embed_query('b')
+    cache.embed_query('c')
+    cache.embed_query('a')
+    cache.embed_query('d')
+
+    # The least recently used vector was evicted
+    cache.embed_query('a')
+    assert cache.hits == 2
+    cache.embed_query('b')
+    assert cache.misses == 5
+
+
+
+def test_cached_embeddings_size(tmp_path):
+    embeddings = FakeEmbeddings(size=8)
+    cache = CachedEmbeddings(embeddings, path=str(tmp_path / 'cache.sqlite'), namespace='fake', max_bytes=3 * 32)
+    other = CachedEmbeddings(embeddings, path=str(tmp_path / 'cache.sqlite'), namespace='fake', max_bytes=3 * 32)
+
+    cache.embed_documents(['a', 'b'])
+    # Replacing a stored vector does not count its size twice
+    cache._put({cache.key('a'): embeddings.vector('a')})
+    assert cache.size == 2 * 32
+
+    # Processes sharing the file agree on the size, so the limit holds across them
+    other.embed_query('c')
+    assert cache.size == other.size == 3 * 32
+    other.embed_query('d')
+    assert cache._conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0] < 4
+    assert cache.size == cache._conn.execute('SELECT SUM(LENGTH(vector)) FROM embeddings').fetchone()[0]
@@ -0,0 +1,81 @@
+import asyncio
+
+from langchain.schema import ChatMessage
+
+from workshop_oai_qa.fakes import FakeChatModel, fake_num_tokens
+from workshop_oai_qa.history import HistoryCompactor, HistorySummary
+from workshop_oai_qa.ratelimit import RateLimiter
+from workshop_oai_qa.scheduler import Scheduler
+
+
+def conversation(turns: int):
+    messages = []
+    for i in range(turns):
+        messages.append(ChatMessage(role='user', content=f'question {i}'))
+        messages.append(ChatMessage(role='assistant', content=f'answer {i}'))
+    return messages
+
+
+def test_short_history_is_kept():
+    compactor = HistoryCompactor(FakeChatModel(), keep_turns=2, summarize_every=2)
+    history = conversation(3)
+
+    compacted, state = compactor.compact(history)
+
+    assert compacted == history
+    assert state == HistorySummary()
+    assert compactor.llm.calls == 0
+
+
+def test_older_turns_are_summarized_incrementally():
+    compactor = HistoryCompactor(FakeChatModel(), keep_turns=2, summarize_every=2)
+    state = None
+    lengths = []
+    for turns in range(1, 11):
+        compacted, state = compactor.compact(conversation(turns), state)
+        lengths.append(len(compacted))
+
+    # Summarized once per two turns, after the first four turns
+    assert compactor.summaries == 4
+    assert state.messages == 16
+    assert compacted[0].role == 'system' and 'question 7' in compacted[0].content
+    assert compacted[1:] == conversation(10)[16:]
+    assert max(lengths) <= 1 + 2 * (2 + 2)
+
+
+def test_summary_is_not_recomputed():
+    compactor = HistoryCompactor(FakeChatModel(), keep_turns=1, summarize_every=1)
+    _, state = compactor.compact(conversation(3))
+
+    compacted, same = compactor.compact(conversation(3), state)
+
+    assert same == state
+    assert compactor.summaries == 1
+
+
+def test_new_conversation_resets_summary():
+    compactor = HistoryCompactor(FakeChatModel(), keep_turns=1, summarize_every=1)
+    _, state = compactor.compact(conversation(5))
+
+    compacted, state = compactor.compact(conversation(1), state)
+
+    assert compacted == conversation(1)
+    assert state == HistorySummary()
+
+
+def test_acompact():
+    compactor = HistoryCompactor(FakeChatModel(), keep_turns=1, summarize_every=1)
+
+    assert asyncio.run(compactor.acompact(conversation(4))) == \
+        HistoryCompactor(FakeChatModel(), keep_turns=1, summarize_every=1).compact(conversation(4))
+
+
+def test_summaries_are_admitted_by_scheduler():
+    scheduler = Scheduler(RateLimiter(requests_per_minute=60))
+    compactor = HistoryCompactor(FakeChatModel(), keep_turns=2, summarize_every=2, scheduler=scheduler,
+                                 length_function=fake_num_tokens)
+
+    compactor.compact(conversation(6))
+    asyncio.run(compactor.acompact(conversation(6)))
+
+    assert compactor.summaries == scheduler.admitted == 2
@@ -0,0 +1,99 @@
+import pytest
+from langchain.schema import Document
+
+from workshop_oai_qa.indexing.manifest import (
+    JsonManifest,
+    SqliteManifest,
+    chunk_hash,
+    diff_chunks,
+    file_hash,
+    open_manifest,
+)
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def manifest_path(request, tmp_path):
+    return str(tmp_path / f'manifest.{request.param}')
+
+
+def chunks(*texts):
+    return [Document(page_content=text, metadata={'source': 'doc.md'}) for text in texts]
+
+
+def test_open_manifest(tmp_path):
+    assert isinstance(open_manifest(str(tmp_path / 'manifest.json')), JsonManifest)
+    assert isinstance(open_manifest(str(tmp_path / 'manifest.sqlite')), SqliteManifest)
+
+
+def test_file_hash(tmp_path):
+    path = tmp_path / 'doc.md'
+    path.write_text('# Hello')
+    first = file_hash(str(path))
+
+    path.write_text('# Hello world')
+    assert file_hash(str(path)) != first
+
+    # Chunking settings are part of the hash
+    assert file_hash(str(path), 'markdown:1000') != file_hash(str(path), 'unstructured:1000')
+
+
+def test_manifest_roundtrip(manifest_path):
+    with open_manifest(manifest_path) as manifest:
+        manifest.update('a.md', 'hash-a', {'c1': 'id1', 'c2': 'id2'})
+        manifest.update('b.md', 'hash-b', {'c3': 'id3'})
+        manifest.update('b.md', 'hash-b2', {'c4': 'id4'})
+        manifest.remove('a.md')
+
+    with open_manifest(manifest_path) as manifest:
+        assert manifest.sources() == ['b.md']
+        assert manifest.file_hash('a.md') is None
+        assert manifest.file_hash('b.md') == 'hash-b2'
+        assert manifest.chunks('b.md') == {'c4': 'id4'}
+
+
+
+def test_manifest_deduplication_state(manifest_path):
+    with open_manifest(manifest_path) as manifest:
+        manifest.update('a.md', 'v1', {'c1': 'id1', 'c2': 'id2'}, duplicates={'c3': 'id9'},
+                        signatures={'id1': b'\x01', 'id2': b'\x02'})
+        assert manifest.duplicates('a.md') == {'c3': 'id9'}
+
+        # Signatures of chunks that are still recorded are kept
+        manifest.update('a.md', 'v2', {'c1': 'id1', 'c4': 'id4'}, signatures={'id4': b'\x04'})
+
+    with open_manifest(manifest_path) as manifest:
+        assert manifest.signatures('a.md') == {'id1': b'\x01', 'id4': b'\x04'}
+        assert manifest.duplicates('a.md') == {}
+        manifest.remove('a.md')
+        assert manifest.signatures('a.md') == {}
+
+def test_diff_chunks(manifest_path):
+    with open_manifest(manifest_path) as manifest:
+        changes = diff_chunks(manifest.chunks('doc.md'), 'doc.md', chunks('one', 'two', 'two'))
+        assert [doc.page_content for doc in changes.added] == ['one', 'two']
+        assert changes.deleted_ids == []
+        manifest.update('doc.md', 'v1', changes.chunks)
+
+        # Only the changed chunk is re-indexed and the removed one is deleted under its original ID
+        changes = diff_chunks(manifest.chunks('doc.md'), 'doc.md', chunks('one', 'three'))
+        assert [doc.page_content for doc in changes.added] == ['three']
+        one, two = (chunk_hash(text, {'source': 'doc.md'}) for text in ('one', 'two'))
+        assert changes.deleted_ids == [manifest.chunks('doc.md')[two]]
+        assert changes.chunks[one] == manifest.chunks('doc.md')[one]
+
+
+def test_changed_metadata_is_reindexed():
+    previous = diff_chunks({}, 'doc.md', chunks('one', 'two')).chunks
+    documents = chunks('one', 'two')
+    documents[1].metadata['headings'] = 'Installation'
+
+    changes = diff_chunks(previous, 'doc.md', documents)
+
+    assert changes.added == [documents[1]]
+    assert changes.deleted_ids == [previous[chunk_hash('two', {'source': 'doc.md'})]]
+
+
+def test_document_ids_differ_per_source():
+    a = diff_chunks({}, 'a.md', chunks('same'))
+    b = diff_chunks({}, 'b.md', chunks('same'))
+    assert a.added_ids != b.added_ids
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import time
+
+import pytest
+from langchain.schema.messages import AIMessageChunk
+from langchain.schema.output import ChatGenerationChunk
+
+from workshop_oai_qa.fakes import FakeChatModel, FakeEmbeddings, fake_num_tokens
+from workshop_oai_qa.metrics import JsonLinesExporter, MetricsRegistry, PrometheusExporter, TimedEmbeddings
+
+STAGES = ['query_generation', 'retrieval', 'prompt_assembly', 'answer_generation', 'turn']
+
+
+class Clock:
+    def __init__(self, step: float = 1.):
+        self.time = 0.
+        self.step = step
+
+    def __call__(self) -> float:
+        self.time += self.step
+        return self.time
+
+
+def test_histogram_percentiles():
+    metrics = MetricsRegistry()
+    for value in range(1, 101):
+        metrics.observe('latency', value, stage='a')
+
+    histogram = metrics.histogram('latency', stage='a')
+    assert histogram.count == 100
+    assert histogram.sum == 5050
+    assert histogram.percentile(0.5) == pytest.approx(50.5)
+    assert histogram.percentile(0.99) == pytest.approx(99.01)
+    assert metrics.histogram('latency', stage='b') is None
+
+
+def test_histogram_keeps_latest_samples():
+    metrics = MetricsRegistry(max_samples=10)
+    for value in range(100):
+        metrics.observe('latency', value)
+
+    histogram = metrics.histogram('latency')
+    assert histogram.count == 100
+    assert histogram.percentile(0) == 90
+
+
+def test_span():
+    metrics = MetricsRegistry(clock=Clock())
+
+    with metrics.span('answer_generation') as span:
+        span.token()
+        span.token()
+        span.record_completion(10)
+
+    assert metrics.histogram('stage_seconds', stage='answer_generation').sum == 3
+    assert metrics.histogram('time_to_first_token_seconds', stage='answer_generation').sum == 1
+    assert metrics.histogram('tokens_per_second', stage='answer_generation').sum == 10 / 1
+
+
+def test_failed_span_counts_error():
+    metrics = MetricsRegistry()
+
+    with pytest.raises(ValueError):
+        with metrics.span('retrieval'):
+            raise ValueError()
+
+    assert metrics.counter('stage_errors_total', stage='retrieval') == 1
+    assert metrics.histogram('stage_seconds', stage='retrieval') is None
+
+
+def test_chain_records_stages(make_chain):
+    metrics = MetricsRegistry()
+    chain = make_chain(metrics=metrics)
+
+    outputs = chain({'input': 'What about transformers?', 'history': [], 'callbacks': None})
+
+    for stage in STAGES:
+        assert metrics.histogram('stage_seconds', stage=stage).count == 1
+    assert metrics.histogram('documents', stage='retrieval').sum == 3
+    assert metrics.histogram('prompt_tokens', stage='prompt_assembly').sum == outputs['prompt_tokens']
+    assert metrics.histogram('prompt_tokens', stage='query_generation').sum > 0
+    assert metrics.histogram('completion_tokens', stage='answer_generation').sum > 0
+    assert metrics.histogram('time_to_first_token_seconds', stage='answer_generation').count == 1
+
+
+def test_async_chain_records_stages(make_chain):
+    metrics = MetricsRegistry()
+    chain = make_chain(metrics=metrics)
+
+    asyncio.run(chain.acall({'input': 'What about transformers?', 'history': [], 'callbacks': None}))
+
+    for stage in STAGES:
+        assert metrics.histogram('stage_seconds', stage=stage).count == 1
+
+
+class DelayedChatModel(FakeChatModel):
+    """Streams an empty delta and, a moment later, the whole answer in one chunk."""
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        yield ChatGenerationChunk(message=AIMessageChunk(content=''))
+        time.sleep(0.05)
+        yield ChatGenerationChunk(message=AIMessageChunk(content=self.respond(messages)))
+
+
+def test_chain_counts_completion_tokens(make_chain):
+    metrics = MetricsRegistry()
+    chain = make_chain(metrics=metrics)
+    chain.llm = DelayedChatModel()
+
+    outputs = chain({'input': 'What about transformers?', 'history': [], 'callbacks': None})
+
+    # Tokens are counted in the answer rather than by chunk, and the first token is the first text
+    completion_tokens = metrics.histogram('completion_tokens', stage='answer_generation').sum
+    assert completion_tokens == fake_num_tokens(outputs['response'].content) > 2
+    assert metrics.histogram('time_to_first_token_seconds', stage='answer_generation').sum >= 0.05
+
+
+def test_timed_embeddings():
+    metrics = MetricsRegistry()
+    embeddings = TimedEmbeddings(FakeEmbeddings(), metrics)
+
+    embeddings.embed_query('text')
+    embeddings.embed_documents(['a', 'b'])
+
+    assert metrics.histogram('stage_seconds', stage='embedding').count == 2
+
+
+def test_prometheus_exporter(tmp_path):
+    metrics = MetricsRegistry(exporter=PrometheusExporter(str(tmp_path / 'metrics.prom')))
+    metrics.observe('stage_seconds', 0.5, stage='retrieval')
+    metrics.increment('stage_errors_total', stage='say "hi"')
+
+    metrics.export()
+
+    text = (tmp_path / 'metrics.prom').read_text()
+    assert text == PrometheusExporter().render(metrics)
+    assert '# TYPE qa_stage_errors_total counter\nqa_stage_errors_total{stage="say \\"hi\\""} 1\n' in text
+    assert '# TYPE qa_stage_seconds summary\n' in text
+    assert 'qa_stage_seconds{stage="retrieval",quantile="0.99"} 0.5\n' in text
+    assert 'qa_stage_seconds_count{stage="retrieval"} 1\n' in text
+
+
+def test_json_lines_exporter(tmp_path):
+    path = tmp_path / 'metrics.jsonl'
+    metrics = MetricsRegistry(exporter=JsonLinesExporter(str(path), clock=lambda: 1.))
+    metrics.observe('stage_seconds', 2., stage='turn')
+
+    metrics.export()
+    metrics.export()
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(lines) == 2
+    assert lines[0]['time'] == 1.
+    assert lines[0]['histograms'] == [
+        {'name': 'stage_seconds', 'labels': {'stage': 'turn'}, 'count': 1, 'sum': 2., 'p50': 2., 'p90': 2., 'p99': 2.}
+    ]
@@ -0,0 +1,145 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import pytest
+from langchain.schema import Document
+
+from workshop_oai_qa.fakes import FakeEmbeddings
+from workshop_oai_qa.indexing.loading import ParseTimes
+from workshop_oai_qa.indexing.manifest import diff_chunks
+from workshop_oai_qa.indexing.pipeline import SourceChanges, batched, buffered, index_documents, ordered_map
+from workshop_oai_qa.indexing.writers import IndexWriter
+
+
+class MemoryWriter(IndexWriter):
+    def __init__(self):
+        self.documents = {}
+        self.uploads = []
+
+    def add(self, documents, ids, vectors):
+        self.uploads.append(list(ids))
+        self.documents.update(zip(ids, documents))
+
+    def delete(self, ids):
+        for id in ids:
+            self.documents.pop(id, None)
+
+    def update_metadata(self, metadatas):
+        for id, metadata in metadatas.items():
+            self.documents[id].metadata = metadata
+
+
+def source_changes(source, count, previous=None):
+    chunks = [Document(page_content=f'{source} chunk {i}', metadata={'source': source}) for i in range(count)]
+    return SourceChanges(source=source, file_hash=source, changes=diff_chunks(previous or {}, source, chunks))
+
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_buffered_is_bounded():
+    produced = []
+
+    def produce():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    items = buffered(produce(), maxsize=2)
+    assert next(items) == 0
+    time.sleep(0.1)
+    # The producer runs ahead of the consumer by at most the buffer size (plus the item it is putting)
+    assert len(produced) <= 4
+    assert list(items) == list(range(1, 100))
+
+
+def test_buffered_propagates_errors():
+    def produce():
+        yield 1
+        raise ValueError('broken document')
+
+    with pytest.raises(ValueError):
+        list(buffered(produce()))
+
+
+def test_index_documents():
+    writer = MemoryWriter()
+    indexed = []
+    sources = [source_changes('a.md', 5), source_changes('b.md', 0), source_changes('c.md', 3)]
+
+    stats = index_documents(
+        iter(sources), FakeEmbeddings(size=8), writer, batch_size=2, max_in_flight=2,
+        on_source_indexed=lambda source: indexed.append(source.source),
+    )
+
+    assert len(writer.documents) == 8
+    assert stats.chunks == 8 and stats.batches == 4
+    assert sorted(indexed) == ['a.md', 'b.md', 'c.md']
+    # Upload batches keep the order of the chunks
+    assert [id for ids in writer.uploads for id in ids] == sources[0].changes.added_ids + sources[2].changes.added_ids
+
+
+def test_index_documents_streams():
+    writer = MemoryWriter()
+    first_upload = threading.Event()
+
+    def sources():
+        yield source_changes('a.md', 4)
+        # Chunks of the first source are uploaded before the next source is produced
+        assert first_upload.wait(timeout=1)
+        yield source_changes('b.md', 4)
+
+    original_add = writer.add
+
+    def add(documents, ids, vectors):
+        original_add(documents, ids, vectors)
+        first_upload.set()
+
+    writer.add = add
+    index_documents(buffered(sources()), FakeEmbeddings(size=8), writer, batch_size=2, max_in_flight=1)
+    assert len(writer.documents) == 8
+
+
+def test_index_documents_crash_keeps_progress():
+    class FailingEmbeddings(FakeEmbeddings):
+        def embed_documents(self, texts):
+            if any(text.startswith('b.md') for text in texts):
+                raise RuntimeError('embedding service down')
+            return super().embed_documents(texts)
+
+    writer = MemoryWriter()
+    indexed = []
+    with pytest.raises(RuntimeError):
+        index_documents(
+            iter([source_changes('a.md', 2), source_changes('b.md', 2)]), FailingEmbeddings(size=8), writer,
+            batch_size=2, max_in_flight=1, on_source_indexed=lambda source: indexed.append(source.source),
+        )
+
+    assert indexed == ['a.md']
+    assert len(writer.documents) == 2
+
+
+def test_ordered_map_keeps_order():
+    def slow_reverse(i):
+        time.sleep(0.01 * (5 - i))
+        return i
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        assert list(ordered_map(slow_reverse, range(5), executor=executor, max_pending=5)) == list(range(5))
+
+
+def test_ordered_map_processes():
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert list(ordered_map(abs, range(0, -20, -1), executor=executor, max_pending=4)) == list(range(20))
+
+
+def test_parse_times():
+    parse_times = ParseTimes()
+    parse_times.record('fast.md', 0.005)
+    parse_times.record('medium.md', 0.2)
+    parse_times.record('slow.md', 12.0)
+
+    assert parse_times.histogram() == [1, 0, 0, 1, 0, 0, 0, 1]
+    assert parse_times.slowest(1) == [('slow.md', 12.0)]
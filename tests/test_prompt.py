@@ -0,0 +1,73 @@
+from langchain.schema import ChatMessage, Document
+
+from workshop_oai_qa.fakes import fake_num_tokens
+from workshop_oai_qa.prompts.retrieval_qa import RetrievalQAPrompt
+
+DOCUMENTS = [
+    Document(page_content=' '.join(['word'] * 50), metadata={'source': f'{i}.md'}) for i in range(4)
+]
+
+HISTORY = [
+    ChatMessage(role='user' if i % 2 else 'assistant', content=f'message {i} ' + ' '.join(['word'] * 20))
+    for i in range(6)
+]
+
+
+def make_prompt(max_tokens=None) -> RetrievalQAPrompt:
+    return RetrievalQAPrompt(max_tokens=max_tokens, length_function=fake_num_tokens)
+
+
+def test_unlimited():
+    prompt = make_prompt()
+
+    assembly = prompt.assemble('How do I install the library?', HISTORY, DOCUMENTS)
+
+    assert assembly.documents == DOCUMENTS
+    assert assembly.history == HISTORY
+    assert assembly.messages == prompt.format_messages('How do I install the library?', HISTORY, DOCUMENTS)
+    assert assembly.messages[-1].content.startswith('How do I install the library?\nSources:\n0.md: word')
+
+
+def test_token_count_matches_messages():
+    prompt = make_prompt()
+
+    assembly = prompt.assemble('How do I install the library?', HISTORY, DOCUMENTS)
+
+    # Each message adds 3 tokens, the reply another 3, and joining documents adds a newline token each
+    content_tokens = sum(fake_num_tokens(message.content) for message in assembly.messages)
+    assert assembly.tokens == content_tokens + 3 * len(assembly.messages) + 3 + len(DOCUMENTS)
+
+
+def test_budget_prefers_documents_over_history():
+    unlimited = make_prompt().assemble('question', HISTORY, DOCUMENTS)
+    document_tokens = make_prompt().document_tokens(DOCUMENTS[0])
+    history_tokens = make_prompt().message_tokens(HISTORY[-1])
+
+    # Room for all documents and the two most recent history messages
+    budget = unlimited.tokens - sum(make_prompt().message_tokens(message) for message in HISTORY[:-2])
+    assembly = make_prompt(budget).assemble('question', HISTORY, DOCUMENTS)
+    assert assembly.documents == DOCUMENTS
+    assert assembly.history == HISTORY[-2:]
+    assert assembly.tokens <= budget
+
+    # Without room for history, the best documents come first
+    budget = unlimited.tokens - sum(make_prompt().message_tokens(message) for message in HISTORY) - document_tokens
+    assembly = make_prompt(budget).assemble('question', HISTORY, DOCUMENTS)
+    assert assembly.documents == DOCUMENTS[:3]
+    assert assembly.history == []
+    assert assembly.tokens <= budget < assembly.tokens + history_tokens
+
+
+def test_question_is_always_included():
+    assembly = make_prompt(10).assemble('question', HISTORY, DOCUMENTS)
+
+    assert assembly.messages[-1].content == 'question'
+    assert assembly.documents == [] and assembly.history == []
+
+
+def test_stored_token_counts():
+    prompt = RetrievalQAPrompt(length_function=lambda text: 1000)
+    document = Document(page_content='content', metadata={'source': 'a.md', 'tokens': 7})
+
+    # Only the source prefix is counted, the content tokens come from the metadata
+    assert prompt.document_tokens(document) == 1000 + 7 + 1
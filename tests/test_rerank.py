@@ -0,0 +1,99 @@
+import asyncio
+from functools import partial
+from typing import List
+
+import numpy as np
+import pytest
+from langchain.schema import Document
+
+from workshop_oai_qa.embeddings import CachedEmbeddings
+from workshop_oai_qa.fakes import FakeEmbeddings, fake_num_tokens
+from workshop_oai_qa.metrics import MetricsRegistry
+from workshop_oai_qa.prompts.retrieval_qa import RetrievalQAPrompt
+from workshop_oai_qa.rerank import EmbeddingReranker, Reranker, lexical_overlap
+
+DOCUMENTS = [
+    Document(page_content=f'Document {i} about transformers ' + 'padding ' * 10 * i, metadata={'source': f'{i}.md'})
+    for i in range(10)
+]
+
+
+class ReverseReranker(Reranker):
+    """Prefers the documents retrieved last."""
+
+    def score(self, query: str, documents: List[Document]) -> np.ndarray:
+        return np.arange(len(documents), dtype=np.float32)
+
+
+@pytest.fixture
+def make_chain(make_chain):
+    return partial(make_chain, documents=DOCUMENTS, k=10)
+
+
+def test_lexical_overlap():
+    documents = [Document(page_content=text) for text in ['Fine-tune a model', 'Train the model', 'Unrelated']]
+
+    assert lexical_overlap('Fine-tune the model', documents).tolist() == [0.75, 0.5, 0.0]
+    assert lexical_overlap('?', documents).tolist() == [0.0, 0.0, 0.0]
+
+
+def test_embedding_reranker_uses_cached_document_vectors(tmp_path):
+    fake = FakeEmbeddings(size=32)
+    embeddings = CachedEmbeddings(fake, path=str(tmp_path / 'cache.sqlite'), namespace='fake')
+    # Embedded at indexing time
+    embeddings.embed_documents([doc.page_content for doc in DOCUMENTS])
+    requests = fake.requests
+
+    ranked = EmbeddingReranker(embeddings, lexical_weight=0).rerank(DOCUMENTS[7].page_content, DOCUMENTS)
+
+    assert ranked[0][0] is DOCUMENTS[7]
+    assert ranked[0][1] == 1.0
+    assert [score for _, score in ranked] == sorted((score for _, score in ranked), reverse=True)
+    assert fake.requests == requests
+    assert EmbeddingReranker(embeddings).rerank('query', []) == []
+
+
+def test_embedding_reranker_falls_back_to_lexical_overlap(tmp_path):
+    fake = FakeEmbeddings(size=32)
+    embeddings = CachedEmbeddings(fake, path=str(tmp_path / 'cache.sqlite'), namespace='fake')
+    query = 'Document 3 about transformers'
+    embeddings.embed_documents([query] + [doc.page_content for doc in DOCUMENTS[:5]])
+    requests = fake.requests
+
+    scores = EmbeddingReranker(embeddings, lexical_weight=0.3).score(query, DOCUMENTS)
+
+    # Documents without cached vectors are not embedded, they are scored by lexical overlap alone
+    assert fake.requests == requests
+    assert scores[5:].tolist() == pytest.approx(lexical_overlap(query, DOCUMENTS[5:]).tolist())
+    assert embeddings.cached(['Document 3 about transformers', 'not cached']) == [
+        embeddings.embed_query('Document 3 about transformers'), None
+    ]
+
+
+def test_reranked_documents_fit_budget(make_chain):
+    prompt = RetrievalQAPrompt(length_function=fake_num_tokens)
+    metrics = MetricsRegistry()
+    chain = make_chain(reranker=ReverseReranker(), rerank_max_tokens=150, metrics=metrics)
+
+    documents = chain.rerank('transformers', DOCUMENTS)
+
+    tokens = [prompt.document_tokens(doc) for doc in DOCUMENTS]
+    assert tokens[9] + tokens[4] <= 150 < tokens[9] + tokens[5]
+    # Best first, skipping documents too large for what is left of the budget
+    assert [doc.metadata['source'] for doc in documents] == ['9.md', '4.md']
+    assert metrics.histogram('candidate_tokens', stage='rerank').sum == sum(tokens)
+    assert metrics.histogram('prompt_tokens_saved', stage='rerank').sum == \
+        sum(tokens) - sum(prompt.document_tokens(doc) for doc in documents)
+    assert metrics.histogram('stage_seconds', stage='rerank').count == 1
+
+
+def test_chain_prompts_with_reranked_documents(make_chain):
+    chain = make_chain(reranker=ReverseReranker(), rerank_max_tokens=150)
+    inputs = {'input': 'What about transformers?', 'history': [], 'callbacks': None}
+
+    outputs = chain(inputs)
+    async_outputs = asyncio.run(chain.acall(inputs))
+
+    assert list(outputs['documents']) == list(async_outputs['documents'])
+    assert list(outputs['documents']) == ['9.md', '4.md']
+    assert outputs['prompt_tokens'] < make_chain()(inputs)['prompt_tokens']
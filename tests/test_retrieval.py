@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+import pytest
+
+from workshop_oai_qa.chain import fuse_documents, query_similarity
+from workshop_oai_qa.metrics import MetricsRegistry
+
+LATENCY = 0.05
+
+
+@pytest.fixture
+def make_chain(make_chain, library_documents):
+    """Chains generating `query` as search query."""
+
+    def make(query: str, **kwargs):
+        def respond(messages):
+            if messages[-1].content.startswith('Generate search quer'):
+                return query
+            return 'This is the answer.'
+
+        return make_chain(documents=library_documents, k=2, respond=respond, **kwargs)
+
+    return make
+
+
+def test_query_similarity():
+    assert query_similarity('Install the library', 'install the library') == 1.0
+    assert query_similarity('install pip', 'install the library') == 0.25
+    assert query_similarity('', '') == 1.0
+
+
+def test_fuse_documents(library_documents):
+    a, b, c = library_documents[:3]
+
+    assert fuse_documents([[a, b], [b.copy(), c]], k=2) == [b, a]
+
+
+@pytest.mark.parametrize('query,strategy,searches', [
+    ('How do I install the library', 'reuse', 1),
+    ('pretrained model tokenizer', 'discard', 2),
+])
+def test_speculation_strategy(query, strategy, searches, make_chain):
+    chain = make_chain(query, speculative_retrieval=True)
+    input = 'How do I install the library?'
+
+    assert chain.speculation_strategy(input, query) == strategy
+
+    outputs = chain(dict(input=input, history=[], callbacks=None))
+    assert outputs['query'] == query
+    assert chain.retriever.vectorstore.searches == searches
+    if strategy != 'discard':
+        assert 'installation.md' in outputs['documents']
+
+
+def test_speculative_search_is_recorded_apart(make_chain):
+    metrics = MetricsRegistry()
+    chain = make_chain('pretrained model tokenizer', latency=LATENCY, speculative_retrieval=True, metrics=metrics)
+    # The speculative searches finish during query generation, before they are discarded
+    chain.retriever.vectorstore.latency = 0.0
+
+    chain(dict(input='How do I install the library?', history=[], callbacks=None))
+    asyncio.run(chain.acall(dict(input='How do I install the library?', history=[], callbacks=None)))
+
+    # The discarded speculative searches do not count as retrievals
+    assert metrics.histogram('stage_seconds', stage='retrieval').count == 2
+    assert metrics.histogram('stage_seconds', stage='speculative_retrieval').count == 2
+
+
+def test_speculative_retrieval_hides_query_latency(make_chain):
+    input = 'How do I install the library?'
+
+    def run(chain):
+        start = time.perf_counter()
+        chain(dict(input=input, history=[], callbacks=None))
+        return time.perf_counter() - start
+
+    sequential = run(make_chain(input, latency=LATENCY))
+    speculative = run(make_chain(input, latency=LATENCY, speculative_retrieval=True))
+
+    # Query generation, retrieval and answer one after the other, against retrieval during query generation
+    assert sequential >= 3 * LATENCY
+    assert speculative < sequential - LATENCY / 2
+
+
+@pytest.mark.parametrize('query', ['How do I install the library', 'pretrained model tokenizer'])
+def test_async_speculative_retrieval(query, make_chain):
+    chain = make_chain(query, latency=LATENCY, speculative_retrieval=True)
+    sync_outputs = chain(dict(input='How do I install the library?', history=[], callbacks=None))
+
+    outputs = asyncio.run(chain.acall(dict(input='How do I install the library?', history=[], callbacks=None)))
+
+    assert outputs['query'] == query
+    assert list(outputs['documents']) == list(sync_outputs['documents'])
+
+
+def test_split_queries(make_chain):
+    chain = make_chain('', multi_query=True, max_queries=3)
+
+    assert chain.split_queries('1. install with pip\n- pretrained model\n\ntokenizer\nextra', 'input') == [
+        'install with pip', 'pretrained model', 'tokenizer'
+    ]
+    assert chain.split_queries('0', 'input') == ['input']
+
+
+def test_multi_query_retrieval(make_chain):
+    chain = make_chain('install with pip\npretrained model', latency=LATENCY, multi_query=True)
+
+    start = time.perf_counter()
+    query, documents = chain.retrieve('How do I install the library and load a model?')
+    elapsed = time.perf_counter() - start
+
+    # Both queries are retrieved concurrently, after query generation
+    assert chain.retriever.vectorstore.searches == 2
+    assert elapsed < 3 * LATENCY
+    sources = [doc.metadata['source'] for doc in documents]
+    assert 'installation.md' in sources and 'models.md' in sources
+    assert len(sources) == len(set(sources)) <= 2
+
+
+def test_async_multi_query_retrieval(make_chain):
+    chain = make_chain('install with pip\npretrained model', latency=LATENCY, multi_query=True)
+    _, sync_documents = chain.retrieve('How do I install the library and load a model?')
+
+    start = time.perf_counter()
+    _, documents = asyncio.run(chain.aretrieve('How do I install the library and load a model?'))
+
+    assert time.perf_counter() - start < 3 * LATENCY
+    assert documents == sync_documents
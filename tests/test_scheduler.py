@@ -0,0 +1,207 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from workshop_oai_qa.batch import BatchRunner, read_questions
+from workshop_oai_qa.metrics import MetricsRegistry
+from workshop_oai_qa.ratelimit import RateLimiter, SqliteTokenBucket
+from workshop_oai_qa.scheduler import BACKGROUND, INTERACTIVE, Scheduler, SchedulerOverloaded
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class GatedRateLimiter:
+    """Admits a request for every permit released by the test."""
+
+    def __init__(self, permits: int = 0):
+        self.permits = permits
+        self.lock = threading.Lock()
+
+    def release(self, permits: int = 1):
+        with self.lock:
+            self.permits += permits
+
+    def try_acquire(self, tokens: float = 0) -> float:
+        with self.lock:
+            if self.permits > 0:
+                self.permits -= 1
+                return 0.0
+            return 0.01
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'Timed out'
+        time.sleep(0.01)
+
+
+def test_interactive_requests_go_first():
+    limiter = GatedRateLimiter()
+    scheduler = Scheduler(limiter, metrics=MetricsRegistry())
+    admitted = []
+
+    def request(level):
+        scheduler.acquire(level=level)
+        admitted.append(level)
+
+    threads = []
+    for level in [BACKGROUND, BACKGROUND, INTERACTIVE]:
+        threads.append(threading.Thread(target=request, args=(level,)))
+        threads[-1].start()
+        wait_for(lambda: scheduler.depth == len(threads))
+
+    for i in range(3):
+        limiter.release()
+        wait_for(lambda: len(admitted) == i + 1)
+    for thread in threads:
+        thread.join()
+
+    assert admitted == [INTERACTIVE, BACKGROUND, BACKGROUND]
+    assert scheduler.metrics.histogram('scheduler_wait_seconds', scheduler='chat', priority='background').count == 2
+
+
+def test_async_requests_wait_without_threads():
+    limiter = GatedRateLimiter()
+    scheduler = Scheduler(limiter)
+    admitted = []
+
+    async def request(level):
+        await scheduler.aacquire(level=level)
+        admitted.append(level)
+
+    async def run():
+        tasks = [asyncio.ensure_future(request(level)) for level in [BACKGROUND, BACKGROUND, INTERACTIVE]]
+        await asyncio.sleep(0.05)
+        # Queued requests hold no thread, only the head of the queue takes from the quota in a worker thread
+        assert scheduler.depth == 3 and threading.active_count() <= threads + 1
+
+        # A cancelled request leaves the queue without taking from the quota
+        tasks[0].cancel()
+        await asyncio.sleep(0.01)
+        assert scheduler.depth == 2
+
+        limiter.release(2)
+        await asyncio.gather(*tasks[1:])
+
+    threads = threading.active_count()
+    asyncio.run(run())
+
+    assert admitted == [INTERACTIVE, BACKGROUND]
+    assert limiter.permits == 0 and scheduler.admitted == 2
+
+
+def test_requests_queue_while_the_rate_limiter_blocks():
+    class BlockingRateLimiter:
+        """Blocks like a SQLite limiter waiting for the write lock of its database."""
+
+        def __init__(self):
+            self.entered = threading.Event()
+            self.unblocked = threading.Event()
+
+        def try_acquire(self, tokens: float = 0) -> float:
+            self.entered.set()
+            self.unblocked.wait(5)
+            return 0.0
+
+    limiter = BlockingRateLimiter()
+    scheduler = Scheduler(limiter)
+    threads = [threading.Thread(target=scheduler.acquire) for _ in range(2)]
+    threads[0].start()
+    limiter.entered.wait(5)
+
+    threads[1].start()
+    wait_for(lambda: scheduler.depth == 2)
+
+    limiter.unblocked.set()
+    for thread in threads:
+        thread.join()
+    assert scheduler.admitted == 2
+
+
+def test_background_requests_are_rejected_when_queue_is_full():
+    limiter = GatedRateLimiter()
+    scheduler = Scheduler(limiter, degrade_depth=1, max_background=1)
+
+    thread = threading.Thread(target=scheduler.acquire, kwargs={'level': BACKGROUND})
+    thread.start()
+    wait_for(lambda: scheduler.overloaded)
+
+    with pytest.raises(SchedulerOverloaded):
+        scheduler.acquire(level=BACKGROUND)
+    assert scheduler.rejected == 1
+
+    # Interactive requests are still queued, and admitted first
+    limiter.release(2)
+    scheduler.acquire(level=INTERACTIVE)
+    thread.join()
+    assert scheduler.admitted == 2
+
+
+def test_rate_limiter_returns_request_when_tokens_do_not_fit():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=100, clock=clock)
+
+    assert limiter.try_acquire(80) == 0
+    assert limiter.try_acquire(80) > 0
+    # The request of the refused call was returned
+    assert limiter.try_acquire(10) == 0
+    assert limiter.try_acquire(0) > 0
+
+
+def test_sqlite_token_bucket_is_shared(tmp_path):
+    clock = FakeClock()
+    path = str(tmp_path / 'ratelimit.sqlite')
+    first = SqliteTokenBucket(path, 'chat:requests', capacity=60, clock=clock)
+    second = SqliteTokenBucket(path, 'chat:requests', capacity=60, clock=clock)
+    other = SqliteTokenBucket(path, 'embedding:requests', capacity=60, clock=clock)
+
+    assert first.try_acquire(40) == 0
+    assert second.try_acquire(40) == 20.0
+    assert other.try_acquire(40) == 0
+
+    clock.now = 20.0
+    assert second.try_acquire(40) == 0
+
+    first.refund(10)
+    second.drain()
+    assert first.try_acquire(1) == 1.0
+
+    for bucket in (first, second, other):
+        bucket.close()
+
+
+def test_query_generation_is_skipped_when_overloaded(make_chain):
+    metrics = MetricsRegistry()
+    chain = make_chain(scheduler=Scheduler(GatedRateLimiter(permits=10), degrade_depth=0), metrics=metrics)
+
+    outputs = chain({'input': 'What about transformers?', 'history': [], 'callbacks': None})
+
+    # Only the answer was generated, searching with the question itself
+    assert chain.llm.calls == 1
+    assert outputs['query'] == 'What about transformers?'
+    assert metrics.counter('degraded_total', stage='query_generation') == 1
+    assert chain.scheduler.admitted == 1
+
+
+def test_batch_runs_at_background_priority(tmp_path, make_chain):
+    metrics = MetricsRegistry()
+    chain = make_chain(scheduler=Scheduler(GatedRateLimiter(permits=10), metrics=metrics))
+    with open(tmp_path / 'questions.jsonl', 'w') as f:
+        f.write(json.dumps({'question': 'What about transformers?'}) + '\n')
+
+    stats = BatchRunner(chain, concurrency=1).run(read_questions(tmp_path / 'questions.jsonl'),
+                                                  str(tmp_path / 'answers.jsonl'))
+
+    assert stats.answered == 1
+    # Query generation and answer
+    assert metrics.histogram('scheduler_wait_seconds', scheduler='chat', priority='background').count == 2
+    assert metrics.histogram('scheduler_wait_seconds', scheduler='chat', priority='interactive') is None
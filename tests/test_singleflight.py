@@ -0,0 +1,160 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import pytest
+from langchain.schema import ChatMessage
+
+from workshop_oai_qa.fakes import FakeEmbeddings
+from workshop_oai_qa.metrics import MetricsRegistry
+from workshop_oai_qa.singleflight import SingleFlight, SingleFlightChain, SingleFlightEmbeddings
+
+def concurrently(fn, n: int = 5):
+    """Call `fn` from `n` threads at once."""
+    barrier = threading.Barrier(n)
+
+    def call(_):
+        barrier.wait()
+        return fn()
+
+    with ThreadPoolExecutor(max_workers=n) as executor:
+        return list(executor.map(call, range(n)))
+
+
+@pytest.fixture
+def make_chain(make_chain):
+    return partial(make_chain, latency=0.1)
+
+
+def test_concurrent_calls_share_result():
+    metrics = MetricsRegistry()
+    flights = SingleFlight('test', metrics=metrics)
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'result'
+
+    assert concurrently(lambda: flights.do('key', slow)) == ['result'] * 5
+    assert len(calls) == 1
+    assert (flights.calls, flights.saved) == (1, 4)
+    assert metrics.counter('singleflight_saved_total', flight='test') == 4
+
+    # Nothing is kept once the call is done
+    flights.do('key', slow)
+    assert len(calls) == 2
+
+
+def test_concurrent_calls_share_error():
+    flights = SingleFlight()
+
+    def fail():
+        time.sleep(0.2)
+        raise ValueError('failed')
+
+    def call():
+        with pytest.raises(ValueError):
+            flights.do('key', fail)
+
+    concurrently(call)
+    assert flights.calls == 1
+
+
+def test_async_calls_share_result():
+    flights = SingleFlight()
+    calls = []
+
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'result'
+
+    async def run():
+        return await asyncio.gather(*(flights.ado('key', slow) for _ in range(5)))
+
+    assert asyncio.run(run()) == ['result'] * 5
+    assert len(calls) == 1 and flights.saved == 4
+
+
+def test_cancelled_leader_does_not_fail_others():
+    flights = SingleFlight()
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(0.1)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+        return 'result'
+
+    async def run():
+        leader = asyncio.ensure_future(flights.ado('key', slow))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.ado('key', slow))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        result = await follower
+
+        # Once every caller is cancelled, so is the call
+        abandoned = asyncio.ensure_future(flights.ado('other', slow))
+        await asyncio.sleep(0.01)
+        abandoned.cancel()
+        await asyncio.sleep(0.01)
+        return result
+
+    assert asyncio.run(run()) == 'result'
+    assert cancelled == [1]
+    assert (flights.calls, flights.saved) == (2, 1)
+
+
+def test_embeddings():
+    fake = FakeEmbeddings(size=8, latency=0.2)
+    embeddings = SingleFlightEmbeddings(fake)
+
+    vectors = concurrently(lambda: embeddings.embed_query('text'))
+
+    assert all(vector == vectors[0] for vector in vectors)
+    assert fake.requests == 1
+    assert embeddings.flights.saved == 4
+
+
+def test_chain_shares_reply_of_first_questions(make_chain):
+    chain = SingleFlightChain(chain=make_chain(), flights=SingleFlight('chain'))
+    greeting = [ChatMessage(role='assistant', content='How may I help you?')]
+
+    outputs = concurrently(lambda: chain({'input': 'What about transformers?', 'history': greeting, 'callbacks': None}))
+
+    assert all(output['reply'] is outputs[0]['reply'] for output in outputs)
+    # A single query generation and answer
+    assert chain.chain.llm.calls == 2
+    assert chain.flights.saved == 4
+
+
+def test_chain_does_not_share_conversations(make_chain):
+    chain = SingleFlightChain(chain=make_chain(), flights=SingleFlight('chain'))
+    history = [ChatMessage(role='user', content='Hi'), ChatMessage(role='assistant', content='Hello')]
+
+    concurrently(lambda: chain({'input': 'What about transformers?', 'history': history, 'callbacks': None}), n=2)
+
+    assert (chain.flights.calls, chain.flights.saved) == (0, 0)
+
+
+def test_concurrent_searches_are_coalesced(make_chain):
+    chain = make_chain(search_flights=SingleFlight('search'))
+
+    async def run():
+        return await asyncio.gather(*(chain.asearch('transformers') for _ in range(3)))
+
+    results = asyncio.run(run())
+    assert results[0] == results[1] == results[2]
+    assert chain.retriever.vectorstore.searches == 1
+
+    concurrently(lambda: chain.search('transformers'), n=3)
+    assert chain.retriever.vectorstore.searches == 2
+    assert chain.search_flights.saved == 4
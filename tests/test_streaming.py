@@ -0,0 +1,136 @@
+import asyncio
+from functools import partial
+
+import pytest
+from langchain.schema import Document
+
+from workshop_oai_qa.streaming import CitationEvent, FollowUpEvent, ReplyCallbackHandler, ReplyParser, TextEvent
+
+SOURCES = {
+    'a.md': Document(page_content='Transformers supports PyTorch', metadata={'source': 'a.md'}),
+    'b.md': Document(page_content='Transformers supports JAX', metadata={'source': 'b.md'}),
+}
+
+REPLY = (
+    'Transformers supports PyTorch [a.md] and JAX [b.md][a.md]. See [unknown.md] and <table><tr></tr></table>.\n'
+    '<<What is X?>>, <<How to Y?>>, <<Why Z?>>.'
+)
+
+
+def parse(reply: str, chunk_size: int, sources=SOURCES):
+    parser = ReplyParser(sources)
+    events = []
+    for i in range(0, len(reply), chunk_size):
+        events.extend(parser.feed(reply[i:i + chunk_size]))
+    events.extend(parser.finish())
+    return parser, events
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, len(REPLY)])
+def test_parse(chunk_size):
+    parser, events = parse(REPLY, chunk_size)
+
+    assert parser.text == 'Transformers supports PyTorch [1] and JAX [2][1]. See [unknown.md] and <table><tr></tr></table>.'
+    assert parser.citations == ['a.md', 'b.md']
+    assert parser.follow_ups == ['What is X?', 'How to Y?', 'Why Z?']
+
+    assert [event for event in events if not isinstance(event, TextEvent)] == [
+        CitationEvent(1, 'a.md'),
+        CitationEvent(2, 'b.md'),
+        FollowUpEvent('What is X?'),
+        FollowUpEvent('How to Y?'),
+        FollowUpEvent('Why Z?'),
+    ]
+    assert ''.join(event.text for event in events if isinstance(event, TextEvent)).strip() == parser.text
+
+
+def test_events_arrive_when_complete():
+    parser = ReplyParser(SOURCES)
+
+    assert parser.feed('Supports [a.') == [TextEvent('Supports ')]
+    assert parser.feed('md] and') == [CitationEvent(1, 'a.md'), TextEvent('[1] and')]
+    assert parser.feed(' <<What is') == [TextEvent(' ')]
+    assert parser.feed(' X?>>') == [FollowUpEvent('What is X?')]
+
+
+def test_unfinished_markup_is_text():
+    parser, _ = parse('Answer [a.md', 3)
+    assert parser.text == 'Answer [a.md'
+
+    parser, _ = parse('Answer <<What', 3)
+    assert parser.text == 'Answer <<What'
+
+    parser, _ = parse('Line [one\ntwo] < three', 3)
+    assert parser.text == 'Line [one\ntwo] < three'
+    assert parser.citations == []
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 100])
+def test_text_after_follow_ups(chunk_size):
+    parser, _ = parse('Answer [a.md]. <<Q1?>> <<Q2?>> Hope this helps.', chunk_size)
+
+    assert parser.text == 'Answer [1]. Hope this helps.'
+    assert parser.follow_ups == ['Q1?', 'Q2?']
+
+
+def test_unmatched_follow_up_is_streamed():
+    parser = ReplyParser(SOURCES)
+
+    assert parser.feed('Shift with x << 2;') == [TextEvent('Shift with x ')]
+    assert parser.feed('\nDone') == [TextEvent('<< 2;\nDone')]
+
+    parser.feed('<<' + 'x' * 300)
+    assert parser.text.endswith('x' * 40)
+    assert parser.follow_ups == []
+
+
+def test_all_citations_without_sources():
+    parser, _ = parse('See [x.md] and [y.md][x.md]', 4, sources=None)
+
+    assert parser.text == 'See [1] and [2][1]'
+    assert parser.citations == ['x.md', 'y.md']
+
+
+class RecordingHandler(ReplyCallbackHandler):
+    def __init__(self):
+        self.text = ''
+        self.citations = []
+        self.follow_ups = []
+
+    def on_reply_text(self, text, **kwargs):
+        self.text += text
+
+    def on_reply_citation(self, number, document, **kwargs):
+        self.citations.append((number, document.metadata['source']))
+
+    def on_reply_follow_up(self, question, **kwargs):
+        self.follow_ups.append(question)
+
+
+@pytest.fixture
+def make_chain(make_chain):
+    def respond(messages):
+        return 'query' if 'search query' in messages[-1].content else REPLY
+
+    return partial(make_chain, documents=list(SOURCES.values()), k=2, respond=respond)
+
+
+def test_chain_streams_parsed_reply(make_chain):
+    handler = RecordingHandler()
+
+    outputs = make_chain()({'input': 'Which frameworks?', 'history': [], 'callbacks': [handler]})
+
+    assert outputs['response'].content == REPLY
+    assert outputs['reply'].formatted_content == handler.text.strip()
+    assert [doc.metadata['source'] for doc in outputs['citations']] == ['a.md', 'b.md']
+    assert handler.citations == [(1, 'a.md'), (2, 'b.md')]
+    assert handler.follow_ups == outputs['follow_ups'] == ['What is X?', 'How to Y?', 'Why Z?']
+
+
+def test_async_chain_streams_parsed_reply(make_chain):
+    handler = RecordingHandler()
+
+    outputs = asyncio.run(make_chain().acall({'input': 'Which frameworks?', 'history': [], 'callbacks': [handler]}))
+
+    assert outputs['reply'].formatted_content == handler.text.strip()
+    assert handler.citations == [(1, 'a.md'), (2, 'b.md')]
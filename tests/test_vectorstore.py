@@ -0,0 +1,136 @@
+import numpy as np
+import pytest
+from langchain.schema import Document
+
+from workshop_oai_qa.fakes import FakeEmbeddings
+from workshop_oai_qa.indexing.writers import LocalVectorStoreWriter
+from workshop_oai_qa.vectorstores.local import DOCUMENTS_FILE, LocalVectorStore
+
+TEXTS = [f'document {i}' for i in range(20)]
+
+
+@pytest.fixture
+def embeddings():
+    return FakeEmbeddings(size=16)
+
+
+@pytest.fixture
+def store(tmp_path, embeddings):
+    store = LocalVectorStore(path=str(tmp_path / 'index'), embedding=embeddings)
+    store.add_texts(TEXTS, metadatas=[{'source': f'{i % 4}.md'} for i in range(20)], ids=[str(i) for i in range(20)])
+    return store
+
+
+def brute_force(embeddings, query, k):
+    matrix = np.array([embeddings.vector(text) for text in TEXTS])
+    return [TEXTS[i] for i in np.argsort(-(matrix @ np.array(embeddings.vector(query))))[:k]]
+
+
+def test_similarity_search(store, embeddings):
+    docs = store.similarity_search('document 3', k=5)
+
+    assert docs[0].page_content == 'document 3'
+    assert [doc.page_content for doc in docs] == brute_force(embeddings, 'document 3', 5)
+
+    scores = [score for _, score in store.similarity_search_with_score('document 3', k=5)]
+    assert scores == sorted(scores, reverse=True)
+    assert scores[0] == pytest.approx(1.0)
+
+
+def test_filter(store):
+    docs = store.similarity_search('document 3', k=10, filter={'source': '1.md'})
+    assert len(docs) == 5
+    assert all(doc.metadata['source'] == '1.md' for doc in docs)
+
+    docs = store.similarity_search('document 3', k=10, filter={'source': ['1.md', '2.md']})
+    assert len(docs) == 10
+
+    docs = store.similarity_search('document 3', k=10, filter=lambda metadata: metadata['source'] == '3.md')
+    assert {doc.metadata['source'] for doc in docs} == {'3.md'}
+
+
+def test_delete_and_replace(store, tmp_path, embeddings):
+    store.delete(['3'])
+    store.add_texts(['replaced'], metadatas=[{'source': 'new.md'}], ids=['4'])
+    store.update_metadata({'5': {'source': 'updated.md'}})
+
+    assert len(store) == 19
+    contents = [doc.page_content for doc in store.similarity_search('document 3', k=20)]
+    assert 'document 3' not in contents and 'document 4' not in contents and 'replaced' in contents
+
+    # State is persisted and survives compaction
+    reopened = LocalVectorStore(path=str(tmp_path / 'index'), embedding=embeddings)
+    reopened.compact()
+    reopened = LocalVectorStore(path=str(tmp_path / 'index'), embedding=embeddings)
+    assert len(reopened) == 19
+    assert reopened.matrix.shape == (19, 16)
+    assert reopened.similarity_search('document 5', k=1)[0].metadata == {'source': 'updated.md'}
+
+
+def test_refresh(store, tmp_path, embeddings):
+    reader = LocalVectorStore(path=str(tmp_path / 'index'), embedding=embeddings)
+    store.add_texts(['added later'], ids=['later'])
+
+    assert reader.similarity_search('added later', k=1)[0].page_content == 'added later'
+
+
+def test_refresh_is_incremental(store, tmp_path, embeddings, monkeypatch):
+    reader = LocalVectorStore(path=str(tmp_path / 'index'), embedding=embeddings)
+    monkeypatch.setattr(reader, '_load', lambda: pytest.fail('appended records are applied without a reload'))
+    store.add_texts(['added later'], ids=['later'])
+    store.delete(['0'])
+
+    assert reader.similarity_search('added later', k=1)[0].page_content == 'added later'
+    assert len(reader) == 20
+    monkeypatch.undo()
+
+    # A log rewritten by compaction is reloaded
+    store.compact()
+    assert reader.similarity_search('added later', k=1)[0].page_content == 'added later'
+    assert reader.matrix.shape == (20, 16)
+
+
+def test_refresh_during_write(store, tmp_path, embeddings):
+    reader = LocalVectorStore(path=str(tmp_path / 'index'), embedding=embeddings)
+    store.add_texts(['added later'], ids=['later'])
+    log = tmp_path / 'index' / DOCUMENTS_FILE
+    content = log.read_bytes()
+
+    # The indexer has written half of the last line
+    log.write_bytes(content[:-20])
+    assert len(reader.similarity_search('added later', k=25)) == 20
+
+    log.write_bytes(content)
+    assert reader.similarity_search('added later', k=1)[0].page_content == 'added later'
+
+
+def test_interrupted_write(store, tmp_path, embeddings):
+    # Vectors appended without their log entries are ignored
+    with open(tmp_path / 'index' / 'vectors.f32', 'ab') as f:
+        f.write(np.ones((2, 16), dtype=np.float32).tobytes())
+
+    reopened = LocalVectorStore(path=str(tmp_path / 'index'), embedding=embeddings)
+    assert reopened.matrix.shape == (20, 16)
+
+
+def test_retriever(store):
+    retriever = store.as_retriever(search_kwargs={'k': 3})
+    assert len(retriever.get_relevant_documents('document 7')) == 3
+
+
+def test_writer(tmp_path, embeddings):
+    store = LocalVectorStore(path=str(tmp_path / 'index'), embedding=embeddings)
+    writer = LocalVectorStoreWriter(store)
+    docs = [Document(page_content=text, metadata={'source': 'a.md'}) for text in TEXTS[:3]]
+
+    writer.add(docs, ['a', 'b', 'c'], [embeddings.vector(doc.page_content) for doc in docs])
+    writer.delete(['b'])
+    assert len(store) == 2
+
+
+def test_version_changes_on_write(store):
+    version = store.version
+
+    store.update_metadata({'0': {'source': 'other.md'}})
+
+    assert store.version != version
@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterable, Iterator, Optional, Set
+
+from langchain.chains.base import Chain
+from langchain.schema import ChatMessage
+
+from workshop_oai_qa.metrics import Histogram
+from workshop_oai_qa.ratelimit import RateLimiter, is_rate_limit_error, retry_after
+from workshop_oai_qa.scheduler import BACKGROUND, SchedulerOverloaded, priority
+
+logger = logging.getLogger(__name__)
+
+# Each question takes a query generation and an answer request
+REQUESTS_PER_QUESTION = 2
+
+
+def read_questions(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Read questions from a JSON lines file with a `question`, and optionally an `id` and a `history` of
+    `{"role", "content"}` messages per line. Questions without an ID are identified by their line number.
+    :param path:
+    :return:
+    """
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if line.strip():
+                record = json.loads(line)
+                record.setdefault('id', i)
+                yield record
+
+
+def completed_ids(path: str) -> Set[str]:
+    """
+    IDs of the questions answered in an earlier run, read from its output. Failed questions are not completed, so
+    they are asked again when resuming.
+    :param path:
+    :return:
+    """
+    ids = set()
+    if not os.path.exists(path):
+        return ids
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be cut off when the run was interrupted
+                continue
+            if not record.get('error'):
+                ids.add(str(record['id']))
+    return ids
+
+
+def _ends_with_newline(path: str) -> bool:
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+class BatchStats:
+    """
+    Thread-safe throughput and latency of a batch run.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = clock()
+        self.answered = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retries = 0
+        self.latency = Histogram()
+        self._lock = threading.Lock()
+
+    def record(self, seconds: Optional[float] = None, failed: bool = False, retries: int = 0):
+        with self._lock:
+            self.retries += retries
+            if failed:
+                self.failed += 1
+            else:
+                self.answered += 1
+                self.latency.observe(seconds)
+
+    @property
+    def elapsed(self) -> float:
+        return max(self.clock() - self.started, 1e-9)
+
+    @property
+    def questions_per_second(self) -> float:
+        return self.answered / self.elapsed
+
+    def summary(self) -> Dict[str, float]:
+        """
+        Aggregate throughput and latency percentiles, e.g. to write them as JSON.
+        :return:
+        """
+        return {
+            'answered': self.answered,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'retries': self.retries,
+            'seconds': self.elapsed,
+            'questions_per_second': self.questions_per_second,
+            'p50_seconds': self.latency.percentile(0.5),
+            'p90_seconds': self.latency.percentile(0.9),
+            'p99_seconds': self.latency.percentile(0.99),
+        }
+
+    def __str__(self):
+        return (
+            f'{self.answered} answered, {self.failed} failed, {self.skipped} skipped, {self.retries} retries '
+            f'in {self.elapsed:.1f}s: {self.questions_per_second:.2f} questions/s, latency '
+            f'p50 {self.latency.percentile(0.5):.2f}s, p90 {self.latency.percentile(0.9):.2f}s, '
+            f'p99 {self.latency.percentile(0.99):.2f}s'
+        )
+
+
+class BatchRunner:
+    """
+    Answers questions with a chain in up to `concurrency` threads, within a requests-per-minute and
+    tokens-per-minute quota shared by all threads.
+
+    The token cost of a question is estimated from the mean prompt tokens of the questions answered so far.
+    Rate limited questions pause all threads and are retried. Questions are asked at background priority, so a
+    chain with a scheduler answers interactive users first.
+    """
+
+    def __init__(
+            self,
+            chain: Chain,
+            concurrency: int = 4,
+            rate_limiter: Optional[RateLimiter] = None,
+            max_retries: int = 5,
+            backoff: float = 1.0,
+            max_backoff: float = 60.0,
+            initial_tokens: int = 2000,
+    ):
+        self.chain = chain
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = BatchStats()
+
+        self._tokens = [initial_tokens, 1]
+        self._logged = 0
+        self._lock = threading.Lock()
+
+    @property
+    def estimated_tokens(self) -> float:
+        with self._lock:
+            return self._tokens[0] / self._tokens[1]
+
+    def _acquire(self):
+        tokens = self.estimated_tokens
+        for _ in range(REQUESTS_PER_QUESTION):
+            self.rate_limiter.acquire(tokens / REQUESTS_PER_QUESTION)
+
+    def answer(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Answer a single question, retrying when rate limited.
+        :param record: Question record as read by `read_questions`
+        :return: Output record
+        """
+        history = [ChatMessage(role=message['role'], content=message['content'])
+                   for message in record.get('history', [])]
+
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            start = time.perf_counter()
+            try:
+                with priority(BACKGROUND):
+                    outputs = self.chain({'input': record['question'], 'history': history, 'callbacks': None})
+            except Exception as e:
+                retry = is_rate_limit_error(e) or isinstance(e, SchedulerOverloaded)
+                if not retry or attempt == self.max_retries:
+                    logger.warning(f'Question {record["id"]} failed: {e}')
+                    self.stats.record(failed=True, retries=attempt)
+                    return {'id': record['id'], 'question': record['question'], 'error': str(e)}
+
+                wait = retry_after(e) or min(self.backoff * 2 ** attempt, self.max_backoff)
+                logger.warning(f'Rate limited, backing off for {wait:.1f}s (attempt {attempt + 1})')
+                self.rate_limiter.pause(wait)
+                continue
+
+            seconds = time.perf_counter() - start
+            self.stats.record(seconds, retries=attempt)
+            if prompt_tokens := outputs.get('prompt_tokens'):
+                with self._lock:
+                    self._tokens[0] += prompt_tokens
+                    self._tokens[1] += 1
+
+            reply = outputs['reply']
+            return {
+                'id': record['id'],
+                'question': record['question'],
+                'answer': reply.formatted_content,
+                'query': outputs.get('query'),
+                'citations': [doc.metadata.get('source') for doc in reply.citations],
+                'follow_ups': reply.follow_ups,
+                'prompt_tokens': prompt_tokens,
+                'seconds': seconds,
+            }
+
+    def run(self, records: Iterable[Dict[str, Any]], output_path: str) -> BatchStats:
+        """
+        Answer all questions not answered in the output yet, appending each result to the output as soon as it is
+        done. Only `concurrency` questions are read ahead, so large inputs are streamed.
+        :param records:
+        :param output_path: JSON lines file, resumed from if it exists
+        :return:
+        """
+        self.stats = BatchStats()
+        done = completed_ids(output_path)
+        if done:
+            logger.info(f'Resuming, {len(done)} questions were answered before')
+
+        in_flight: Set[Future] = set()
+        with open(output_path, 'a') as output, ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            # Terminate a line cut off by an interruption, so the next result starts on a line of its own
+            if output.tell() and not _ends_with_newline(output_path):
+                output.write('\n')
+
+            def write(futures: Iterable[Future]):
+                for future in futures:
+                    output.write(json.dumps(future.result()) + '\n')
+                # Flush every result, so an interrupted run resumes after the last finished question
+                output.flush()
+                self._log_progress()
+
+            try:
+                for record in records:
+                    if str(record['id']) in done:
+                        self.stats.skipped += 1
+                        continue
+                    in_flight.add(executor.submit(self.answer, record))
+                    if len(in_flight) >= self.concurrency:
+                        finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        write(finished)
+
+                finished, _ = wait(in_flight)
+                write(finished)
+            except KeyboardInterrupt:
+                logger.warning('Interrupted, rerun with the same output to resume')
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        logger.info(f'Batch done: {self.stats}')
+        return self.stats
+
+    def _log_progress(self, every: int = 100):
+        completed = self.stats.answered + self.stats.failed
+        if completed >= self._logged + every:
+            self._logged = completed
+            logger.info(f'Progress: {self.stats}')
+
@@ -0,0 +1,397 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.callbacks.manager import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
+from langchain.chains.base import Chain
+from langchain.schema.embeddings import Embeddings
+
+from workshop_oai_qa.metrics import MetricsRegistry
+from workshop_oai_qa.utils import role_from_message
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_input(text: str) -> str:
+    """
+    Normalize a question for exact-match caching, ignoring case, whitespace and trailing punctuation.
+    :param text:
+    :return:
+    """
+    return re.sub(r'\s+', ' ', text).strip().rstrip('?!.').strip().lower()
+
+
+class Cache(ABC):
+    """
+    Exact-match cache of JSON-serializable values with a time to live and least recently used eviction.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    @abstractmethod
+    def _get(self, key: str) -> Optional[Any]:
+        """Value of a key that has not expired, or None."""
+
+    @abstractmethod
+    def set(self, key: str, value: Any):
+        """Store a value, evicting the least recently used values beyond the maximum number of entries."""
+
+    @abstractmethod
+    def clear(self):
+        """Remove all values."""
+
+    def close(self):
+        pass
+
+
+class MemoryCache(Cache):
+    """
+    Cache in the memory of the process, shared by the Streamlit sessions it serves.
+    """
+
+    def __init__(self, ttl: float = 24 * 3600, max_entries: int = 10000, clock: Callable[[], float] = time.monotonic):
+        super().__init__()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+
+        self._entries: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self.clock() - entry[0] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._entries[key] = (self.clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteCache(Cache):
+    """
+    Cache in a local SQLite database, shared by all processes on the machine. Caches with different `namespace`
+    can share a database file.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            namespace: str,
+            ttl: float = 24 * 3600,
+            max_entries: int = 10000,
+            clock: Callable[[], float] = time.time,
+    ):
+        super().__init__()
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS cache (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            );
+            CREATE INDEX IF NOT EXISTS cache_accessed ON cache (namespace, accessed);
+        ''')
+
+    def __len__(self):
+        with self._lock:
+            row = self._conn.execute('SELECT COUNT(*) FROM cache WHERE namespace = ?', (self.namespace,)).fetchone()
+        return row[0]
+
+    def _get(self, key: str) -> Optional[Any]:
+        now = self.clock()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT value FROM cache WHERE namespace = ? AND key = ? AND created >= ?',
+                (self.namespace, key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                'UPDATE cache SET accessed = ? WHERE namespace = ? AND key = ?', (now, self.namespace, key)
+            )
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        now = self.clock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO cache (namespace, key, value, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                (self.namespace, key, json.dumps(value), now, now),
+            )
+            self._conn.execute(
+                'DELETE FROM cache WHERE namespace = ? AND created < ?', (self.namespace, now - self.ttl)
+            )
+            self._conn.execute('''
+                DELETE FROM cache WHERE namespace = ? AND key IN (
+                    SELECT key FROM cache WHERE namespace = ? ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.namespace, self.namespace, self.max_entries))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM cache WHERE namespace = ?', (self.namespace,))
+
+    def close(self):
+        self._conn.close()
+
+
+def _unit(vector: List[float]) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class CacheEntry:
+    def __init__(self, question: str, vector: np.ndarray, value: Any, seconds: float, created: float):
+        self.question = question
+        self.vector = vector
+        self.value = value
+        self.seconds = seconds
+        self.created = created
+
+
+class SemanticCache:
+    """
+    In-memory cache of answers keyed by the embedding of the question.
+
+    A lookup returns the answer to the most similar stored question if its cosine similarity is at least
+    `threshold`. Entries expire after `ttl` seconds and the least recently used ones are evicted beyond
+    `max_entries`. When `version()` changes, e.g. because the index was rebuilt, the cache is cleared. Without
+    `version`, entries are only invalidated by their time to live.
+
+    Vectors are normalized when stored and looked up, so scores are cosine similarities whatever the embeddings.
+    """
+
+    def __init__(
+            self,
+            threshold: float = 0.95,
+            ttl: float = 24 * 3600,
+            max_entries: int = 1000,
+            version: Optional[Callable[[], str]] = None,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.version = version
+        self.clock = clock
+
+        self._entries: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+        self._matrix: Optional[np.ndarray] = None
+        self._keys: List[str] = []
+        self._version = version() if version else None
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def _check_version(self):
+        if self.version is None:
+            return
+        version = self.version()
+        if version != self._version:
+            logger.info(f'Index version changed from {self._version} to {version}, clearing semantic cache')
+            self._version = version
+            self._entries.clear()
+            self._matrix = None
+
+    def _expire(self):
+        # Entries are kept in insertion order refreshed on access, so expired ones can be anywhere
+        now = self.clock()
+        expired = [key for key, entry in self._entries.items() if now - entry.created > self.ttl]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def lookup(self, vector: List[float]) -> Optional[CacheEntry]:
+        """
+        Find the entry of the most similar question at or above the similarity threshold.
+        :param vector: Embedding of the question
+        :return:
+        """
+        vector = _unit(vector)
+        with self._lock:
+            self._check_version()
+            self._expire()
+            if self._entries and self._matrix is None:
+                self._keys = list(self._entries)
+                self._matrix = np.stack([self._entries[key].vector for key in self._keys])
+
+            entry = None
+            if self._entries:
+                scores = self._matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    entry = self._entries[self._keys[best]]
+                    self._entries.move_to_end(self._keys[best])
+
+            if entry:
+                self.hits += 1
+                self.seconds_saved += entry.seconds
+            else:
+                self.misses += 1
+            return entry
+
+    def store(self, question: str, vector: List[float], value: Any, seconds: float):
+        """
+        Store the answer to a question.
+        :param question:
+        :param vector: Embedding of the question
+        :param value:
+        :param seconds: Time it took to answer the question, counted as saved on every hit
+        :return:
+        """
+        with self._lock:
+            self._check_version()
+            self._entries[question] = CacheEntry(question, _unit(vector), value, seconds, self.clock())
+            self._entries.move_to_end(question)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def log(self):
+        logger.info(
+            f'Semantic cache: {self.hits} hits, {self.misses} misses ({self.hit_rate:.0%} hit rate), '
+            f'{self.seconds_saved:.1f}s saved'
+        )
+
+
+class SemanticCacheChain(Chain):
+    """
+    Answers questions from a `SemanticCache` in front of another chain, such as `DocumentAssistantChain`.
+
+    Only turns with at most `max_history` earlier user messages are cached, as later answers depend on the
+    conversation. Cached outputs include the full `AssistantMessage` with its citations and follow-ups.
+    """
+
+    chain: Chain
+    embeddings: Embeddings
+    cache: SemanticCache
+    max_history: int = 0
+    metrics: Optional[MetricsRegistry] = None
+    """Counts hits and misses, and the seconds saved by hits."""
+
+    @property
+    def input_keys(self) -> List[str]:
+        return self.chain.input_keys
+
+    @property
+    def output_keys(self) -> List[str]:
+        return self.chain.output_keys
+
+    def _lookup(self, vector: List[float]) -> Optional[CacheEntry]:
+        entry = self.cache.lookup(vector)
+        if self.metrics is not None:
+            self.metrics.increment('cache_hits_total' if entry else 'cache_misses_total', cache='semantic')
+            if entry:
+                self.metrics.increment('cache_seconds_saved_total', entry.seconds, cache='semantic')
+        if entry:
+            logger.info(f'Answering from semantic cache, similar to: {entry.question}')
+            self.cache.log()
+        return entry
+
+    def cacheable(self, inputs: Dict[str, Any]) -> bool:
+        history = inputs.get('history') or []
+        return sum(role_from_message(message) == 'user' for message in history) <= self.max_history
+
+    def _call(
+            self,
+            inputs: Dict[str, Any],
+            run_manager: Optional[CallbackManagerForChainRun] = None
+        ) -> Dict[str, Any]:
+        if not self.cacheable(inputs):
+            return self.chain(inputs, return_only_outputs=True)
+
+        vector = self.embeddings.embed_query(inputs['input'])
+        if entry := self._lookup(vector):
+            return entry.value
+
+        start = time.perf_counter()
+        outputs = self.chain(inputs, return_only_outputs=True)
+        self.cache.store(inputs['input'], vector, outputs, time.perf_counter() - start)
+        return outputs
+
+    async def _acall(
+            self,
+            inputs: Dict[str, Any],
+            run_manager: Optional[AsyncCallbackManagerForChainRun] = None
+        ) -> Dict[str, Any]:
+        if not self.cacheable(inputs):
+            return await self.chain.acall(inputs, return_only_outputs=True)
+
+        vector = await self.embeddings.aembed_query(inputs['input'])
+        if entry := self._lookup(vector):
+            return entry.value
+
+        start = time.perf_counter()
+        outputs = await self.chain.acall(inputs, return_only_outputs=True)
+        self.cache.store(inputs['input'], vector, outputs, time.perf_counter() - start)
+        return outputs
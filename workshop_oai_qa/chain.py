@@ -1,18 +1,117 @@
+import asyncio
+import contextvars
+import json
 import re
-from typing import Dict, Any, Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, Optional, List, Tuple
 import logging
 
-from langchain.callbacks.manager import CallbackManagerForChainRun
+from langchain.callbacks.manager import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
 from langchain.chains.base import Chain
-from langchain.schema import ChatMessage, Document
+from langchain.pydantic_v1 import Field
+from langchain.callbacks.base import BaseCallbackManager
+from langchain.schema import AIMessage, BaseMessage, ChatMessage, Document
 from langchain.schema.language_model import BaseLanguageModel
 from langchain.schema.vectorstore import VectorStoreRetriever
 
-from workshop_oai_qa.prompts.query_generation import QUERY_GENERATION_PROMPT
-from workshop_oai_qa.prompts.retrieval_qa import RetrievalQAPrompt
+from workshop_oai_qa.cache import Cache, normalize_input
+from workshop_oai_qa.metrics import MetricsRegistry, Span
+from workshop_oai_qa.prompts.query_generation import MULTI_QUERY_GENERATION_PROMPT, QUERY_GENERATION_PROMPT
+from workshop_oai_qa.prompts.retrieval_qa import PromptAssembly, RetrievalQAPrompt
+from workshop_oai_qa.rerank import Reranker
+from workshop_oai_qa.scheduler import Scheduler
+from workshop_oai_qa.singleflight import SingleFlight
+from workshop_oai_qa.streaming import (
+    CitationEvent,
+    FollowUpEvent,
+    ReplyCallbackHandler,
+    ReplyEvent,
+    ReplyParser,
+    TextEvent,
+)
+from workshop_oai_qa.utils import reciprocal_rank_fusion
 
 logger = logging.getLogger(__name__)
 
+# Expected completion tokens of a search query, counted against the quota when admitting query generation
+QUERY_COMPLETION_TOKENS = 50
+
+# Runs speculative and fanned out retrievals concurrently in synchronous calls, and reranking in asynchronous ones
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='retrieval')
+
+
+def query_similarity(a: str, b: str) -> float:
+    """
+    Jaccard similarity of the lowercase words of two queries.
+    :param a:
+    :param b:
+    :return:
+    """
+    a, b = set(re.findall(r'\w+', a.lower())), set(re.findall(r'\w+', b.lower()))
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def fuse_documents(rankings: List[List[Document]], k: int) -> List[Document]:
+    """
+    Fuse ranked document lists by reciprocal rank fusion, counting documents with the same source and content,
+    which make up the chunk ID, once.
+    :param rankings:
+    :param k: Number of documents to return
+    :return:
+    """
+    documents = {}
+    keys = []
+    for ranking in rankings:
+        keys.append([])
+        for doc in ranking:
+            key = (doc.metadata.get('source'), doc.page_content)
+            documents.setdefault(key, doc)
+            keys[-1].append(key)
+
+    return [documents[key] for key, _ in reciprocal_rank_fusion(keys)[:k]]
+
+
+def _reply_handlers(callbacks) -> List[ReplyCallbackHandler]:
+    """Callback handlers that receive the parsed events of the streamed reply."""
+    if isinstance(callbacks, BaseCallbackManager):
+        callbacks = callbacks.handlers
+    return [handler for handler in callbacks or [] if isinstance(handler, ReplyCallbackHandler)]
+
+
+def _chunk_content(chunk) -> str:
+    # Chat models stream message chunks, other language models stream strings
+    return chunk.content if isinstance(chunk, BaseMessage) else chunk
+
+
+class _AnswerStream:
+    """
+    Collects the streamed answer of a chain, dispatching its parsed events to the reply handlers and timing it on the
+    answer generation span.
+    """
+
+    def __init__(self, chain: 'DocumentAssistantChain', span: Span, sources: Dict[str, Document], callbacks):
+        self.chain = chain
+        self.span = span
+        self.sources = sources
+        self.handlers = _reply_handlers(callbacks)
+        self.parser = ReplyParser(sources)
+        self.content: List[str] = []
+
+    def feed(self, chunk):
+        text = _chunk_content(chunk)
+        # Streams can open with empty deltas, such as the one holding the role, so the first token is the first text
+        if text:
+            self.span.token()
+        self.content.append(text)
+        self.chain._dispatch(self.parser.feed(text), self.sources, self.handlers)
+
+    def finish(self) -> str:
+        self.chain._dispatch(self.parser.finish(), self.sources, self.handlers)
+        text = ''.join(self.content)
+        # Chunks can hold several tokens or none, so the completion is counted with the tokenizer of the prompt
+        self.span.record_completion(self.chain.prompt.count_tokens(text))
+        return text
+
 
 class AssistantMessage(ChatMessage):
     role: str = 'assistant'
@@ -32,19 +131,313 @@ class DocumentAssistantChain(Chain):
     def output_keys(self) -> List[str]:
         """Keys expected to be in the chain output."""
         return [
-            'query', 'documents', 'messages', 'response', 'reply', 'follow_ups', 'citations'
+            'query', 'documents', 'messages', 'response', 'reply', 'follow_ups', 'citations', 'prompt_tokens'
         ]
 
     llm: BaseLanguageModel
     retriever: VectorStoreRetriever
+    prompt: RetrievalQAPrompt = Field(default_factory=RetrievalQAPrompt)
+
+    speculative_retrieval: bool = False
+    """Retrieve documents for the raw input while the search query is generated."""
+    reuse_threshold: float = 0.8
+    """Reuse the speculative documents if the query is at least this similar to the input, discard them if not."""
+    multi_query: bool = False
+    """Generate a query per part of the question, retrieve them concurrently and fuse the results."""
+    max_queries: int = 3
+
+    query_cache: Optional[Cache] = None
+    """Caches generated search queries by normalized input."""
+    retrieval_cache: Optional[Cache] = None
+    """Caches retrieved documents by index version and search query."""
+    index_version: Optional[Callable[[], str]] = None
+    """Identifies the indexed documents, so cached retrieval results are not used after reindexing."""
+
+    metrics: Optional[MetricsRegistry] = None
+    """Records the wall time, token counts and documents of each stage of a run."""
+    search_flights: Optional[SingleFlight] = None
+    """Runs concurrent searches for the same query, e.g. from different sessions, as a single retrieval."""
+
+    scheduler: Optional[Scheduler] = None
+    """Admits requests to the chat model within its quota, at the priority of the calling context."""
+    completion_tokens: int = 500
+    """Expected completion tokens of an answer, counted against the quota with the prompt tokens."""
+
+    reranker: Optional[Reranker] = None
+    """Rescores the retrieved documents, so the most relevant ones go into the prompt first."""
+    rerank_max_tokens: Optional[int] = None
+    """Token budget of the reranked documents, only the best ones that fit are kept. Unlimited if not set."""
+
+    def _query_generation_messages(self, input: str) -> List[BaseMessage]:
+        if self.multi_query:
+            return MULTI_QUERY_GENERATION_PROMPT.format_messages(input=input, max_queries=self.max_queries)
+        return QUERY_GENERATION_PROMPT.format_messages(input=input)
+
+    def span(self, stage: str) -> Span:
+        """
+        Context manager timing a stage of a run, recorded in `metrics` if set.
+        :param stage:
+        :return:
+        """
+        return Span(self.metrics, stage)
+
+    def _record_query_tokens(self, span: Span, messages: List[BaseMessage], query: str):
+        if self.metrics is not None:
+            span.record('prompt_tokens', sum(self.prompt.message_tokens(message) for message in messages))
+            span.record('completion_tokens', self.prompt.count_tokens(query))
+
+    def _query_tokens(self, messages: List[BaseMessage]) -> int:
+        return sum(self.prompt.message_tokens(message) for message in messages) + QUERY_COMPLETION_TOKENS
 
     def generate_search_query(self, input: str):
         """Generate a search query from the input question."""
-        messages = QUERY_GENERATION_PROMPT.format_messages(input=input)
-        response = self.llm.invoke(messages)
+        messages = self._query_generation_messages(input)
+        if self.scheduler is not None:
+            self.scheduler.acquire(self._query_tokens(messages))
+        with self.span('query_generation') as span:
+            response = self.llm.invoke(messages)
+            self._record_query_tokens(span, messages, response.content)
+
+        return response.content
+
+    async def agenerate_search_query(self, input: str):
+        """Generate a search query from the input question without blocking the event loop."""
+        messages = self._query_generation_messages(input)
+        if self.scheduler is not None:
+            await self.scheduler.aacquire(self._query_tokens(messages))
+        with self.span('query_generation') as span:
+            response = await self.llm.ainvoke(messages)
+            self._record_query_tokens(span, messages, response.content)
 
         return response.content
 
+    def split_queries(self, query: str, input: str) -> List[str]:
+        """
+        Split generated search queries into one query per line, falling back to the input if there are none.
+        :param query:
+        :param input:
+        :return:
+        """
+        queries = []
+        for line in query.splitlines():
+            line = re.sub(r'^\s*(?:[-*]|\d+[.)])\s*', '', line).strip()
+            if line and line != '0' and line not in queries:
+                queries.append(line)
+        return queries[:self.max_queries] or [input]
+
+    def _query_cache_key(self, input: str) -> str:
+        return f'{"multi" if self.multi_query else "single"}:{normalize_input(input)}'
+
+    def _count_cache(self, cache: str, value: Any):
+        if self.metrics is not None:
+            self.metrics.increment('cache_hits_total' if value is not None else 'cache_misses_total', cache=cache)
+
+    def _cached_query(self, input: str) -> Optional[str]:
+        if self.query_cache is None:
+            return None
+        query = self.query_cache.get(self._query_cache_key(input))
+        self._count_cache('queries', query)
+        return query
+
+    def _cache_query(self, input: str, query: str):
+        if self.query_cache is not None:
+            self.query_cache.set(self._query_cache_key(input), query)
+
+    def _retrieval_cache_key(self, query: str) -> str:
+        version = self.index_version() if self.index_version else ''
+        return f'{version}:{json.dumps(self.retriever.search_kwargs, sort_keys=True)}:{query}'
+
+    def _cached_documents(self, query: str) -> Optional[List[Document]]:
+        if self.retrieval_cache is None:
+            return None
+        documents = self.retrieval_cache.get(self._retrieval_cache_key(query))
+        self._count_cache('retrieval', documents)
+        return [Document(**doc) for doc in documents] if documents is not None else None
+
+    def _cache_documents(self, query: str, documents: List[Document]):
+        if self.retrieval_cache is not None:
+            self.retrieval_cache.set(
+                self._retrieval_cache_key(query),
+                [{'page_content': doc.page_content, 'metadata': doc.metadata} for doc in documents],
+            )
+
+    def search(self, query: str, stage: str = 'retrieval') -> List[Document]:
+        """
+        Retrieve the documents of a search query, from the retrieval cache if possible.
+        :param query:
+        :param stage: Stage the search is recorded as, speculative searches are kept apart from the others
+        :return:
+        """
+        with self.span(stage) as span:
+            documents = self._cached_documents(query)
+            if documents is None:
+                documents = self._retrieve_documents(query)
+            span.record('documents', len(documents))
+        return documents
+
+    def _retrieve_documents(self, query: str) -> List[Document]:
+        def retrieve():
+            documents = self.retriever.get_relevant_documents(query)
+            self._cache_documents(query, documents)
+            return documents
+
+        if self.search_flights is None:
+            return retrieve()
+        return self.search_flights.do(self._retrieval_cache_key(query), retrieve)
+
+    async def asearch(self, query: str, stage: str = 'retrieval') -> List[Document]:
+        """
+        Retrieve the documents of a search query asynchronously, from the retrieval cache if possible.
+        :param query:
+        :param stage: Stage the search is recorded as, speculative searches are kept apart from the others
+        :return:
+        """
+        with self.span(stage) as span:
+            documents = self._cached_documents(query)
+            if documents is None:
+                documents = await self._aretrieve_documents(query)
+            span.record('documents', len(documents))
+        return documents
+
+    async def _aretrieve_documents(self, query: str) -> List[Document]:
+        async def retrieve():
+            documents = await self.retriever.aget_relevant_documents(query)
+            self._cache_documents(query, documents)
+            return documents
+
+        if self.search_flights is None:
+            return await retrieve()
+        return await self.search_flights.ado(self._retrieval_cache_key(query), retrieve)
+
+    @property
+    def _k(self) -> int:
+        return self.retriever.search_kwargs.get('k', 4)
+
+    def speculation_strategy(self, input: str, query: str) -> str:
+        """
+        Decide what to do with the documents retrieved for the raw input, based on how much the query differs.
+        :param input:
+        :param query:
+        :return: `reuse` or `discard`
+        """
+        return 'reuse' if query_similarity(input, query) >= self.reuse_threshold else 'discard'
+
+    def _degraded_query(self, input: str) -> Optional[str]:
+        """Search with the input as it is, saving a request to the chat model, when its scheduler is overloaded."""
+        if self.scheduler is None or not self.scheduler.overloaded:
+            return None
+        logger.info(f'Skipping query generation, {self.scheduler.depth} requests queued')
+        if self.metrics is not None:
+            self.metrics.increment('degraded_total', stage='query_generation')
+        return input
+
+    def retrieve(self, input: str) -> Tuple[str, List[Document]]:
+        """
+        Generate a search query from the input question and retrieve the relevant documents.
+        :param input:
+        :return: Search query and documents
+        """
+        # Queries of inputs seen before are known right away, leaving nothing to speculate on
+        query = self._cached_query(input) or self._degraded_query(input)
+        speculative = _executor.submit(contextvars.copy_context().run, self.search, input, 'speculative_retrieval') \
+            if self.speculative_retrieval and query is None else None
+
+        if query is None:
+            logger.info(f'Generating search query for input: {input}')
+            try:
+                query = self.generate_search_query(input)
+            except BaseException:
+                if speculative:
+                    speculative.cancel()
+                raise
+            self._cache_query(input, query)
+
+        strategy = self.speculation_strategy(input, query) if speculative else None
+        if strategy == 'reuse':
+            logger.info(f'Reusing speculative search results for query: {query}')
+            return query, speculative.result()
+        if strategy == 'discard':
+            # Only a search that has not started yet is dropped, a running one finishes and its results are ignored
+            speculative.cancel()
+
+        queries = self.split_queries(query, input) if self.multi_query else [query]
+        logger.info(f'Running search queries: {queries}')
+        if len(queries) > 1:
+            # The searches run at the priority of the caller
+            rankings = [future.result() for future in [
+                _executor.submit(contextvars.copy_context().run, self.search, q) for q in queries
+            ]]
+        else:
+            rankings = [self.search(queries[0])]
+        return query, rankings[0] if len(rankings) == 1 else fuse_documents(rankings, k=self._k)
+
+    async def aretrieve(self, input: str) -> Tuple[str, List[Document]]:
+        """
+        Generate a search query from the input question and retrieve the relevant documents asynchronously.
+        :param input:
+        :return: Search query and documents
+        """
+        query = self._cached_query(input) or self._degraded_query(input)
+        speculative = asyncio.ensure_future(self.asearch(input, 'speculative_retrieval')) \
+            if self.speculative_retrieval and query is None else None
+
+        if query is None:
+            logger.info(f'Generating search query for input: {input}')
+            try:
+                query = await self.agenerate_search_query(input)
+            except BaseException:
+                if speculative:
+                    speculative.cancel()
+                raise
+            self._cache_query(input, query)
+
+        strategy = self.speculation_strategy(input, query) if speculative else None
+        if strategy == 'reuse':
+            logger.info(f'Reusing speculative search results for query: {query}')
+            return query, await speculative
+        if strategy == 'discard':
+            # The task stops at its next await, a search already sent to the retriever is not recalled
+            speculative.cancel()
+
+        queries = self.split_queries(query, input) if self.multi_query else [query]
+        logger.info(f'Running search queries: {queries}')
+        rankings = list(await asyncio.gather(*(self.asearch(q) for q in queries)))
+        return query, rankings[0] if len(rankings) == 1 else fuse_documents(rankings, k=self._k)
+
+    def rerank(self, query: str, documents: List[Document]) -> List[Document]:
+        """
+        Order the retrieved documents by the reranker and keep the best ones that fit the rerank token budget.
+        :param query:
+        :param documents:
+        :return:
+        """
+        if self.reranker is None or not documents:
+            return documents
+
+        with self.span('rerank') as span:
+            budget = self.rerank_max_tokens if self.rerank_max_tokens is not None else float('inf')
+            included, tokens, candidate_tokens = [], 0, 0
+            for document, _ in self.reranker.rerank(query, documents):
+                document_tokens = self.prompt.document_tokens(document)
+                candidate_tokens += document_tokens
+                if tokens + document_tokens <= budget:
+                    included.append(document)
+                    tokens += document_tokens
+            span.record('candidates', len(documents))
+            span.record('documents', len(included))
+            span.record('candidate_tokens', candidate_tokens)
+            span.record('prompt_tokens_saved', candidate_tokens - tokens)
+        logger.info(f'Reranking kept {len(included)}/{len(documents)} documents, {tokens}/{candidate_tokens} tokens')
+        return included
+
+    async def arerank(self, query: str, documents: List[Document]) -> List[Document]:
+        """Rerank the retrieved documents in a worker thread, as scoring runs on the CPU."""
+        if self.reranker is None or not documents:
+            return documents
+        return await asyncio.get_running_loop().run_in_executor(
+            _executor, contextvars.copy_context().run, self.rerank, query, documents
+        )
+
     def extract_follow_ups(self, response: str):
         """
         Extract follow up questions prompts from the response text.
@@ -87,48 +480,100 @@ class DocumentAssistantChain(Chain):
         ) -> Dict[str, Any]:
         logger.info(f'Running chain with inputs: {inputs}')
 
-        # Generate search query from input question
-        logger.info(f'Generating search query for input: {inputs["input"]}')
-        query = self.generate_search_query(inputs['input'])
+        with self.span('turn'):
+            # Generate search query from input question and retrieve relevant documents
+            query, documents = self.retrieve(inputs['input'])
+            documents = self.rerank(query, documents)
 
-        # Retrieve relevant documents from search query
-        logger.info(f'Running search query: {query}')
-        documents = self.retriever.get_relevant_documents(query)
+            # Generate Q&A prompt from input question, retrieved documents and chat history
+            logger.info(f'Running Q&A')
+            prompt = self._assemble(inputs, documents)
+            messages = prompt.messages
 
-        # Generate Q&A prompt from input question, retrieved documents and chat history
-        logger.info(f'Running Q&A')
-        messages = RetrievalQAPrompt().format_messages(
-            input=inputs['input'],
-            history=inputs['history'],
-            documents=documents,
-        )
+            # Stream the response to the Q&A prompt, parsing citations and follow up questions as they arrive
+            sources = {doc.metadata['source']: doc for doc in prompt.documents}
+            if self.scheduler is not None:
+                self.scheduler.acquire(prompt.tokens + self.completion_tokens)
+            with self.span('answer_generation') as span:
+                stream = _AnswerStream(self, span, sources, inputs['callbacks'])
+                for chunk in self.llm.stream(messages, config={'callbacks': inputs['callbacks']}):
+                    stream.feed(chunk)
+                content = stream.finish()
 
-        # Generate response from Q&A prompt
-        response = self.llm.predict_messages(
-            messages,
-            callbacks=inputs['callbacks'],
-        )
-        reply = response.content
+        return self._outputs(query, sources, messages, AIMessage(content=content), prompt.tokens, stream.parser)
 
-        # Extract follow up questions and citations from response
-        logger.info('Extracting citations')
-        documents = {
-            doc.metadata['source']: doc
-            for doc in documents
-        }
-        citations = [
-            documents[citation]
-            for citation in self.extract_citations(reply)
-            if citation in documents
-        ]
+    async def _acall(
+            self,
+            inputs: Dict[str, Any],
+            run_manager: Optional[AsyncCallbackManagerForChainRun] = None
+        ) -> Dict[str, Any]:
+        logger.info(f'Running chain with inputs: {inputs}')
+
+        with self.span('turn'):
+            # Generate search query from input question and retrieve relevant documents
+            query, documents = await self.aretrieve(inputs['input'])
+            documents = await self.arerank(query, documents)
+
+            # Generate Q&A prompt from input question, retrieved documents and chat history
+            logger.info('Running Q&A')
+            prompt = self._assemble(inputs, documents)
+            messages = prompt.messages
+
+            # Stream the response to the Q&A prompt, parsing citations and follow up questions as they arrive
+            sources = {doc.metadata['source']: doc for doc in prompt.documents}
+            if self.scheduler is not None:
+                await self.scheduler.aacquire(prompt.tokens + self.completion_tokens)
+            with self.span('answer_generation') as span:
+                stream = _AnswerStream(self, span, sources, inputs['callbacks'])
+                async for chunk in self.llm.astream(messages, config={'callbacks': inputs['callbacks']}):
+                    stream.feed(chunk)
+                content = stream.finish()
+
+        return self._outputs(query, sources, messages, AIMessage(content=content), prompt.tokens, stream.parser)
 
-        logger.info('Extracting follow ups')
-        follow_ups = self.extract_follow_ups(reply)
+    def _assemble(self, inputs: Dict[str, Any], documents: List[Document]) -> PromptAssembly:
+        with self.span('prompt_assembly') as span:
+            prompt = self.prompt.assemble(
+                input=inputs['input'],
+                history=inputs['history'],
+                documents=documents,
+            )
+            span.record('prompt_tokens', prompt.tokens)
+            span.record('documents', len(prompt.documents))
+        logger.info(f'Prompt has {prompt.tokens} tokens')
+        return prompt
 
-        # Clean up response by removing follow-up questions and replacing citations
-        logger.info('Stripping reply')
-        reply = self.strip_follow_ups(reply)
-        reply = self.replace_citations(reply, citations=[doc.metadata['source'] for doc in citations])
+    def _dispatch(self, events: List[ReplyEvent], sources: Dict[str, Document], handlers: List[ReplyCallbackHandler]):
+        for event in events:
+            for handler in handlers:
+                if isinstance(event, TextEvent):
+                    handler.on_reply_text(event.text)
+                elif isinstance(event, CitationEvent):
+                    handler.on_reply_citation(event.number, sources[event.source])
+                elif isinstance(event, FollowUpEvent):
+                    handler.on_reply_follow_up(event.question)
+
+    def _outputs(
+            self,
+            query: str,
+            documents: Dict[str, Document],
+            messages: List[BaseMessage],
+            response: BaseMessage,
+            prompt_tokens: int,
+            parser: ReplyParser,
+    ) -> Dict[str, Any]:
+        """
+        Build the chain outputs from the response and the citations and follow-up questions parsed from it.
+        :param query:
+        :param documents: Documents included in the prompt by source
+        :param messages:
+        :param response:
+        :param prompt_tokens:
+        :param parser: Parser that was fed the complete response
+        :return:
+        """
+        citations = [documents[citation] for citation in parser.citations]
+        follow_ups = parser.follow_ups
 
         return {
             'query': query,
@@ -137,10 +582,11 @@ class DocumentAssistantChain(Chain):
             'response': response,
             'reply': AssistantMessage(
                 content=response.content,
-                formatted_content=reply,
+                formatted_content=parser.text.strip(),
                 follow_ups=follow_ups,
                 citations=citations
             ),
             'follow_ups': follow_ups,
             'citations': citations,
+            'prompt_tokens': prompt_tokens,
         }
@@ -0,0 +1,274 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Callable, Dict
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+
+from workshop_oai_qa.ratelimit import RateLimiter, is_rate_limit_error, retry_after
+from workshop_oai_qa.utils import num_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStats:
+    """
+    Thread-safe throughput counters of an embedding run.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.chunks = 0
+        self.tokens = 0
+        self.requests = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def record(self, chunks: int = 0, tokens: int = 0, requests: int = 0, retries: int = 0):
+        with self._lock:
+            self.chunks += chunks
+            self.tokens += tokens
+            self.requests += requests
+            self.retries += retries
+
+    @property
+    def elapsed(self) -> float:
+        return max(self.clock() - self.started, 1e-9)
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.chunks / self.elapsed
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.tokens / self.elapsed
+
+    def __str__(self):
+        return (
+            f'{self.chunks} chunks ({self.tokens} tokens) in {self.requests} requests, '
+            f'{self.retries} retries, {self.elapsed:.1f}s: '
+            f'{self.chunks_per_second:.1f} chunks/s, {self.tokens_per_second:.0f} tokens/s'
+        )
+
+
+class BatchEmbedder(Embeddings):
+    """
+    Embeds texts in batches through `embed_documents` of the wrapped model, keeping up to `max_workers`
+    requests in flight within the requests-per-minute and tokens-per-minute quota of the deployment.
+    """
+
+    def __init__(
+            self,
+            embeddings: Embeddings,
+            batch_size: int = 16,
+            max_workers: int = 4,
+            rate_limiter: Optional[RateLimiter] = None,
+            max_retries: int = 8,
+            backoff: float = 1.0,
+            max_backoff: float = 60.0,
+            length_function: Callable[[str], int] = num_tokens,
+            sleep=time.sleep,
+    ):
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.length_function = length_function
+        self.sleep = sleep
+        self.stats = EmbeddingStats()
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed a single batch in one request, backing off exponentially when the deployment returns a 429.
+        :param texts:
+        :return:
+        """
+        tokens = sum(self.length_function(text) for text in texts)
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(tokens)
+            try:
+                vectors = self.embeddings.embed_documents(texts)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+
+                wait = retry_after(e) or min(self.backoff * 2 ** attempt, self.max_backoff)
+                logger.warning(f'Rate limited, backing off for {wait:.1f}s (attempt {attempt + 1})')
+                self.stats.record(requests=1, retries=1)
+                self.rate_limiter.pause(wait)
+                continue
+
+            self.stats.record(chunks=len(texts), tokens=tokens, requests=1)
+            return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed all texts concurrently in batches of `batch_size`, preserving the input order.
+        :param texts:
+        :return:
+        """
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) <= 1:
+            return self.embed_batch(texts) if texts else []
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self.embed_batch, batches))
+
+        logger.info(f'Embedded {self.stats}')
+        return [vector for batch in results for vector in batch]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_batch([text])[0]
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Persistent embeddings cache in front of an embeddings model, shared by indexing and query time.
+
+    Vectors are stored as float32 blobs in SQLite, keyed by `namespace` (the model and deployment) and the hash of
+    the text. When the stored vectors exceed `max_bytes`, the least recently used ones are evicted. Their total size
+    is kept in the database, so processes sharing the file agree on it.
+    """
+
+    def __init__(self, embeddings: Embeddings, path: str, namespace: str, max_bytes: int = 1 << 30):
+        self.embeddings = embeddings
+        self.path = path
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed);
+            CREATE TABLE IF NOT EXISTS embeddings_size (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL);
+            INSERT OR IGNORE INTO embeddings_size (id, bytes)
+                SELECT 0, COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings;
+        ''')
+
+    def key(self, text: str) -> str:
+        return f'{self.namespace}:{hashlib.sha256(text.encode("utf-8")).hexdigest()}'
+
+    @property
+    def size(self) -> int:
+        """Total bytes of the stored vectors."""
+        with self._lock:
+            return self._conn.execute('SELECT bytes FROM embeddings_size').fetchone()[0]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _get(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self._lock, self._conn:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({",".join("?" * len(batch))})', batch
+                )
+                found.update((key, np.frombuffer(vector, dtype=np.float32).tolist()) for key, vector in rows)
+            self._conn.executemany(
+                'UPDATE embeddings SET accessed = ? WHERE key = ?', [(time.time(), key) for key in found]
+            )
+        return found
+
+    def _put(self, items: Dict[str, List[float]]):
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes(), time.time()) for key, vector in items.items()]
+        keys = list(items)
+        with self._lock, self._conn:
+            # Take the write lock first, so no other process changes the stored vectors until the size is updated
+            self._conn.execute('UPDATE embeddings_size SET bytes = bytes')
+            replaced = 0
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                replaced += self._conn.execute(
+                    f'SELECT SUM(LENGTH(vector)) FROM embeddings WHERE key IN ({",".join("?" * len(batch))})', batch
+                ).fetchone()[0] or 0
+            self._conn.executemany('INSERT OR REPLACE INTO embeddings (key, vector, accessed) VALUES (?, ?, ?)', rows)
+            size = self._resize(sum(len(row[1]) for row in rows) - replaced)
+            if size > self.max_bytes:
+                self._evict(size)
+
+    def _resize(self, delta: int) -> int:
+        self._conn.execute('UPDATE embeddings_size SET bytes = bytes + ?', (delta,))
+        return self._conn.execute('SELECT bytes FROM embeddings_size').fetchone()[0]
+
+    def _evict(self, size: int):
+        # Evict down to 90% of the limit, so eviction does not run on every insert
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute('SELECT key, LENGTH(vector) FROM embeddings ORDER BY accessed').fetchall()
+        evicted, freed = [], 0
+        for key, length in rows:
+            if size - freed <= target:
+                break
+            evicted.append((key,))
+            freed += length
+        self._conn.executemany('DELETE FROM embeddings WHERE key = ?', evicted)
+        self._resize(-freed)
+        logger.info(f'Evicted {len(evicted)} embeddings from cache')
+
+    def cached(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        Vectors of the texts that are in the cache, without embedding the others.
+        :param texts:
+        :return: Vector of each text, or None if it is not cached
+        """
+        keys = [self.key(text) for text in texts]
+        found = self._get(list(set(keys)))
+        return [found.get(key) for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.key(text) for text in texts]
+        found = self._get(list(set(keys)))
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._put(computed)
+            found.update(computed)
+
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self.key(text)
+        found = self._get([key])
+        with self._lock:
+            if key in found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if key in found:
+            return found[key]
+
+        vector = self.embeddings.embed_query(text)
+        self._put({key: vector})
+        return vector
+
+    def close(self):
+        self._conn.close()
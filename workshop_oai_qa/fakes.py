@@ -0,0 +1,324 @@
+"""
+Deterministic local stand-ins for the Azure OpenAI and Azure Search clients, used to test and benchmark
+the assistant without network access.
+"""
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult, Document
+from langchain.schema.messages import AIMessageChunk
+from langchain.schema.output import ChatGenerationChunk
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.vectorstore import VectorStore
+from openai.error import RateLimitError
+
+from workshop_oai_qa.indexing.writers import IndexWriter
+
+_QUERY_GENERATION = re.compile(r'^Generate search quer(?:y|ies) for: (.*)$', re.DOTALL)
+_SOURCE = re.compile(r'^([^\s:]+): ', re.MULTILINE)
+_WORD = re.compile(r'\w+')
+# Words with their trailing whitespace, and single punctuation characters, roughly like model tokens
+_TOKEN = re.compile(r'\w+\s*|[^\w\s]\s*|\s+')
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Embeddings model returning deterministic unit vectors derived from the text hash.
+
+    Every `rate_limit_every`-th request fails with a 429 `RateLimitError`, mimicking an exhausted deployment quota.
+    """
+
+    def __init__(self, size: int = 1536, latency: float = 0.0, rate_limit_every: int = 0, retry_after: float = None):
+        self.size = size
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+
+        self.requests = 0
+        self.rate_limited = 0
+        self.texts = 0
+        self._lock = threading.Lock()
+
+    def _request(self, count: int):
+        with self._lock:
+            self.requests += 1
+            limited = self.rate_limit_every and self.requests % self.rate_limit_every == 0
+            if limited:
+                self.rate_limited += 1
+            else:
+                self.texts += count
+
+        if self.latency:
+            time.sleep(self.latency)
+        if limited:
+            headers = {'retry-after': str(self.retry_after)} if self.retry_after is not None else {}
+            raise RateLimitError('Requests to the Embeddings Operation have exceeded the rate limit.',
+                                 http_status=429, headers=headers)
+
+    def vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        vector = np.random.default_rng(seed).standard_normal(self.size, dtype=np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._request(len(texts))
+        return [self.vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+
+class FakeEmbeddingsServer:
+    """
+    Local HTTP endpoint serving the OpenAI embeddings API from a `FakeEmbeddings`, answering its rate limit errors
+    with a 429 response and their `Retry-After` header. Use as context manager and point the client at `url`.
+    """
+
+    def __init__(self, embeddings: FakeEmbeddings):
+        self.embeddings = embeddings
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                texts = [body['input']] if isinstance(body['input'], str) else body['input']
+                try:
+                    vectors = server.embeddings.embed_documents(texts)
+                except RateLimitError as e:
+                    self._respond(429, {'error': {'message': str(e), 'type': 'requests', 'code': '429'}}, e.headers)
+                    return
+                data = [{'object': 'embedding', 'index': i, 'embedding': vector} for i, vector in enumerate(vectors)]
+                self._respond(200, {
+                    'object': 'list',
+                    'data': data,
+                    'model': body.get('model'),
+                    'usage': {'prompt_tokens': 0, 'total_tokens': 0},
+                })
+
+            def _respond(self, status: int, payload: dict, headers: Optional[Dict[str, str]] = None):
+                content = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def __enter__(self) -> 'FakeEmbeddingsServer':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def fake_num_tokens(text: str) -> int:
+    """
+    Approximate token count of a text by its words and punctuation, as tiktoken needs to download its encodings.
+    :param text:
+    :return:
+    """
+    return len(re.findall(r'\w+|[^\w\s]', text))
+
+
+def fake_response(messages: List[BaseMessage]) -> str:
+    """
+    Respond like the assistant would: a search query for query generation prompts, a summary for summarization
+    prompts, otherwise an answer citing the first source in the prompt followed by a follow-up question.
+    :param messages:
+    :return:
+    """
+    content = messages[-1].content
+    if match := _QUERY_GENERATION.match(content):
+        return match.group(1)
+    if content.endswith('New summary:'):
+        # Summaries keep a bounded number of the latest words
+        return ' '.join(_WORD.findall(content[:-len('New summary:')])[-50:])
+
+    sources = _SOURCE.findall(content.partition('\nSources:\n')[2])
+    citation = f' [{sources[0]}]' if sources else ''
+    return f'This is the answer.{citation}\n<<Can you tell me more?>>'
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model answering with `respond(messages)` after `latency` seconds, sleeping without blocking the event loop
+    when called asynchronously. Streamed answers arrive in word tokens, `token_latency` seconds apart.
+    """
+
+    respond: Callable[[List[BaseMessage]], str] = fake_response
+    latency: float = 0.0
+    token_latency: float = 0.0
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-chat'
+
+    def _result(self, messages: List[BaseMessage]) -> ChatResult:
+        self.calls += 1
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.respond(messages)))])
+
+    def _generate(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._result(messages)
+
+    async def _agenerate(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> ChatResult:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._result(messages)
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        self.calls += 1
+        return _TOKEN.findall(self.respond(messages))
+
+    def _stream(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        if self.latency:
+            time.sleep(self.latency)
+        for i, token in enumerate(self._tokens(messages)):
+            if i and self.token_latency:
+                time.sleep(self.token_latency)
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for i, token in enumerate(self._tokens(messages)):
+            if i and self.token_latency:
+                await asyncio.sleep(self.token_latency)
+            if run_manager:
+                await run_manager.on_llm_new_token(token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+class FakeVectorStore(VectorStore):
+    """
+    Vector store ranking its documents by the number of words they share with the query, after `latency` seconds.
+    With an `embedding` model, the query is embedded first, like Azure Cognitive Search does.
+    """
+
+    def __init__(self, documents: Iterable[Document] = (), latency: float = 0.0, embedding: Embeddings = None):
+        self.documents = list(documents)
+        self.latency = latency
+        self.embedding = embedding
+        self.searches = 0
+        self._words = []
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        self.documents.extend(
+            Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)
+        )
+        return [str(i) for i in range(len(self.documents) - len(texts), len(self.documents))]
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings = None, metadatas: Optional[List[dict]] = None,
+                   **kwargs: Any) -> 'FakeVectorStore':
+        store = cls(**kwargs)
+        store.add_texts(texts, metadatas)
+        return store
+
+    def _search(self, query: str, k: int) -> List[Document]:
+        self.searches += 1
+        # Words of the documents are computed once, so searching costs about as little as a real search service
+        for doc in self.documents[len(self._words):]:
+            self._words.append(set(_WORD.findall(doc.page_content.lower())))
+        words = set(_WORD.findall(query.lower()))
+        overlap = [len(words & doc_words) for doc_words in self._words]
+        return [self.documents[i] for i in sorted(range(len(overlap)), key=lambda i: -overlap[i])[:k]]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        if self.embedding:
+            self.embedding.embed_query(query)
+        if self.latency:
+            time.sleep(self.latency)
+        return self._search(query, k)
+
+    async def asimilarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        if self.embedding:
+            self.embedding.embed_query(query)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._search(query, k)
+
+
+class FakeIndexWriter(IndexWriter):
+    """
+    Index writer keeping the uploaded chunks in memory, taking `latency` seconds per request.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.documents: Dict[str, Document] = {}
+        self.requests = 0
+
+    def _request(self):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add(self, documents: List[Document], ids: List[str], vectors: List[List[float]]):
+        self._request()
+        self.documents.update(zip(ids, documents))
+
+    def delete(self, ids: List[str]):
+        self._request()
+        for id in ids:
+            self.documents.pop(id, None)
+
+    def update_metadata(self, metadatas: Dict[str, dict]):
+        self._request()
+        for id, metadata in metadatas.items():
+            if id in self.documents:
+                self.documents[id] = Document(page_content=self.documents[id].page_content, metadata=metadata)
@@ -0,0 +1,115 @@
+import logging
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from langchain.schema import BaseMessage, ChatMessage
+from langchain.schema.language_model import BaseLanguageModel
+from langchain.schema.messages import get_buffer_string
+
+from workshop_oai_qa.prompts.summarization import SUMMARIZATION_PROMPT
+from workshop_oai_qa.scheduler import Scheduler
+from workshop_oai_qa.utils import num_tokens
+
+logger = logging.getLogger(__name__)
+
+# Expected completion tokens of a summary, counted against the quota when admitting a summarization
+SUMMARY_COMPLETION_TOKENS = 300
+
+
+class HistorySummary(NamedTuple):
+    summary: str = ''
+    messages: int = 0
+    """Number of messages at the start of the history folded into the summary."""
+
+
+class HistoryCompactor:
+    """
+    Keeps the last `keep_turns` turns of a conversation verbatim and folds older turns into a running summary.
+
+    The summary is extended once `summarize_every` older turns have accumulated, rather than on every call, so at most
+    `keep_turns + summarize_every` turns are passed verbatim. The returned `HistorySummary` is meant to be kept with
+    the conversation, e.g. in the Streamlit session state, and passed to the next call.
+
+    With a `scheduler`, summarizations are admitted within the quota of the chat deployment like the other requests
+    to it.
+    """
+
+    def __init__(
+            self,
+            llm: BaseLanguageModel,
+            keep_turns: int = 3,
+            summarize_every: int = 3,
+            scheduler: Optional[Scheduler] = None,
+            length_function: Callable[[str], int] = num_tokens,
+    ):
+        self.llm = llm
+        self.keep_turns = keep_turns
+        self.summarize_every = summarize_every
+        self.scheduler = scheduler
+        self.length_function = length_function
+
+        self.summaries = 0
+
+    def _pending(self, history: List[BaseMessage], state: HistorySummary) -> List[BaseMessage]:
+        """Older messages that are not yet in the summary, if there are enough to summarize."""
+        older = history[state.messages:max(len(history) - 2 * self.keep_turns, state.messages)]
+        return older if len(older) >= 2 * self.summarize_every else []
+
+    def _messages(self, history: List[BaseMessage], state: HistorySummary) -> List[BaseMessage]:
+        summary = [ChatMessage(role='system', content=f'Summary of the earlier conversation:\n{state.summary}')] \
+            if state.summary else []
+        return summary + history[state.messages:]
+
+    def _state(self, history: List[BaseMessage], state: Optional[HistorySummary]) -> HistorySummary:
+        # A shorter history than was summarized belongs to a new conversation
+        return state if state and state.messages <= len(history) else HistorySummary()
+
+    def _prompt(self, state: HistorySummary, pending: List[BaseMessage]):
+        logger.info(f'Summarizing {len(pending)} messages into the conversation summary')
+        self.summaries += 1
+        return SUMMARIZATION_PROMPT.format_messages(
+            summary=state.summary or '(empty)',
+            new_lines=get_buffer_string(pending, human_prefix='user', ai_prefix='assistant'),
+        )
+
+    def _tokens(self, prompt: List[BaseMessage]) -> int:
+        return sum(self.length_function(message.content) for message in prompt) + SUMMARY_COMPLETION_TOKENS
+
+    def compact(
+            self,
+            history: List[BaseMessage],
+            state: Optional[HistorySummary] = None,
+    ) -> Tuple[List[BaseMessage], HistorySummary]:
+        """
+        Compact the history of a conversation.
+        :param history:
+        :param state: Summary returned by the previous call for the same conversation
+        :return: Compacted history, and the summary to pass to the next call
+        """
+        state = self._state(history, state)
+        if pending := self._pending(history, state):
+            prompt = self._prompt(state, pending)
+            if self.scheduler is not None:
+                self.scheduler.acquire(self._tokens(prompt))
+            summary = self.llm.invoke(prompt).content
+            state = HistorySummary(summary=summary, messages=state.messages + len(pending))
+        return self._messages(history, state), state
+
+    async def acompact(
+            self,
+            history: List[BaseMessage],
+            state: Optional[HistorySummary] = None,
+    ) -> Tuple[List[BaseMessage], HistorySummary]:
+        """
+        Compact the history of a conversation without blocking the event loop.
+        :param history:
+        :param state: Summary returned by the previous call for the same conversation
+        :return: Compacted history, and the summary to pass to the next call
+        """
+        state = self._state(history, state)
+        if pending := self._pending(history, state):
+            prompt = self._prompt(state, pending)
+            if self.scheduler is not None:
+                await self.scheduler.aacquire(self._tokens(prompt))
+            summary = (await self.llm.ainvoke(prompt)).content
+            state = HistorySummary(summary=summary, messages=state.messages + len(pending))
+        return self._messages(history, state), state
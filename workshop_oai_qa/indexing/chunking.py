@@ -0,0 +1,136 @@
+import re
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from langchain.schema import Document
+
+from workshop_oai_qa.utils import get_encoding
+
+_HEADING = re.compile(r'^(#{1,6})\s+(.*?)\s*#*\s*$')
+_FENCE = re.compile(r'^\s*(`{3,}|~{3,})')
+
+
+class Block(NamedTuple):
+    text: str
+    start: int
+    headings: Tuple[str, ...]
+
+
+def split_blocks(text: str) -> List[Block]:
+    """
+    Split Markdown into blocks at heading and code fence boundaries, dropping HTML comments such as license headers.
+    Each block records its character offset in the text and the path of headings it is nested under.
+    :param text:
+    :return:
+    """
+    blocks = []
+    headings: List[Optional[str]] = [None] * 6
+    lines, start, offset = [], 0, 0
+    fence, in_comment = None, False
+
+    def flush():
+        block = ''.join(lines)
+        if block.strip():
+            blocks.append(Block(block, start, tuple(h for h in headings if h)))
+        lines.clear()
+
+    for line in text.splitlines(keepends=True):
+        if fence:
+            # Code blocks are kept whole, including any lines that look like headings
+            lines.append(line)
+            if line.strip().startswith(fence):
+                flush()
+                fence = None
+        elif in_comment:
+            in_comment = '-->' not in line
+        elif line.lstrip().startswith('<!--'):
+            flush()
+            in_comment = '-->' not in line
+        elif match := _FENCE.match(line):
+            flush()
+            fence, start = match.group(1), offset
+            lines.append(line)
+        elif match := _HEADING.match(line):
+            flush()
+            level = len(match.group(1))
+            headings[level - 1:] = [match.group(2)] + [None] * (6 - level)
+            start = offset
+            lines.append(line)
+        elif lines:
+            lines.append(line)
+        elif line.strip():
+            # Blocks start at their first non-blank line, so `start` points at the chunk content
+            start = offset
+            lines.append(line)
+        offset += len(line)
+
+    flush()
+    return blocks
+
+
+class MarkdownChunker:
+    """
+    Splits Markdown into chunks of at most `chunk_size` tokens along its heading and code fence structure.
+
+    Blocks are tokenized in a single batched pass per file and packed greedily into chunks, splitting blocks larger
+    than a chunk by lines. Chunk metadata holds the heading path, start offset and token count of the chunk.
+    """
+
+    def __init__(
+            self,
+            chunk_size: int = 1000,
+            encoding_name: str = 'cl100k_base',
+            length_function: Optional[Callable[[str], int]] = None,
+    ):
+        self.chunk_size = chunk_size
+        self.encoding_name = encoding_name
+        self.length_function = length_function
+
+    def _lengths(self, texts: List[str]) -> List[int]:
+        if self.length_function:
+            return [self.length_function(text) for text in texts]
+
+        return [len(tokens) for tokens in get_encoding(self.encoding_name).encode_ordinary_batch(texts)]
+
+    def _split_block(self, block: Block, tokens: int) -> List[Tuple[Block, int]]:
+        if tokens <= self.chunk_size:
+            return [(block, tokens)]
+
+        # Oversized blocks are split by lines, a single line longer than a chunk is kept whole
+        pieces, offset = [], block.start
+        for line in block.text.splitlines(keepends=True):
+            pieces.append(Block(line, offset, block.headings))
+            offset += len(line)
+        return list(zip(pieces, self._lengths([piece.text for piece in pieces])))
+
+    def _chunk(self, blocks: List[Tuple[Block, int]], metadata: dict) -> Document:
+        first = blocks[0][0]
+        return Document(
+            page_content=''.join(block.text for block, _ in blocks).strip(),
+            metadata={
+                **metadata,
+                'start_index': first.start,
+                'headings': ' > '.join(first.headings),
+                'tokens': sum(tokens for _, tokens in blocks),
+            },
+        )
+
+    def split_text(self, text: str, metadata: Optional[dict] = None) -> List[Document]:
+        blocks = split_blocks(text)
+        lengths = self._lengths([block.text for block in blocks])
+
+        chunks, current, current_tokens = [], [], 0
+        for block, tokens in zip(blocks, lengths):
+            for piece, piece_tokens in self._split_block(block, tokens):
+                if current and current_tokens + piece_tokens > self.chunk_size:
+                    chunks.append(self._chunk(current, metadata or {}))
+                    current, current_tokens = [], 0
+                current.append((piece, piece_tokens))
+                current_tokens += piece_tokens
+
+        if current:
+            chunks.append(self._chunk(current, metadata or {}))
+        return chunks
+
+    def split_file(self, source: str) -> List[Document]:
+        with open(source, encoding='utf-8') as f:
+            return self.split_text(f.read(), metadata={'source': source})
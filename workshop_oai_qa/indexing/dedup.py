@@ -0,0 +1,222 @@
+import logging
+import re
+import zlib
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+
+from workshop_oai_qa.indexing.manifest import Manifest, chunk_hash
+from workshop_oai_qa.indexing.pipeline import SourceChanges
+from workshop_oai_qa.utils import num_tokens
+
+logger = logging.getLogger(__name__)
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_WORD = re.compile(r'\w+')
+
+
+def shingles(text: str, size: int = 5) -> np.ndarray:
+    """
+    Hash the word `size`-shingles of a text into 32-bit integers.
+    :param text:
+    :param size:
+    :return:
+    """
+    words = _WORD.findall(text.lower())
+    grams = {' '.join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+    return np.fromiter((zlib.crc32(gram.encode('utf-8')) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+def _bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    Pick the number of LSH bands and rows per band whose S-curve threshold (1/b)^(1/r) is closest to `threshold`.
+    :param threshold:
+    :param num_perm:
+    :return:
+    """
+    candidates = [(num_perm // rows, rows) for rows in range(1, num_perm + 1)]
+    return min(candidates, key=lambda band: abs((1 / band[0]) ** (1 / band[1]) - threshold))
+
+
+class MinHashDeduplicator:
+    """
+    Drops chunks that are near-duplicates of an indexed chunk, before they are embedded.
+
+    Chunks are compared by the estimated Jaccard similarity of their word shingles using MinHash signatures,
+    with LSH banding to find candidates. The first occurrence is kept as canonical chunk and the sources of its
+    duplicates found in the same run are recorded in its `duplicates` metadata. Skipped tokens are taken from the
+    `tokens` metadata set by the markdown chunker, or counted with `length_function` for chunks without it.
+
+    For incremental runs, `seed` loads the signatures of the chunks indexed earlier and which chunk each skipped
+    duplicate maps to. When a canonical chunk is deleted, the sources of its duplicates are collected in `orphaned`,
+    so they can be indexed again.
+    """
+
+    def __init__(self, threshold: float = 0.9, num_perm: int = 128, shingle_size: int = 5, seed: int = 1,
+                 length_function: Callable[[str], int] = num_tokens):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.length_function = length_function
+        self.bands, self.rows = _bands(threshold, num_perm)
+
+        rng = np.random.RandomState(seed)
+        # Coefficients below 2^31 keep a * x + b within uint64 for 32-bit shingle hashes
+        self._a = rng.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+
+        self._buckets: List[Dict[bytes, List[str]]] = [defaultdict(list) for _ in range(self.bands)]
+        self._signatures: Dict[str, np.ndarray] = {}
+        self._exact: Dict[str, str] = {}
+        self._exact_keys: Dict[str, str] = {}
+        self._metadata: Dict[str, dict] = {}
+        # Per source the canonical chunk of each skipped chunk hash, and per canonical chunk the sources referring to it
+        self._duplicates: Dict[str, Dict[str, str]] = {}
+        self._referrers: Dict[str, Set[str]] = defaultdict(set)
+
+        self.orphaned: Set[str] = set()
+        self.duplicates = 0
+        self.tokens_avoided = 0
+        self.updated_ids = set()
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = shingles(text, self.shingle_size)
+        return ((np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME).min(axis=0)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def find(self, text: str) -> Tuple[str, np.ndarray]:
+        """
+        Find the canonical chunk a text is a near-duplicate of.
+        :param text:
+        :return: ID of the canonical chunk or None, and the signature of the text
+        """
+        signature = self.signature(text)
+        for band, key in zip(self._buckets, self._band_keys(signature)):
+            for id in band.get(key, ()):
+                if np.mean(self._signatures[id] == signature) >= self.threshold:
+                    return id, signature
+        return None, signature
+
+    def _add(self, id: str, signature: np.ndarray):
+        self._signatures[id] = signature
+        for band, key in zip(self._buckets, self._band_keys(signature)):
+            band[key].append(id)
+
+    def seed(self, manifest: Manifest):
+        """
+        Load the chunks indexed in earlier runs, so new chunks are also compared against unchanged files.
+        :param manifest:
+        :return:
+        """
+        for source in manifest.sources():
+            for id, signature in manifest.signatures(source).items():
+                signature = np.frombuffer(signature, dtype=np.uint64)
+                # Signatures of another number of permutations are not comparable
+                if len(signature) == self.num_perm:
+                    self._add(id, signature)
+            self._record_duplicates(source, manifest.duplicates(source))
+        logger.info(f'Loaded {len(self._signatures)} chunk signatures')
+
+    def _record_duplicates(self, source: str, duplicates: Dict[str, str]):
+        self._duplicates[source] = duplicates
+        for canonical in duplicates.values():
+            self._referrers[canonical].add(source)
+
+    def forget(self, source: str):
+        """
+        Forget which chunks a source had skipped as duplicates, e.g. once the source is removed or indexed again.
+        :param source:
+        :return:
+        """
+        for canonical in self._duplicates.pop(source, {}).values():
+            self._referrers[canonical].discard(source)
+
+    def remove(self, ids: Iterable[str]):
+        """
+        Remove deleted chunks, collecting the sources of their duplicates in `orphaned`.
+        :param ids: Index document IDs
+        :return:
+        """
+        for id in ids:
+            signature = self._signatures.pop(id, None)
+            if signature is not None:
+                for band, key in zip(self._buckets, self._band_keys(signature)):
+                    band[key].remove(id)
+            self._exact.pop(self._exact_keys.pop(id, None), None)
+            self._metadata.pop(id, None)
+            self.updated_ids.discard(id)
+            self.orphaned.update(self._referrers.pop(id, ()))
+
+    def filter(self, source: SourceChanges) -> SourceChanges:
+        """
+        Remove near-duplicate chunks from the chunks a source adds to the index.
+
+        Duplicates are left out of the recorded chunks of the source, so they are reconsidered once the source
+        changes instead of pointing at an index entry owned by another source. Chunks the source deletes are removed
+        first, so its remaining chunks are not matched against them.
+        :param source:
+        :return:
+        """
+        changes = source.changes
+        added, added_ids, chunks, duplicates = [], [], dict(changes.chunks), {}
+        self.forget(source.source)
+        self.remove(changes.deleted_ids)
+
+        for document, id in zip(changes.added, changes.added_ids):
+            content_hash = chunk_hash(document.page_content)
+            canonical = self._exact.get(content_hash)
+            signature = None
+            if canonical is None:
+                canonical, signature = self.find(document.page_content)
+
+            if canonical is None:
+                self._exact[content_hash] = id
+                self._exact_keys[id] = content_hash
+                self._add(id, signature)
+                self._metadata[id] = document.metadata
+                added.append(document)
+                added_ids.append(id)
+                continue
+
+            self.duplicates += 1
+            tokens = document.metadata.get('tokens')
+            self.tokens_avoided += tokens if tokens is not None else self.length_function(document.page_content)
+            # The metadata of canonical chunks indexed in earlier runs is not known, so it is not rewritten
+            if canonical in self._metadata:
+                self._metadata[canonical].setdefault('duplicates', []).append(document.metadata['source'])
+                self.updated_ids.add(canonical)
+            hash = chunk_hash(document.page_content, document.metadata)
+            chunks.pop(hash, None)
+            duplicates[hash] = canonical
+
+        self._record_duplicates(source.source, duplicates)
+        self.orphaned.discard(source.source)
+        return source._replace(changes=changes._replace(added=added, added_ids=added_ids, chunks=chunks))
+
+    def duplicate_chunks(self, source: str) -> Dict[str, str]:
+        """
+        Chunks of a source skipped as duplicates, see `Manifest.duplicates`.
+        :param source:
+        :return:
+        """
+        return dict(self._duplicates.get(source, {}))
+
+    def signatures(self, ids: Iterable[str]) -> Dict[str, bytes]:
+        """
+        Signatures of indexed chunks to store in the manifest, see `Manifest.signatures`.
+        :param ids: Index document IDs
+        :return:
+        """
+        return {id: self._signatures[id].tobytes() for id in ids if id in self._signatures}
+
+    def metadata(self, id: str) -> dict:
+        return self._metadata[id]
+
+    def log(self):
+        logger.info(
+            f'Skipped {self.duplicates} near-duplicate chunks ({self.tokens_avoided} tokens), '
+            f'{len(self.updated_ids)} canonical chunks have duplicates'
+        )
@@ -0,0 +1,115 @@
+import bisect
+import logging
+import time
+from functools import lru_cache
+from typing import Callable, List, NamedTuple, Dict, Optional
+
+from langchain.schema import Document
+
+from workshop_oai_qa.indexing.chunking import MarkdownChunker
+
+logger = logging.getLogger(__name__)
+
+
+class LoadedSource(NamedTuple):
+    source: str
+    chunks: List[Document]
+    seconds: float
+
+
+@lru_cache(maxsize=None)
+def _text_splitter(chunk_size: int, length_function: Optional[Callable[[str], int]] = None):
+    from langchain.text_splitter import CharacterTextSplitter
+
+    if length_function:
+        return CharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=0,
+            add_start_index=True,
+            length_function=length_function,
+        )
+    return CharacterTextSplitter.from_tiktoken_encoder(
+        chunk_size=chunk_size,
+        chunk_overlap=0,
+        add_start_index=True,
+    )
+
+
+@lru_cache(maxsize=None)
+def _markdown_chunker(chunk_size: int, length_function: Optional[Callable[[str], int]] = None):
+    return MarkdownChunker(chunk_size=chunk_size, length_function=length_function)
+
+
+CHUNKERS = ['unstructured', 'markdown']
+
+
+def load_and_split(
+        source: str,
+        chunk_size: int,
+        chunker: str = 'unstructured',
+        length_function: Optional[Callable[[str], int]] = None,
+) -> LoadedSource:
+    """
+    Load a Markdown file and split it into chunks of at most `chunk_size` tokens.
+
+    Defined at module level so it can run in worker processes, each keeping its own text splitter.
+    :param source: Path of the Markdown file
+    :param chunk_size:
+    :param chunker: `unstructured` to parse with Unstructured and split with tiktoken,
+                    `markdown` to split along the Markdown structure with `MarkdownChunker`
+    :param length_function: Token counter instead of tiktoken, must be picklable to run in worker processes
+    :return:
+    """
+    start = time.perf_counter()
+    if chunker == 'markdown':
+        chunks = _markdown_chunker(chunk_size, length_function).split_file(source)
+    elif chunker == 'unstructured':
+        from langchain.document_loaders import UnstructuredMarkdownLoader
+
+        chunks = _text_splitter(chunk_size, length_function).split_documents(UnstructuredMarkdownLoader(source).load())
+    else:
+        raise ValueError(f'Unexpected chunker: {chunker}')
+
+    return LoadedSource(source=source, chunks=chunks, seconds=time.perf_counter() - start)
+
+
+class ParseTimes:
+    """
+    Histogram of per-file parse times, to find pathological files.
+    """
+
+    BUCKETS = [0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0]
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+
+    def record(self, source: str, seconds: float):
+        self.seconds[source] = seconds
+
+    def histogram(self) -> List[int]:
+        """
+        Count files per bucket, the last bucket holding the files slower than the largest bound.
+        :return:
+        """
+        counts = [0] * (len(self.BUCKETS) + 1)
+        for seconds in self.seconds.values():
+            counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        return counts
+
+    def slowest(self, n: int = 5) -> List[tuple]:
+        return sorted(self.seconds.items(), key=lambda item: item[1], reverse=True)[:n]
+
+    def log(self):
+        if not self.seconds:
+            return
+
+        total = sum(self.seconds.values())
+        lines = [f'Parsed {len(self.seconds)} files in {total:.1f}s of CPU time:']
+        lower = 0.0
+        for upper, count in zip(self.BUCKETS + [float('inf')], self.histogram()):
+            label = f'{lower * 1000:>6.0f}ms - {upper * 1000:.0f}ms' if upper != float('inf') else f'> {lower:.0f}s'
+            lines.append(f'  {label:<20} {count:>5} {"#" * count}')
+            lower = upper
+        lines.append('Slowest files:')
+        lines.extend(f'  {seconds:.2f}s {source}' for source, seconds in self.slowest())
+        logger.info('\n'.join(lines))
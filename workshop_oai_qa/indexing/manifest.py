@@ -0,0 +1,287 @@
+import hashlib
+import json
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from typing import Dict, List, NamedTuple, Optional
+
+from langchain.schema import Document
+
+
+def file_hash(path: str, settings: str = '') -> str:
+    """
+    Hash the raw contents of a source file, together with the settings it is chunked with.
+    :param path:
+    :param settings: Chunking settings, so changing them reindexes the file even if it did not change
+    :return:
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    if settings:
+        digest.update(b'\0' + settings.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def chunk_hash(text: str, metadata: Optional[dict] = None) -> str:
+    """
+    Hash the content of a chunk, together with its metadata if given.
+    :param text:
+    :param metadata: Chunk metadata, so a chunk whose headings or source changed is uploaded again
+    :return:
+    """
+    digest = hashlib.sha256(text.encode('utf-8'))
+    if metadata:
+        digest.update(b'\0' + json.dumps(metadata, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def document_id(source: str, hash: str) -> str:
+    """
+    Deterministic index document ID of a chunk, unique per source file so identical chunks in different files
+    do not overwrite each other.
+    :param source:
+    :param hash:
+    :return:
+    """
+    return hashlib.sha256(f'{source}\n{hash}'.encode('utf-8')).hexdigest()[:32]
+
+
+class Manifest(ABC):
+    """
+    Records the hash of every indexed source file and the hash and index document ID of each of its chunks.
+
+    With deduplication, it also records the MinHash signatures of the indexed chunks and, per source, the chunks
+    skipped as near-duplicates with the index document ID of their canonical chunk.
+    """
+
+    @abstractmethod
+    def sources(self) -> List[str]:
+        """Sources currently recorded in the manifest."""
+
+    @abstractmethod
+    def file_hash(self, source: str) -> Optional[str]:
+        """Hash of the source file when it was last indexed."""
+
+    @abstractmethod
+    def chunks(self, source: str) -> Dict[str, str]:
+        """Mapping of chunk hash to index document ID of the chunks of a source."""
+
+    @abstractmethod
+    def duplicates(self, source: str) -> Dict[str, str]:
+        """Mapping of chunk hash to the index document ID of the canonical chunk, of skipped chunks of a source."""
+
+    @abstractmethod
+    def signatures(self, source: str) -> Dict[str, bytes]:
+        """MinHash signatures of the chunks of a source by index document ID."""
+
+    @abstractmethod
+    def update(
+            self,
+            source: str,
+            file_hash: str,
+            chunks: Dict[str, str],
+            duplicates: Optional[Dict[str, str]] = None,
+            signatures: Optional[Dict[str, bytes]] = None,
+    ):
+        """
+        Replace the recorded state of a source. Signatures of chunks that are still recorded are kept, so only those
+        of added chunks need to be passed.
+        """
+
+    @abstractmethod
+    def remove(self, source: str):
+        """Forget a source."""
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JsonManifest(Manifest):
+    """
+    Manifest kept in a JSON file, rewritten atomically after every change.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._data: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._data = json.load(f)
+
+    def _save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def sources(self) -> List[str]:
+        return list(self._data)
+
+    def file_hash(self, source: str) -> Optional[str]:
+        return self._data.get(source, {}).get('hash')
+
+    def chunks(self, source: str) -> Dict[str, str]:
+        return dict(self._data.get(source, {}).get('chunks', {}))
+
+    def duplicates(self, source: str) -> Dict[str, str]:
+        return dict(self._data.get(source, {}).get('duplicates', {}))
+
+    def signatures(self, source: str) -> Dict[str, bytes]:
+        return {id: bytes.fromhex(signature)
+                for id, signature in self._data.get(source, {}).get('signatures', {}).items()}
+
+    def update(
+            self,
+            source: str,
+            file_hash: str,
+            chunks: Dict[str, str],
+            duplicates: Optional[Dict[str, str]] = None,
+            signatures: Optional[Dict[str, bytes]] = None,
+    ):
+        ids = set(chunks.values())
+        kept = {id: signature for id, signature in self._data.get(source, {}).get('signatures', {}).items()
+                if id in ids}
+        kept.update((id, signature.hex()) for id, signature in (signatures or {}).items())
+        self._data[source] = {'hash': file_hash, 'chunks': dict(chunks)}
+        if duplicates:
+            self._data[source]['duplicates'] = dict(duplicates)
+        if kept:
+            self._data[source]['signatures'] = kept
+        self._save()
+
+    def remove(self, source: str):
+        if self._data.pop(source, None) is not None:
+            self._save()
+
+
+class SqliteManifest(Manifest):
+    """
+    Manifest kept in a SQLite database, suited for large corpora.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS files (source TEXT PRIMARY KEY, hash TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS chunks (
+                source TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                id TEXT NOT NULL,
+                PRIMARY KEY (source, hash)
+            );
+            CREATE TABLE IF NOT EXISTS duplicates (
+                source TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                canonical TEXT NOT NULL,
+                PRIMARY KEY (source, hash)
+            );
+            CREATE TABLE IF NOT EXISTS signatures (
+                source TEXT NOT NULL,
+                id TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                PRIMARY KEY (source, id)
+            );
+        ''')
+
+    def sources(self) -> List[str]:
+        return [row[0] for row in self._conn.execute('SELECT source FROM files')]
+
+    def file_hash(self, source: str) -> Optional[str]:
+        row = self._conn.execute('SELECT hash FROM files WHERE source = ?', (source,)).fetchone()
+        return row[0] if row else None
+
+    def chunks(self, source: str) -> Dict[str, str]:
+        return dict(self._conn.execute('SELECT hash, id FROM chunks WHERE source = ?', (source,)))
+
+    def duplicates(self, source: str) -> Dict[str, str]:
+        return dict(self._conn.execute('SELECT hash, canonical FROM duplicates WHERE source = ?', (source,)))
+
+    def signatures(self, source: str) -> Dict[str, bytes]:
+        return dict(self._conn.execute('SELECT id, signature FROM signatures WHERE source = ?', (source,)))
+
+    def update(
+            self,
+            source: str,
+            file_hash: str,
+            chunks: Dict[str, str],
+            duplicates: Optional[Dict[str, str]] = None,
+            signatures: Optional[Dict[str, bytes]] = None,
+    ):
+        ids = set(chunks.values())
+        with self._conn:
+            removed = [(source, id) for id in self.signatures(source) if id not in ids]
+            self._conn.executemany('DELETE FROM signatures WHERE source = ? AND id = ?', removed)
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO signatures (source, id, signature) VALUES (?, ?, ?)',
+                [(source, id, signature) for id, signature in (signatures or {}).items()],
+            )
+            self._conn.execute('DELETE FROM duplicates WHERE source = ?', (source,))
+            self._conn.executemany(
+                'INSERT INTO duplicates (source, hash, canonical) VALUES (?, ?, ?)',
+                [(source, hash, canonical) for hash, canonical in (duplicates or {}).items()],
+            )
+            self._conn.execute('DELETE FROM chunks WHERE source = ?', (source,))
+            self._conn.executemany(
+                'INSERT INTO chunks (source, hash, id) VALUES (?, ?, ?)',
+                [(source, hash, id) for hash, id in chunks.items()],
+            )
+            self._conn.execute('INSERT OR REPLACE INTO files (source, hash) VALUES (?, ?)', (source, file_hash))
+
+    def remove(self, source: str):
+        with self._conn:
+            for table in ('chunks', 'duplicates', 'signatures', 'files'):
+                self._conn.execute(f'DELETE FROM {table} WHERE source = ?', (source,))
+
+    def close(self):
+        self._conn.close()
+
+
+def open_manifest(path: str) -> Manifest:
+    """
+    Open a manifest, picking the backend from the file extension.
+    :param path: `.json` for a JSON manifest, anything else for SQLite
+    :return:
+    """
+    return JsonManifest(path) if path.endswith('.json') else SqliteManifest(path)
+
+
+class ChunkChanges(NamedTuple):
+    added: List[Document]
+    added_ids: List[str]
+    deleted_ids: List[str]
+    chunks: Dict[str, str]
+
+
+def diff_chunks(previous: Dict[str, str], source: str, documents: List[Document]) -> ChunkChanges:
+    """
+    Compare the freshly split chunks of a source against the ones recorded in the manifest.
+    :param previous: Recorded mapping of chunk hash to index document ID, see `Manifest.chunks`
+    :param source:
+    :param documents: Chunks of the source
+    :return: Chunks that need to be embedded and uploaded, index IDs that no longer exist and the new chunk mapping
+    """
+    chunks: Dict[str, str] = {}
+    added, added_ids = [], []
+
+    for document in documents:
+        hash = chunk_hash(document.page_content, document.metadata)
+        if hash in chunks:
+            continue
+
+        chunks[hash] = previous.get(hash) or document_id(source, hash)
+        if hash not in previous:
+            added.append(document)
+            added_ids.append(chunks[hash])
+
+    deleted_ids = [id for hash, id in previous.items() if hash not in chunks]
+
+    return ChunkChanges(added=added, added_ids=added_ids, deleted_ids=deleted_ids, chunks=chunks)
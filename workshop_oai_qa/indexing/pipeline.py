@@ -0,0 +1,200 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Executor
+from typing import Iterable, Iterator, List, TypeVar, NamedTuple, Callable, Optional
+
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+
+from workshop_oai_qa.indexing.manifest import ChunkChanges
+from workshop_oai_qa.indexing.writers import IndexWriter
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+_DONE = object()
+
+
+def buffered(iterable: Iterable[T], maxsize: int = 8) -> Iterator[T]:
+    """
+    Consume an iterable in a background thread, keeping at most `maxsize` items buffered ahead of the consumer.
+    Exceptions raised by the iterable are re-raised in the consumer.
+    :param iterable:
+    :param maxsize:
+    :return:
+    """
+    buffer = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stopped.is_set():
+                    try:
+                        buffer.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stopped.is_set():
+                    return
+            buffer.put((_DONE, None))
+        except BaseException as e:
+            buffer.put((_DONE, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+def batched(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class SourceChanges(NamedTuple):
+    source: str
+    file_hash: str
+    changes: ChunkChanges
+
+
+class _Chunk(NamedTuple):
+    document: Document
+    id: str
+    source: SourceChanges
+
+
+class IndexingStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.sources = 0
+        self.chunks = 0
+        self.batches = 0
+        self.first_upload: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def __str__(self):
+        first_upload = f'{self.first_upload:.1f}s' if self.first_upload is not None else 'n/a'
+        return (
+            f'{self.sources} sources, {self.chunks} chunks in {self.batches} batches, {self.elapsed:.1f}s '
+            f'(first upload after {first_upload})'
+        )
+
+
+def index_documents(
+        sources: Iterable[SourceChanges],
+        embeddings: Embeddings,
+        writer: IndexWriter,
+        batch_size: int = 16,
+        max_in_flight: int = 4,
+        on_source_indexed: Callable[[SourceChanges], None] = None,
+) -> IndexingStats:
+    """
+    Embed and upload the added chunks of each source in a streaming fashion.
+
+    Chunks are embedded in batches with up to `max_in_flight` requests running concurrently, and each batch is
+    uploaded as soon as it is embedded. Batches are uploaded in order, so `on_source_indexed` is called as soon as
+    all chunks of a source have been uploaded, which allows recording progress for resuming after a crash.
+    :param sources: Changes per source, typically a lazily loaded and split stream
+    :param embeddings:
+    :param writer:
+    :param batch_size: Number of chunks per embedding request and upload
+    :param max_in_flight: Maximum number of concurrent embedding requests
+    :param on_source_indexed: Called once all added chunks of a source have been uploaded
+    :return:
+    """
+    stats = IndexingStats()
+    remaining = {}
+
+    def source_done(source: SourceChanges):
+        stats.sources += 1
+        if on_source_indexed:
+            on_source_indexed(source)
+
+    def chunks() -> Iterator[_Chunk]:
+        for source in sources:
+            added = source.changes.added
+            if not added:
+                source_done(source)
+                continue
+
+            remaining[source.source] = len(added)
+            for document, id in zip(added, source.changes.added_ids):
+                yield _Chunk(document, id, source)
+
+    def upload(batch: List[_Chunk], vectors: List[List[float]]):
+        writer.add([chunk.document for chunk in batch], [chunk.id for chunk in batch], vectors)
+        stats.batches += 1
+        stats.chunks += len(batch)
+        if stats.first_upload is None:
+            stats.first_upload = stats.elapsed
+            logger.info(f'First {len(batch)} chunks uploaded after {stats.first_upload:.1f}s')
+
+        for chunk in batch:
+            remaining[chunk.source.source] -= 1
+            if remaining[chunk.source.source] == 0:
+                del remaining[chunk.source.source]
+                source_done(chunk.source)
+
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for batch in batched(chunks(), batch_size):
+            in_flight.append((batch, executor.submit(
+                embeddings.embed_documents, [chunk.document.page_content for chunk in batch]
+            )))
+            # Upload the oldest batch once enough requests are in flight, bounding the number of buffered chunks
+            if len(in_flight) >= max_in_flight:
+                batch, future = in_flight.popleft()
+                upload(batch, future.result())
+
+        while in_flight:
+            batch, future = in_flight.popleft()
+            upload(batch, future.result())
+
+    logger.info(f'Indexed {stats}')
+    return stats
+
+
+def ordered_map(fn: Callable[..., T], items: Iterable, executor: Optional[Executor] = None,
+                max_pending: int = 16) -> Iterator[T]:
+    """
+    Map `fn` over `items` on an executor, yielding results in input order while keeping at most `max_pending`
+    items submitted ahead of the consumer. Runs in the calling thread without an executor.
+    :param fn:
+    :param items:
+    :param executor: e.g. a `ProcessPoolExecutor` to use every CPU core
+    :param max_pending:
+    :return:
+    """
+    if executor is None:
+        yield from map(fn, items)
+        return
+
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,107 @@
+import base64
+import json
+from abc import ABC, abstractmethod
+from typing import List, Dict
+
+import numpy as np
+from langchain.schema import Document
+from langchain.vectorstores.azuresearch import (
+    AzureSearch,
+    FIELDS_ID,
+    FIELDS_CONTENT,
+    FIELDS_CONTENT_VECTOR,
+    FIELDS_METADATA,
+)
+
+from workshop_oai_qa.vectorstores.local import LocalVectorStore
+
+
+class IndexWriter(ABC):
+    """
+    Destination of the indexing pipeline, receiving chunks together with their precomputed embeddings.
+    """
+
+    @abstractmethod
+    def add(self, documents: List[Document], ids: List[str], vectors: List[List[float]]):
+        """Add or overwrite chunks under the given document IDs."""
+
+    @abstractmethod
+    def delete(self, ids: List[str]):
+        """Delete chunks by document ID."""
+
+    @abstractmethod
+    def update_metadata(self, metadatas: Dict[str, dict]):
+        """Replace the metadata of chunks already in the index, by document ID."""
+
+
+class AzureSearchWriter(IndexWriter):
+    """
+    Writes chunks to an Azure Cognitive Search index using the same document layout as `AzureSearch.add_texts`.
+    """
+
+    def __init__(self, vector_store: AzureSearch, batch_size: int = 1000):
+        self.vector_store = vector_store
+        self.batch_size = batch_size
+
+    @staticmethod
+    def key(id: str) -> str:
+        # Encoded the same way as `AzureSearch.add_texts` to only use characters valid in a key
+        return base64.urlsafe_b64encode(bytes(id, 'utf-8')).decode('ascii')
+
+    def _upload(self, data: List[dict]):
+        for i in range(0, len(data), self.batch_size):
+            response = self.vector_store.client.upload_documents(documents=data[i:i + self.batch_size])
+            if not all(r.succeeded for r in response):
+                raise Exception(response)
+
+    def add(self, documents: List[Document], ids: List[str], vectors: List[List[float]]):
+        field_names = {field.name for field in self.vector_store.fields}
+        data = []
+        for document, id, vector in zip(documents, ids, vectors):
+            data.append({
+                '@search.action': 'upload',
+                FIELDS_ID: self.key(id),
+                FIELDS_CONTENT: document.page_content,
+                FIELDS_CONTENT_VECTOR: np.array(vector, dtype=np.float32).tolist(),
+                FIELDS_METADATA: json.dumps(document.metadata),
+                **{k: v for k, v in document.metadata.items() if k in field_names},
+            })
+        self._upload(data)
+
+    def delete(self, ids: List[str]):
+        keys = [{FIELDS_ID: self.key(id)} for id in ids]
+        for i in range(0, len(keys), self.batch_size):
+            self.vector_store.client.delete_documents(documents=keys[i:i + self.batch_size])
+
+    def update_metadata(self, metadatas: Dict[str, dict]):
+        data = [
+            {'@search.action': 'merge', FIELDS_ID: self.key(id), FIELDS_METADATA: json.dumps(metadata)}
+            for id, metadata in metadatas.items()
+        ]
+        for i in range(0, len(data), self.batch_size):
+            response = self.vector_store.client.merge_documents(documents=data[i:i + self.batch_size])
+            if not all(r.succeeded for r in response):
+                raise Exception(response)
+
+
+class LocalVectorStoreWriter(IndexWriter):
+    """
+    Writes chunks to a `LocalVectorStore` directory.
+    """
+
+    def __init__(self, vector_store: LocalVectorStore):
+        self.vector_store = vector_store
+
+    def add(self, documents: List[Document], ids: List[str], vectors: List[List[float]]):
+        self.vector_store.add_embeddings(
+            [document.page_content for document in documents],
+            vectors,
+            metadatas=[document.metadata for document in documents],
+            ids=ids,
+        )
+
+    def delete(self, ids: List[str]):
+        self.vector_store.delete(ids)
+
+    def update_metadata(self, metadatas: Dict[str, dict]):
+        self.vector_store.update_metadata(metadatas)
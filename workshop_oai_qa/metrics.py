@@ -0,0 +1,257 @@
+import json
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Histogram:
+    """
+    Count and sum of all observations, and percentiles over the latest `max_samples` of them.
+    """
+
+    def __init__(self, max_samples: int = 10000):
+        self.count = 0
+        self.sum = 0.
+        self.samples: Deque[float] = deque(maxlen=max_samples)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def percentile(self, q: float) -> float:
+        """
+        :param q: Quantile between 0 and 1
+        :return:
+        """
+        return float(np.percentile(self.samples, q * 100)) if self.samples else 0.
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            **{f'p{int(q * 100)}': self.percentile(q) for q in QUANTILES},
+        }
+
+
+class MetricsRegistry:
+    """
+    Thread-safe in-process registry of counters and histograms, identified by name and labels.
+    """
+
+    def __init__(
+            self,
+            prefix: str = 'qa',
+            max_samples: int = 10000,
+            exporter: Optional['MetricsExporter'] = None,
+            clock=time.perf_counter,
+    ):
+        self.prefix = prefix
+        self.max_samples = max_samples
+        self.exporter = exporter
+        self.clock = clock
+
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1, **labels: str):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, _labels(labels))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.max_samples)
+            self.histograms[key].observe(value)
+
+    def histogram(self, name: str, **labels: str) -> Optional[Histogram]:
+        return self.histograms.get((name, _labels(labels)))
+
+    def counter(self, name: str, **labels: str) -> float:
+        return self.counters.get((name, _labels(labels)), 0)
+
+    def span(self, stage: str) -> 'Span':
+        return Span(self, stage, self.clock)
+
+    def snapshot(self) -> Dict[str, List[dict]]:
+        """
+        Current value of every counter and a summary of every histogram.
+        :return:
+        """
+        with self._lock:
+            return {
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'histograms': [
+                    {'name': name, 'labels': dict(labels), **histogram.summary()}
+                    for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])
+                ],
+            }
+
+    def export(self):
+        if self.exporter:
+            self.exporter.export(self)
+
+
+class Span:
+    """
+    Times a stage of a chain run as a context manager, recording its wall time and any values set on it as
+    histograms labeled with the stage. Without a registry nothing is recorded.
+    """
+
+    def __init__(self, registry: Optional[MetricsRegistry], stage: str, clock=time.perf_counter):
+        self.registry = registry
+        self.stage = stage
+        self.clock = clock
+        self.values: Dict[str, float] = {}
+        self.start = self.end = self.first_token = None
+
+    def __enter__(self) -> 'Span':
+        self.start = self.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = self.clock()
+        if self.registry is None:
+            return
+        if exc_type is not None:
+            self.registry.increment('stage_errors_total', stage=self.stage)
+            return
+        self.registry.observe('stage_seconds', self.seconds, stage=self.stage)
+        for name, value in self.values.items():
+            self.registry.observe(name, value, stage=self.stage)
+
+    @property
+    def seconds(self) -> float:
+        return (self.end if self.end is not None else self.clock()) - self.start
+
+    def record(self, name: str, value: float):
+        self.values[name] = value
+
+    def token(self):
+        """Mark a streamed token, the first one sets the time to first token."""
+        if self.first_token is None:
+            self.first_token = self.clock()
+            self.record('time_to_first_token_seconds', self.first_token - self.start)
+
+    def record_completion(self, tokens: int):
+        """
+        Record the completion tokens and the rate at which they were streamed after the first one.
+        :param tokens:
+        :return:
+        """
+        self.record('completion_tokens', tokens)
+        if self.first_token is not None:
+            self.record('tokens_per_second', tokens / max(self.clock() - self.first_token, 1e-9))
+
+
+class MetricsExporter(ABC):
+    """
+    Writes the metrics of a registry somewhere they can be scraped or read back.
+    """
+
+    @abstractmethod
+    def export(self, registry: MetricsRegistry):
+        pass
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+class PrometheusExporter(MetricsExporter):
+    """
+    Renders the registry in the Prometheus text format, histograms as summaries with quantiles. Written to `path`,
+    e.g. for the node exporter textfile collector, if given.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+
+    def render(self, registry: MetricsRegistry) -> str:
+        snapshot = registry.snapshot()
+        lines = []
+        typed = set()
+        for counter in snapshot['counters']:
+            name = f'{registry.prefix}_{counter["name"]}'
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{_format_labels(counter["labels"])} {counter["value"]}')
+
+        for histogram in snapshot['histograms']:
+            name = f'{registry.prefix}_{histogram["name"]}'
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} summary')
+            for q in QUANTILES:
+                labels = {**histogram['labels'], 'quantile': str(q)}
+                lines.append(f'{name}{_format_labels(labels)} {histogram[f"p{int(q * 100)}"]}')
+            lines.append(f'{name}_sum{_format_labels(histogram["labels"])} {histogram["sum"]}')
+            lines.append(f'{name}_count{_format_labels(histogram["labels"])} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, registry: MetricsRegistry):
+        if self.path is None:
+            return
+        # Replace the file at once, so a scrape never reads it half written
+        with open(f'{self.path}.tmp', 'w') as f:
+            f.write(self.render(registry))
+        os.replace(f'{self.path}.tmp', self.path)
+
+
+class JsonLinesExporter(MetricsExporter):
+    """
+    Appends a timestamped snapshot of the registry to a JSON lines file on every export.
+    """
+
+    def __init__(self, path: str, clock=time.time):
+        self.path = path
+        self.clock = clock
+
+    def export(self, registry: MetricsRegistry):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'time': self.clock(), **registry.snapshot()}) + '\n')
+
+
+class TimedEmbeddings(Embeddings):
+    """
+    Records the time spent embedding as the `embedding` stage, separating it from the search in retrieval timings.
+    """
+
+    def __init__(self, embeddings: Embeddings, metrics: MetricsRegistry):
+        self.embeddings = embeddings
+        self.metrics = metrics
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self.metrics.span('embedding'):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with self.metrics.span('embedding'):
+            return self.embeddings.embed_query(text)
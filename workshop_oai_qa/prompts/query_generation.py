@@ -27,3 +27,32 @@ QUERY_GENERATION_PROMPT = ChatPromptTemplate.from_messages(
         ("user", _PROMPT),
     ]
 )
+
+_MULTI_QUERY_SYSTEM_MESSAGE = _SYSTEM_MESSAGE.replace(
+    "Generate a search query based on the conversation and the new question.",
+    "Generate search queries based on the conversation and the new question. "
+    "If the question has several parts, generate a separate query for each part, at most {max_queries} queries. "
+    "Put each query on its own line, without numbering.",
+).replace("If you cannot generate a search query", "If you cannot generate any search query")
+
+_MULTI_QUERY_PROMPT = "Generate search queries for: {input}"
+
+MULTI_QUERY_GENERATION_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        ("system", _MULTI_QUERY_SYSTEM_MESSAGE),
+        FewShotChatMessagePromptTemplate(
+            example_prompt=ChatPromptTemplate.from_messages([
+                ("user", _MULTI_QUERY_PROMPT),
+                ("assistant", "{output}"),
+            ]),
+            examples=[
+                {"input": "What are my health plans?", "output": "Show available health plans"},
+                {
+                    "input": "does my plan cover cardio and what does the dental plan cost?",
+                    "output": "Health plan cardio coverage\nDental plan cost",
+                },
+            ],
+        ),
+        ("user", _MULTI_QUERY_PROMPT),
+    ]
+)
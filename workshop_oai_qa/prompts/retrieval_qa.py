@@ -1,9 +1,15 @@
-from typing import Any, List
+import logging
+from functools import lru_cache
+from typing import Any, Callable, List, NamedTuple, Optional, Tuple
 
 from langchain.prompts import ChatPromptTemplate, BaseChatPromptTemplate, FewShotChatMessagePromptTemplate
 from langchain.schema import BaseMessage, SystemMessage, HumanMessage, ChatMessage, Document
 from pydantic import validator, BaseModel
 
+from workshop_oai_qa.utils import num_tokens
+
+logger = logging.getLogger(__name__)
+
 _SYSTEM_PROMPT = """Assistant helps the company employees with their questions, By using companies knowledge base. Be brief in your answers.
 Answer ONLY with the facts listed in the list of sources below. If there isn't enough information below, say you don't know. Do not generate answers that don't use the sources below. If asking a clarifying question to the user would help, ask the question.
 For tabular information return it as an html table. Do not return markdown format. If the question is not in English, answer in the language used in the question.
@@ -40,34 +46,123 @@ _EXAMPLES = [
 ]
 
 
+# Tokens the chat format adds per message, and to prime the reply
+_TOKENS_PER_MESSAGE = 3
+_TOKENS_PER_REPLY = 3
+
+
+@lru_cache(maxsize=None)
+def _prefix_messages() -> Tuple[BaseMessage, ...]:
+    """System message and few-shot examples, which are the same for every question."""
+    return (
+        SystemMessage(content=_SYSTEM_PROMPT + '\n' + _FOLLOW_UP_QUESTIONS_PROMPT),
+        *FewShotChatMessagePromptTemplate(
+            example_prompt=ChatPromptTemplate.from_messages([
+                ("user", "{input}"),
+                ("assistant", "{output}"),
+            ]),
+            examples=_EXAMPLES,
+        ).format_messages(),
+    )
+
+
+_count_tokens = lru_cache(maxsize=16384)(num_tokens)
+
+
+class PromptAssembly(NamedTuple):
+    messages: List[BaseMessage]
+    tokens: int
+    documents: List[Document]
+    history: List[BaseMessage]
+
+
 class RetrievalQAPrompt(BaseChatPromptTemplate):
     input_variables: List[str] = ["input", "history", 'documents']
 
-    def format_messages(
+    max_tokens: Optional[int] = None
+    """Token budget of the prompt, unlimited if not set."""
+    encoding_name: str = 'cl100k_base'
+    length_function: Optional[Callable[[str], int]] = None
+    """Counts the tokens of a text, tiktoken with `encoding_name` if not set."""
+
+    def count_tokens(self, text: str) -> int:
+        return self.length_function(text) if self.length_function else _count_tokens(text, self.encoding_name)
+
+    def message_tokens(self, message: BaseMessage) -> int:
+        return _TOKENS_PER_MESSAGE + self.count_tokens(message.content)
+
+    def document_tokens(self, document: Document) -> int:
+        """
+        Count the tokens a document adds to the prompt, using the token count stored at indexing time if available.
+        :param document:
+        :return:
+        """
+        if 'tokens' in document.metadata:
+            return self.count_tokens(f'{document.metadata["source"]}: ') + int(document.metadata['tokens']) + 1
+        return self.count_tokens(self.format_document(document)) + 1
+
+    def prefix_tokens(self) -> int:
+        return sum(self.message_tokens(message) for message in _prefix_messages())
+
+    def assemble(
             self,
             input: str,
             history: List[BaseMessage],
             documents: List[Document],
-            **kwargs: Any
-    ) -> List[BaseMessage]:
+    ) -> PromptAssembly:
+        """
+        Assemble the prompt within the token budget, filled by priority: the question, the documents in order of
+        relevance, then the most recent history.
+        :param input:
+        :param history:
+        :param documents:
+        :return: Messages, their token count and the documents and history messages that were included
+        """
+        budget = self.max_tokens if self.max_tokens is not None else float('inf')
+        tokens = _TOKENS_PER_REPLY + self.prefix_tokens() + _TOKENS_PER_MESSAGE + self.count_tokens(input)
+
+        included = []
+        if documents:
+            tokens += self.count_tokens('\nSources:\n')
+            for document in documents:
+                document_tokens = self.document_tokens(document)
+                if tokens + document_tokens <= budget:
+                    included.append(document)
+                    tokens += document_tokens
+
+        recent = []
+        for message in reversed(history):
+            message_tokens = self.message_tokens(message)
+            if tokens + message_tokens > budget:
+                break
+            recent.insert(0, message)
+            tokens += message_tokens
+
+        if len(included) < len(documents) or len(recent) < len(history):
+            logger.info(f'Prompt budget of {self.max_tokens} tokens fits {len(included)}/{len(documents)} documents '
+                        f'and {len(recent)}/{len(history)} history messages')
+
         # Format documents into prompt
-        sources = self.format_documents(documents)
+        sources = self.format_documents(included)
 
         # Format input into prompt by including sources
-        question = f'{input}\nSources:\n{sources}' if documents else input
-
-        return [
-            SystemMessage(content=_SYSTEM_PROMPT + '\n' + _FOLLOW_UP_QUESTIONS_PROMPT),
-            *FewShotChatMessagePromptTemplate(
-                example_prompt=ChatPromptTemplate.from_messages([
-                    ("user", "{input}"),
-                    ("assistant", "{output}"),
-                ]),
-                examples=_EXAMPLES,
-            ).format_messages(),
-            *history,
+        question = f'{input}\nSources:\n{sources}' if included else input
+
+        messages = [
+            *_prefix_messages(),
+            *recent,
             ChatMessage(role='user', content=question),
         ]
+        return PromptAssembly(messages=messages, tokens=tokens, documents=included, history=recent)
+
+    def format_messages(
+            self,
+            input: str,
+            history: List[BaseMessage],
+            documents: List[Document],
+            **kwargs: Any
+    ) -> List[BaseMessage]:
+        return self.assemble(input, history, documents).messages
 
     def format_documents(self, documents: List[Document]) -> str:
         return '\n'.join([self.format_document(doc) for doc in documents])
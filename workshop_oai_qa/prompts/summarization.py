@@ -0,0 +1,21 @@
+from langchain.prompts import ChatPromptTemplate
+
+_SYSTEM_MESSAGE = """Progressively summarize the conversation between a user and an assistant answering questions from a knowledge base.
+Extend the current summary with the new lines of the conversation and return a new summary.
+Keep the questions asked, the facts in the answers and the names of the sources they cite. Leave out greetings, follow-up question suggestions and formatting such as html tables.
+Be brief, the summary replaces the earlier conversation in the prompt of the assistant."""
+
+_PROMPT = """Current summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:"""
+
+SUMMARIZATION_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        ("system", _SYSTEM_MESSAGE),
+        ("user", _PROMPT),
+    ]
+)
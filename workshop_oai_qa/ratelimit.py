@@ -0,0 +1,230 @@
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that refills continuously up to `capacity` every `period` seconds.
+    """
+
+    def __init__(self, capacity: float, period: float = 60.0, clock=time.monotonic, sleep=time.sleep):
+        if capacity <= 0:
+            raise ValueError(f'Token bucket capacity must be positive, got {capacity}')
+
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.clock = clock
+        self.sleep = sleep
+
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, amount: float = 1.0) -> float:
+        """
+        Take `amount` tokens if they are available.
+        :param amount: Number of tokens, clamped to the bucket capacity so large requests can still pass
+        :return: 0 if the tokens were taken, otherwise the number of seconds to wait before retrying
+        """
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            self._refill(self.clock())
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.rate
+
+    def acquire(self, amount: float = 1.0):
+        """
+        Block until `amount` tokens have been taken from the bucket.
+        :param amount:
+        :return:
+        """
+        while (wait := self.try_acquire(amount)) > 0:
+            self.sleep(wait)
+
+    def refund(self, amount: float = 1.0):
+        """
+        Return tokens that were taken for a request that was not sent after all.
+        :param amount:
+        :return:
+        """
+        with self._lock:
+            self._refill(self.clock())
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+    def drain(self):
+        """
+        Empty the bucket, e.g. after the server reported that the quota is exhausted.
+        :return:
+        """
+        with self._lock:
+            self._refill(self.clock())
+            self._tokens = 0.0
+
+
+class SqliteTokenBucket(TokenBucket):
+    """
+    Token bucket with its state in a SQLite database, so worker processes on the same machine share one quota.
+    Uses the wall clock, which all processes agree on.
+    """
+
+    def __init__(self, path: str, name: str, capacity: float, period: float = 60.0, clock=time.time,
+                 sleep=time.sleep):
+        super().__init__(capacity, period, clock=clock, sleep=sleep)
+        self.path = path
+        self.name = name
+
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+        ''')
+
+    def _update(self, fn: Callable[[float], Tuple[float, float]]) -> float:
+        """
+        Refill the stored bucket and replace its tokens by `fn(tokens)` in one transaction.
+        :param fn: Returns the new number of tokens and the result
+        :return:
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = self.clock()
+                row = self._conn.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (self.name,)).fetchone()
+                tokens, updated = row if row else (self.capacity, now)
+                tokens = min(self.capacity, tokens + max(now - updated, 0.0) * self.rate)
+                tokens, result = fn(tokens)
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)', (self.name, tokens, now)
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return result
+
+    def try_acquire(self, amount: float = 1.0) -> float:
+        amount = min(float(amount), self.capacity)
+
+        def take(tokens: float) -> Tuple[float, float]:
+            if tokens >= amount:
+                return tokens - amount, 0.0
+            return tokens, (amount - tokens) / self.rate
+
+        return self._update(take)
+
+    def refund(self, amount: float = 1.0):
+        self._update(lambda tokens: (min(self.capacity, tokens + amount), 0.0))
+
+    def drain(self):
+        self._update(lambda tokens: (0.0, 0.0))
+
+    def close(self):
+        self._conn.close()
+
+
+class RateLimiter:
+    """
+    Limits requests against an Azure OpenAI deployment quota in requests-per-minute and tokens-per-minute.
+
+    With a `path`, the quota is kept in SQLite under `name` and shared with other processes using the same path.
+    """
+
+    def __init__(
+            self,
+            requests_per_minute: Optional[float] = None,
+            tokens_per_minute: Optional[float] = None,
+            clock=None,
+            sleep=time.sleep,
+            path: Optional[str] = None,
+            name: str = 'default',
+    ):
+        # Processes sharing the quota agree on the wall clock only
+        self.clock = clock or (time.time if path else time.monotonic)
+        self.sleep = sleep
+
+        def bucket(capacity: float, kind: str) -> TokenBucket:
+            if path:
+                return SqliteTokenBucket(path, f'{name}:{kind}', capacity, clock=self.clock, sleep=sleep)
+            return TokenBucket(capacity, clock=self.clock, sleep=sleep)
+
+        self.requests = bucket(requests_per_minute, 'requests') if requests_per_minute else None
+        self.tokens = bucket(tokens_per_minute, 'tokens') if tokens_per_minute else None
+
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 0):
+        """
+        Block until a request costing `tokens` tokens fits within the quota.
+        :param tokens: Estimated token cost of the request
+        :return:
+        """
+        while (wait := self._paused_until - self.clock()) > 0:
+            self.sleep(wait)
+
+        if self.requests:
+            self.requests.acquire(1)
+        if self.tokens and tokens:
+            self.tokens.acquire(tokens)
+
+    def try_acquire(self, tokens: float = 0) -> float:
+        """
+        Take a request costing `tokens` tokens from the quota if it fits.
+        :param tokens: Estimated token cost of the request
+        :return: 0 if the request was admitted, otherwise the number of seconds to wait before retrying
+        """
+        if (wait := self._paused_until - self.clock()) > 0:
+            return wait
+        if self.requests and (wait := self.requests.try_acquire(1)) > 0:
+            return wait
+        if self.tokens and tokens and (wait := self.tokens.try_acquire(tokens)) > 0:
+            if self.requests:
+                self.requests.refund(1)
+            return wait
+        return 0.0
+
+    def pause(self, seconds: float):
+        """
+        Hold back all callers for `seconds`, used to back off after a 429 response. The buckets keep their tokens, so
+        callers resume as soon as the pause is over.
+        :param seconds:
+        :return:
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, self.clock() + seconds)
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """
+    Check whether an exception raised by an OpenAI client is a 429 response.
+    :param error:
+    :return:
+    """
+    status = getattr(error, 'http_status', None) or getattr(error, 'status_code', None)
+    return status == 429 or type(error).__name__ == 'RateLimitError'
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """
+    Read the `Retry-After` header of a rate limit error, if the server sent one.
+    :param error:
+    :return:
+    """
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        value = headers.get('retry-after') or headers.get('Retry-After')
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
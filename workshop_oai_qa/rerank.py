@@ -0,0 +1,115 @@
+import logging
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import List, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+from workshop_oai_qa.embeddings import CachedEmbeddings
+from workshop_oai_qa.vectorstores.bm25 import tokenize
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=16384)
+def _terms(text: str) -> frozenset:
+    """Distinct terms of a text, cached as the same chunks are retrieved turn after turn."""
+    return frozenset(tokenize(text))
+
+
+def lexical_overlap(query: str, documents: List[Document]) -> np.ndarray:
+    """
+    Fraction of the distinct query terms that occur in each document.
+    :param query:
+    :param documents:
+    :return:
+    """
+    terms = _terms(query)
+    if not terms:
+        return np.zeros(len(documents), dtype=np.float32)
+    return np.array(
+        [len(terms & _terms(doc.page_content)) / len(terms) for doc in documents], dtype=np.float32
+    )
+
+
+def _min_max(scores: np.ndarray) -> np.ndarray:
+    spread = scores.max() - scores.min() if len(scores) else 0
+    return (scores - scores.min()) / spread if spread > 0 else np.zeros_like(scores)
+
+
+class Reranker(ABC):
+    """
+    Rescores the documents retrieved for a query, to put the most relevant ones first.
+    """
+
+    @abstractmethod
+    def score(self, query: str, documents: List[Document]) -> np.ndarray:
+        """
+        Score the relevance of each document to the query, higher is more relevant.
+        :param query:
+        :param documents:
+        :return:
+        """
+
+    def rerank(self, query: str, documents: List[Document]) -> List[Tuple[Document, float]]:
+        """
+        Order the documents by their score, keeping the retrieval order of equal scores.
+        :param query:
+        :param documents:
+        :return: Documents with their scores, best first
+        """
+        if not documents:
+            return []
+        scores = self.score(query, documents)
+        return [(documents[i], float(scores[i])) for i in np.argsort(-scores, kind='stable')]
+
+
+class EmbeddingReranker(Reranker):
+    """
+    Scores documents by the cosine similarity of their embeddings to the query, mixed with the lexical overlap.
+
+    Document vectors are only read from `embeddings`, the cache the index was built with, so scoring is a single
+    matrix-vector product and never requests embeddings. Documents whose vectors are not cached are scored by their
+    lexical overlap alone. Similarities are min-max scaled over the candidates, as those of a retrieval result lie
+    close together.
+    """
+
+    def __init__(self, embeddings: CachedEmbeddings, lexical_weight: float = 0.3):
+        self.embeddings = embeddings
+        self.lexical_weight = lexical_weight
+
+    def score(self, query: str, documents: List[Document]) -> np.ndarray:
+        lexical = lexical_overlap(query, documents)
+        cached = self.embeddings.cached([doc.page_content for doc in documents])
+        rows = [i for i, vector in enumerate(cached) if vector is not None]
+        if len(rows) < len(documents):
+            logger.info(f'Reranking {len(documents) - len(rows)}/{len(documents)} documents without cached vectors')
+
+        similarity = lexical.copy()
+        if rows:
+            # The query was embedded through the same cache by the retriever
+            query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+            vectors = np.asarray([cached[i] for i in rows], dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector)
+            similarity[rows] = _min_max((vectors @ query_vector) / np.where(norms == 0, 1, norms))
+        return (1 - self.lexical_weight) * similarity + self.lexical_weight * lexical
+
+
+class CrossEncoderReranker(Reranker):
+    """
+    Scores query and document pairs with a small local cross-encoder, e.g. `cross-encoder/ms-marco-MiniLM-L-6-v2`.
+    Needs the `sentence-transformers` package, which is not installed by default.
+    """
+
+    def __init__(self, model_name: str = 'cross-encoder/ms-marco-MiniLM-L-6-v2', max_length: int = 512,
+                 batch_size: int = 32):
+        from sentence_transformers import CrossEncoder
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = CrossEncoder(model_name, max_length=max_length)
+
+    def score(self, query: str, documents: List[Document]) -> np.ndarray:
+        pairs = [(query, doc.page_content) for doc in documents]
+        return np.asarray(self.model.predict(pairs, batch_size=self.batch_size), dtype=np.float32)
@@ -5,15 +5,25 @@ from langchain.chat_models import AzureChatOpenAI
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.vectorstores import AzureSearch
 
+from workshop_oai_qa.cache import MemoryCache, SemanticCache, SemanticCacheChain, SqliteCache
 from workshop_oai_qa.chain import DocumentAssistantChain
+from workshop_oai_qa.embeddings import CachedEmbeddings
+from workshop_oai_qa.history import HistoryCompactor
+from workshop_oai_qa.metrics import JsonLinesExporter, MetricsRegistry, PrometheusExporter, TimedEmbeddings
+from workshop_oai_qa.prompts.retrieval_qa import RetrievalQAPrompt
+from workshop_oai_qa.ratelimit import RateLimiter
+from workshop_oai_qa.rerank import CrossEncoderReranker, EmbeddingReranker
+from workshop_oai_qa.scheduler import ScheduledEmbeddings, Scheduler
+from workshop_oai_qa.singleflight import SingleFlight, SingleFlightChain, SingleFlightEmbeddings
+from workshop_oai_qa.vectorstores.local import LocalVectorStore
 
 
 @st.cache_resource
-def conversation_chain():
+def chat_model():
     env_config = os.environ
 
     # Create Azure OpenAI Chat Model Client
-    llm = AzureChatOpenAI(
+    return AzureChatOpenAI(
         deployment_name=env_config["OPENAI_DEPLOYMENT_COMPLETION"],
         openai_api_base=env_config["OPENAI_API_BASE"],
         openai_api_version=env_config["OPENAI_API_VERSION"],
@@ -22,7 +32,65 @@ def conversation_chain():
         streaming=True
     )
 
-    # Create Azure OpenAI Embedding Model Client
+
+@st.cache_resource
+def metrics():
+    env_config = os.environ
+
+    # Export the per-stage timings after every turn, in Prometheus text format or as JSON lines
+    exporter = None
+    if path := env_config.get('METRICS_PATH'):
+        if env_config.get('METRICS_EXPORTER', 'prometheus') == 'jsonl':
+            exporter = JsonLinesExporter(path)
+        else:
+            exporter = PrometheusExporter(path)
+    return MetricsRegistry(exporter=exporter)
+
+
+@st.cache_resource
+def scheduler(kind: str, deployment: str):
+    env_config = os.environ
+
+    # Admit requests within the quota of a deployment, shared by all app processes through RATE_LIMIT_PATH
+    prefix = kind.upper()
+    requests_per_minute = env_config.get(f'{prefix}_REQUESTS_PER_MINUTE')
+    tokens_per_minute = env_config.get(f'{prefix}_TOKENS_PER_MINUTE')
+    if not requests_per_minute and not tokens_per_minute:
+        return None
+
+    return Scheduler(
+        RateLimiter(
+            requests_per_minute=float(requests_per_minute) if requests_per_minute else None,
+            tokens_per_minute=float(tokens_per_minute) if tokens_per_minute else None,
+            path=env_config.get('RATE_LIMIT_PATH') or None,
+            name=f'{kind}/{deployment}',
+        ),
+        degrade_depth=int(env_config.get('SCHEDULER_DEGRADE_DEPTH', 4)),
+        name=kind,
+        metrics=metrics(),
+    )
+
+
+@st.cache_resource
+def history_compactor():
+    env_config = os.environ
+
+    # Keep the latest turns verbatim and summarize older ones
+    return HistoryCompactor(
+        llm=chat_model(),
+        keep_turns=int(env_config.get('HISTORY_KEEP_TURNS', 3)),
+        summarize_every=int(env_config.get('HISTORY_SUMMARIZE_EVERY', 3)),
+        scheduler=scheduler('chat', env_config['OPENAI_DEPLOYMENT_COMPLETION']),
+    )
+
+
+@st.cache_resource
+def conversation_chain():
+    env_config = os.environ
+
+    llm = chat_model()
+
+    # Create Azure OpenAI Embedding Model Client, cached on disk to avoid embedding repeated queries again
     embeddings = OpenAIEmbeddings(
         model='text-embedding-ada-002',
         deployment=os.getenv('OPENAI_DEPLOYMENT_EMBEDDING'),
@@ -31,18 +99,105 @@ def conversation_chain():
         openai_api_key=env_config["OPENAI_API_KEY"],
         openai_api_type="azure",
     )
+    if embedding_scheduler := scheduler('embedding', os.getenv('OPENAI_DEPLOYMENT_EMBEDDING')):
+        embeddings = ScheduledEmbeddings(embeddings, embedding_scheduler)
+    embeddings = CachedEmbeddings(
+        embeddings,
+        path=env_config.get('EMBEDDING_CACHE_PATH', '.cache/embeddings.sqlite'),
+        namespace=f'text-embedding-ada-002/{os.getenv("OPENAI_DEPLOYMENT_EMBEDDING")}',
+    )
+    cached_embeddings = embeddings
+    embeddings = TimedEmbeddings(embeddings, metrics())
+
+    # Collapse identical requests of concurrent sessions into one upstream call
+    single_flight = env_config.get('SINGLE_FLIGHT', 'true').lower() == 'true'
+    if single_flight:
+        embeddings = SingleFlightEmbeddings(embeddings, SingleFlight('embeddings', metrics()))
+
+    # Create Vector Store Client, either Azure Cognitive Search or a local index written by the indexer
+    if env_config.get('VECTOR_STORE', 'azure') == 'local':
+        vector_store = LocalVectorStore(
+            path=env_config.get('LOCAL_VECTOR_STORE_PATH', '.index'),
+            embedding=embeddings,
+            search_type='hybrid',
+            n_probe=int(env_config.get('LOCAL_VECTOR_STORE_N_PROBE', 8)),
+            rescore=int(env_config.get('LOCAL_VECTOR_STORE_RESCORE', 4)),
+        )
+    else:
+        vector_store = AzureSearch(
+            azure_search_endpoint=env_config['AZURE_SEARCH_ENDPOINT'],
+            azure_search_key=env_config['AZURE_SEARCH_KEY'],
+            index_name=env_config['AZURE_SEARCH_INDEX'],
+            embedding_function=embeddings.embed_query,
+            search_type='hybrid',
+        )
+
+    # Retrieve wide and rerank locally, keeping the best documents that fit the token budget
+    reranker = None
+    if (rerank := env_config.get('RERANK', 'none').lower()) == 'embedding':
+        # Indexed chunks were embedded through the same cache, so their vectors are not requested again
+        reranker = EmbeddingReranker(
+            cached_embeddings,
+            lexical_weight=float(env_config.get('RERANK_LEXICAL_WEIGHT', 0.3)),
+        )
+    elif rerank == 'cross-encoder':
+        reranker = CrossEncoderReranker(env_config.get('RERANK_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2'))
+    k = int(env_config.get('RERANK_FETCH_K', 40)) if reranker else 5
+    retriever = vector_store.as_retriever(search_kwargs={'k': k})
 
-    # Create Azure Search Vector Store Client
-    retriever = AzureSearch(
-        azure_search_endpoint=env_config['AZURE_SEARCH_ENDPOINT'],
-        azure_search_key=env_config['AZURE_SEARCH_KEY'],
-        index_name=env_config['AZURE_SEARCH_INDEX'],
-        embedding_function=embeddings.embed_query,
-        search_type='hybrid',
-    ).as_retriever(search_kwargs={'k': 5})
-
-    # Return Document Assistant Chain
-    return DocumentAssistantChain(
+    # Identify the indexed documents, to invalidate cached results after reindexing. Azure Cognitive Search indexes
+    # are identified by INDEX_VERSION, without it cached results only expire by their time to live
+    if isinstance(vector_store, LocalVectorStore):
+        def index_version():
+            return vector_store.version
+    elif env_config.get('INDEX_VERSION'):
+        def index_version():
+            return env_config['INDEX_VERSION']
+    else:
+        index_version = None
+
+    # Cache generated queries and retrieved documents, in SQLite to share them between processes
+    query_cache = retrieval_cache = None
+    if env_config.get('QUERY_CACHE', 'false').lower() == 'true':
+        ttl = float(env_config.get('QUERY_CACHE_TTL', 24 * 3600))
+        if path := env_config.get('QUERY_CACHE_PATH'):
+            query_cache = SqliteCache(path, namespace='queries', ttl=ttl)
+            retrieval_cache = SqliteCache(path, namespace='retrieval', ttl=ttl)
+        else:
+            query_cache = MemoryCache(ttl=ttl)
+            retrieval_cache = MemoryCache(ttl=ttl)
+
+    # Create Document Assistant Chain
+    chain = DocumentAssistantChain(
         llm=llm,
         retriever=retriever,
+        prompt=RetrievalQAPrompt(max_tokens=int(env_config.get('PROMPT_MAX_TOKENS', 12000))),
+        speculative_retrieval=env_config.get('SPECULATIVE_RETRIEVAL', 'false').lower() == 'true',
+        multi_query=env_config.get('MULTI_QUERY', 'false').lower() == 'true',
+        query_cache=query_cache,
+        retrieval_cache=retrieval_cache,
+        index_version=index_version,
+        metrics=metrics(),
+        search_flights=SingleFlight('search', metrics()) if single_flight else None,
+        scheduler=scheduler('chat', env_config['OPENAI_DEPLOYMENT_COMPLETION']),
+        reranker=reranker,
+        rerank_max_tokens=int(env_config.get('RERANK_MAX_TOKENS', 3000)),
     )
+
+    # Answer paraphrases of earlier first questions from cache, until the index changes
+    if env_config.get('SEMANTIC_CACHE', 'false').lower() == 'true':
+        chain = SemanticCacheChain(
+            chain=chain,
+            embeddings=embeddings,
+            cache=SemanticCache(
+                threshold=float(env_config.get('SEMANTIC_CACHE_THRESHOLD', 0.95)),
+                ttl=float(env_config.get('SEMANTIC_CACHE_TTL', 24 * 3600)),
+                version=index_version,
+            ),
+            metrics=metrics(),
+        )
+
+    # Sessions asking the same first question at the same time share a single answer
+    if single_flight:
+        chain = SingleFlightChain(chain=chain, flights=SingleFlight('chain', metrics()))
+    return chain
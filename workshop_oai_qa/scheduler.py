@@ -0,0 +1,225 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langchain.schema.embeddings import Embeddings
+
+from workshop_oai_qa.metrics import MetricsRegistry
+from workshop_oai_qa.ratelimit import RateLimiter
+from workshop_oai_qa.utils import num_tokens
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+_priority = contextvars.ContextVar('priority', default=INTERACTIVE)
+
+
+@contextmanager
+def priority(level: int):
+    """
+    Run the requests made within the context, also those of chains, at the given priority.
+    :param level: `INTERACTIVE` or `BACKGROUND`
+    :return:
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class SchedulerOverloaded(Exception):
+    """Raised for background requests when too many of them are queued already."""
+
+
+class Scheduler:
+    """
+    Admits requests against the requests-per-minute and tokens-per-minute quota of a deployment in priority order.
+
+    Requests wait in a queue ordered by priority and arrival, only the request at the head of the queue takes from
+    the quota, so queued interactive requests always go before background ones. When `degrade_depth` or more
+    requests are queued, the scheduler is `overloaded` and callers can do less work, background requests are
+    rejected once `max_background` of them are queued.
+    """
+
+    def __init__(
+            self,
+            rate_limiter: RateLimiter,
+            degrade_depth: int = 4,
+            max_background: Optional[int] = 64,
+            name: str = 'chat',
+            metrics: Optional[MetricsRegistry] = None,
+    ):
+        self.rate_limiter = rate_limiter
+        self.degrade_depth = degrade_depth
+        self.max_background = max_background
+        self.name = name
+        self.metrics = metrics
+
+        self.admitted = 0
+        self.rejected = 0
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        # Futures of waiting coroutines, woken up together with the waiting threads
+        self._wakeups: Dict[Tuple[int, int], asyncio.Future] = {}
+
+    @property
+    def depth(self) -> int:
+        """Number of queued requests."""
+        return len(self._queue)
+
+    @property
+    def overloaded(self) -> bool:
+        return self.depth >= self.degrade_depth
+
+    def _reject(self, level: int):
+        if level == INTERACTIVE or self.max_background is None:
+            return
+        background = sum(1 for queued, _ in self._queue if queued != INTERACTIVE)
+        if background >= self.max_background:
+            self.rejected += 1
+            if self.metrics is not None:
+                self.metrics.increment('scheduler_rejected_total', scheduler=self.name)
+            raise SchedulerOverloaded(f'{background} background requests queued for {self.name}')
+
+    def _enqueue(self, level: int) -> Tuple[int, int]:
+        # Called with the condition held
+        self._reject(level)
+        ticket = (level, next(self._counter))
+        heapq.heappush(self._queue, ticket)
+        return ticket
+
+    def _at_head(self, ticket: Tuple[int, int]) -> bool:
+        # Called with the condition held
+        return self._queue[0] == ticket
+
+    def _dequeue(self, ticket: Tuple[int, int]):
+        # Called with the condition held, also when the request was cancelled or failed
+        self._wakeups.pop(ticket, None)
+        self._queue.remove(ticket)
+        heapq.heapify(self._queue)
+        self._notify()
+
+    def _notify(self):
+        self._condition.notify_all()
+        for future in self._wakeups.values():
+            future.get_loop().call_soon_threadsafe(_wake, future)
+
+    def _admitted(self, level: int, start: float):
+        self.admitted += 1
+        if self.metrics is not None:
+            self.metrics.observe('scheduler_wait_seconds', time.perf_counter() - start,
+                                 scheduler=self.name, priority=PRIORITY_NAMES.get(level, str(level)))
+
+    def acquire(self, tokens: float = 0, level: Optional[int] = None):
+        """
+        Block until the request is at the head of the queue and fits within the quota.
+
+        The rate limiter is called without holding the condition, as with `RATE_LIMIT_PATH` it waits for a write lock
+        on its SQLite database, which would hold up every other request meanwhile.
+        :param tokens: Estimated token cost of the request
+        :param level: Priority, that of the current context by default
+        :return:
+        """
+        level = current_priority() if level is None else level
+        start = time.perf_counter()
+        with self._condition:
+            ticket = self._enqueue(level)
+        try:
+            while True:
+                # Woken up early when a request arrives or leaves the queue
+                with self._condition:
+                    while not self._at_head(ticket):
+                        self._condition.wait()
+                wait = self.rate_limiter.try_acquire(tokens)
+                if wait <= 0:
+                    break
+                with self._condition:
+                    self._condition.wait(wait)
+        finally:
+            with self._condition:
+                self._dequeue(ticket)
+        with self._condition:
+            self._admitted(level, start)
+
+    async def aacquire(self, tokens: float = 0, level: Optional[int] = None):
+        """
+        Wait for admission without blocking the event loop or holding a thread while queued. The request at the head
+        of the queue takes from the quota in a worker thread. A cancelled request leaves the queue, without taking
+        from the quota unless it was cancelled while doing so.
+        :param tokens:
+        :param level:
+        :return:
+        """
+        level = current_priority() if level is None else level
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        with self._condition:
+            ticket = self._enqueue(level)
+        try:
+            while True:
+                with self._condition:
+                    head = self._at_head(ticket)
+                    if not head:
+                        wakeup = self._wakeups[ticket] = loop.create_future()
+                wait = None
+                if head:
+                    wait = await asyncio.to_thread(self.rate_limiter.try_acquire, tokens)
+                    if wait <= 0:
+                        break
+                    with self._condition:
+                        wakeup = self._wakeups[ticket] = loop.create_future()
+                await asyncio.wait([wakeup], timeout=wait)
+        finally:
+            with self._condition:
+                self._dequeue(ticket)
+        with self._condition:
+            self._admitted(level, start)
+
+    def __str__(self):
+        return f'{self.name}: {self.admitted} admitted, {self.rejected} rejected, {self.depth} queued'
+
+
+class ScheduledEmbeddings(Embeddings):
+    """
+    Embeddings whose requests are admitted by a scheduler, at the priority of the calling context.
+    """
+
+    def __init__(self, embeddings: Embeddings, scheduler: Scheduler,
+                 length_function: Callable[[str], int] = num_tokens):
+        self.embeddings = embeddings
+        self.scheduler = scheduler
+        self.length_function = length_function
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.scheduler.acquire(sum(self.length_function(text) for text in texts))
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        self.scheduler.acquire(self.length_function(text))
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        await self.scheduler.aacquire(self.length_function(text))
+        return await self.embeddings.aembed_query(text)
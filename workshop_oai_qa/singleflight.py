@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, TypeVar
+
+from langchain.callbacks.manager import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
+from langchain.chains.base import Chain
+from langchain.schema.embeddings import Embeddings
+
+from workshop_oai_qa.cache import normalize_input
+from workshop_oai_qa.metrics import MetricsRegistry
+from workshop_oai_qa.utils import role_from_message
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class _AsyncFlight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one: the first caller runs the call, callers arriving while
+    it is in progress wait for it and share its result or exception. Nothing is kept once the call is done.
+
+    `calls` counts the calls that ran, `saved` those that were answered by a call already in progress.
+    """
+
+    def __init__(self, name: str = 'default', metrics: Optional[MetricsRegistry] = None):
+        self.name = name
+        self.metrics = metrics
+        self.calls = 0
+        self.saved = 0
+
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._async_flights: Dict[Hashable, _AsyncFlight] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, leader: bool):
+        # Called with the lock held
+        if leader:
+            self.calls += 1
+        else:
+            self.saved += 1
+        if self.metrics is not None:
+            self.metrics.increment('singleflight_calls_total' if leader else 'singleflight_saved_total',
+                                   flight=self.name)
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        """
+        Run `fn`, or wait for the call with the same key that is in progress in another thread.
+        :param key:
+        :param fn:
+        :return:
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            self._count(leader)
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def ado(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Await `fn()`, or the call with the same key that is in progress on the same event loop.
+
+        The call runs as a task of its own, so a cancelled caller, the first one included, does not cancel it for
+        the others. It is only cancelled when no caller is waiting for it any more.
+        :param key:
+        :param fn:
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        key = (id(loop), key)
+        with self._lock:
+            flight = self._async_flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._async_flights[key] = _AsyncFlight(asyncio.ensure_future(fn()))
+                flight.task.add_done_callback(lambda task: self._finish(key, flight))
+            flight.waiters += 1
+            self._count(leader)
+
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            with self._lock:
+                flight.waiters -= 1
+                abandoned = flight.waiters == 0 and not flight.task.done()
+                if abandoned and self._async_flights.get(key) is flight:
+                    del self._async_flights[key]
+            if abandoned:
+                flight.task.cancel()
+
+    def _finish(self, key: Hashable, flight: _AsyncFlight):
+        with self._lock:
+            if self._async_flights.get(key) is flight:
+                del self._async_flights[key]
+        # Retrieve the exception, so it is not reported as unhandled when nobody was waiting
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def __str__(self):
+        return f'{self.name}: {self.calls} calls, {self.saved} saved'
+
+
+class SingleFlightEmbeddings(Embeddings):
+    """
+    Embeds concurrent queries with the same text in a single upstream request.
+    """
+
+    def __init__(self, embeddings: Embeddings, flights: Optional[SingleFlight] = None):
+        self.embeddings = embeddings
+        self.flights = flights or SingleFlight('embeddings')
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.flights.do(text, lambda: self.embeddings.embed_query(text))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.flights.ado(text, lambda: self.embeddings.aembed_query(text))
+
+
+class SingleFlightChain(Chain):
+    """
+    Shares the outputs of a chain between concurrent calls with the same normalized input and no earlier user
+    messages, such as many sessions asking the same suggested question at once.
+
+    Only the first caller receives the streamed reply in its callbacks, the others receive the same outputs,
+    including the `AssistantMessage`, once it is done.
+    """
+
+    chain: Chain
+    flights: SingleFlight
+
+    @property
+    def input_keys(self) -> List[str]:
+        return self.chain.input_keys
+
+    @property
+    def output_keys(self) -> List[str]:
+        return self.chain.output_keys
+
+    def _key(self, inputs: Dict[str, Any]) -> Optional[str]:
+        # The greeting of the assistant does not make the conversation differ
+        history = inputs.get('history') or []
+        if any(role_from_message(message) == 'user' for message in history):
+            return None
+        return normalize_input(inputs['input'])
+
+    def _call(
+            self,
+            inputs: Dict[str, Any],
+            run_manager: Optional[CallbackManagerForChainRun] = None
+        ) -> Dict[str, Any]:
+        key = self._key(inputs)
+        if key is None:
+            return self.chain(inputs, return_only_outputs=True)
+        return dict(self.flights.do(key, lambda: self.chain(inputs, return_only_outputs=True)))
+
+    async def _acall(
+            self,
+            inputs: Dict[str, Any],
+            run_manager: Optional[AsyncCallbackManagerForChainRun] = None
+        ) -> Dict[str, Any]:
+        key = self._key(inputs)
+        if key is None:
+            return await self.chain.acall(inputs, return_only_outputs=True)
+        return dict(await self.flights.ado(key, lambda: self.chain.acall(inputs, return_only_outputs=True)))
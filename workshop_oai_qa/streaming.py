@@ -0,0 +1,163 @@
+from typing import Any, Dict, List, NamedTuple, Optional, Union
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import Document
+
+# Citations longer than this are not source names, the brackets are kept as text
+_MAX_CITATION_LENGTH = 256
+# Follow-ups longer than this, or spanning lines, are not follow-ups, e.g. `<<` in code, and are released as text
+_MAX_FOLLOW_UP_LENGTH = 256
+# Characters separating follow-up questions, e.g. `<<A>>, <<B>>.`
+_SEPARATORS = ' ,.;\n\t'
+
+
+class TextEvent(NamedTuple):
+    text: str
+
+
+class CitationEvent(NamedTuple):
+    number: int
+    source: str
+
+
+class FollowUpEvent(NamedTuple):
+    question: str
+
+
+ReplyEvent = Union[TextEvent, CitationEvent, FollowUpEvent]
+
+
+class ReplyParser:
+    """
+    Single-pass incremental parser of a streamed assistant reply.
+
+    Tokens are fed as they arrive. Display text is emitted with citations of known sources renumbered to `[1]`,
+    `[2]`, ... in order of first appearance, and `<<follow-up questions>>` held back. Citation and follow-up events
+    are emitted as soon as they are complete. Only the characters of an unfinished `[...]` or `<<...>>` are buffered.
+    """
+
+    def __init__(self, sources: Optional[Dict[str, Document]] = None):
+        self.sources = sources
+
+        self.text = ''
+        self.citations: List[str] = []
+        self.follow_ups: List[str] = []
+        self._numbers: Dict[str, int] = {}
+
+        self._state = 'text'
+        self._buffer = ''
+        # Separators after a follow-up, dropped if another follow-up or the end of the reply comes next
+        self._pending = ''
+        self._after_follow_up = False
+
+    def _emit_text(self, text: str, events: List[ReplyEvent]):
+        if not text:
+            return
+        if self._pending:
+            text, self._pending = self._pending + text, ''
+        # Separators are only held back until the text after the follow-ups goes on
+        self._after_follow_up = False
+        self.text += text
+        if events and isinstance(events[-1], TextEvent):
+            events[-1] = TextEvent(events[-1].text + text)
+        else:
+            events.append(TextEvent(text))
+
+    def _citation(self, citation: str, events: List[ReplyEvent]):
+        if self.sources is not None and citation not in self.sources:
+            self._emit_text(f'[{citation}]', events)
+            return
+
+        number = self._numbers.get(citation)
+        if number is None:
+            number = self._numbers[citation] = len(self.citations) + 1
+            self.citations.append(citation)
+            events.append(CitationEvent(number, citation))
+        self._emit_text(f'[{number}]', events)
+
+    def feed(self, token: str) -> List[ReplyEvent]:
+        """
+        Parse the next token of the reply.
+        :param token:
+        :return: Events completed by the token
+        """
+        events = []
+        text = []
+        for char in token:
+            if self._state == 'angle':
+                self._state = 'text'
+                if char == '<':
+                    self._state, self._buffer = 'follow_up', ''
+                    continue
+                text.append('<')
+
+            if self._state == 'text':
+                if char in '[<' or (self._after_follow_up and char in _SEPARATORS):
+                    self._emit_text(''.join(text), events)
+                    text.clear()
+                    if char == '[':
+                        self._state, self._buffer = 'citation', ''
+                    elif char == '<':
+                        self._state = 'angle'
+                    else:
+                        self._pending += char
+                else:
+                    text.append(char)
+            elif self._state == 'citation':
+                if char == ']':
+                    self._citation(self._buffer, events)
+                    self._state = 'text'
+                elif char == '\n' or len(self._buffer) >= _MAX_CITATION_LENGTH:
+                    text.append('[' + self._buffer + char)
+                    self._state = 'text'
+                else:
+                    self._buffer += char
+            elif self._state == 'follow_up':
+                if char == '>' and self._buffer.endswith('>'):
+                    question = self._buffer[:-1].strip()
+                    self.follow_ups.append(question)
+                    events.append(FollowUpEvent(question))
+                    # Separators around follow-ups are not part of the display text
+                    self._pending = ''
+                    self.text = self.text.rstrip()
+                    self._after_follow_up = True
+                    self._state = 'text'
+                elif char == '\n' or len(self._buffer) >= _MAX_FOLLOW_UP_LENGTH:
+                    text.append('<<' + self._buffer + char)
+                    self._state = 'text'
+                else:
+                    self._buffer += char
+
+        self._emit_text(''.join(text), events)
+        return events
+
+    def finish(self) -> List[ReplyEvent]:
+        """
+        Flush unfinished citations and follow-ups as text at the end of the reply.
+        :return:
+        """
+        events = []
+        if self._state == 'citation':
+            self._emit_text('[' + self._buffer, events)
+        elif self._state == 'angle':
+            self._emit_text('<', events)
+        elif self._state == 'follow_up':
+            self._emit_text('<<' + self._buffer, events)
+        self._state, self._buffer, self._pending = 'text', '', ''
+        self._after_follow_up = False
+        return events
+
+
+class ReplyCallbackHandler(BaseCallbackHandler):
+    """
+    Receives the parsed events of the assistant reply while it is streamed by `DocumentAssistantChain`.
+    """
+
+    def on_reply_text(self, text: str, **kwargs: Any):
+        """Display text, with citations renumbered and follow-up questions left out."""
+
+    def on_reply_citation(self, number: int, document: Document, **kwargs: Any):
+        """A source cited for the first time."""
+
+    def on_reply_follow_up(self, question: str, **kwargs: Any):
+        """A completed follow-up question."""
@@ -1,3 +1,6 @@
+from functools import lru_cache
+from typing import List, Hashable, Tuple
+
 from langchain.schema import BaseMessage, ChatMessage, AIMessage
 
 
@@ -13,3 +16,34 @@ def role_from_message(message: BaseMessage):
         return 'assistant'
     else:
         raise ValueError(f'Unexpected message type: {type(message)}')
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str):
+    import tiktoken
+
+    return tiktoken.get_encoding(encoding_name)
+
+
+def num_tokens(text: str, encoding_name: str = 'cl100k_base') -> int:
+    """
+    Count the tokens of a text with the tiktoken encoding used by the Azure OpenAI models
+    :param text:
+    :param encoding_name:
+    :return:
+    """
+    return len(get_encoding(encoding_name).encode(text))
+
+
+def reciprocal_rank_fusion(rankings: List[List[Hashable]], k: int = 60) -> List[Tuple[Hashable, float]]:
+    """
+    Fuse rankings by summing 1 / (k + rank) over the rankings each item appears in
+    :param rankings: Lists of items, best first
+    :param k: Damping constant, 60 as in the original paper
+    :return: Items with their fused scores, best first
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
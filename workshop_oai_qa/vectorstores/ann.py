@@ -0,0 +1,187 @@
+import math
+from typing import Optional, Tuple
+
+import numpy as np
+
+DTYPES = ['int8', 'float16']
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, block_size: int = 16384) -> np.ndarray:
+    """
+    Assign unit vectors to their most similar centroid, in blocks to bound memory.
+    :param vectors:
+    :param centroids:
+    :param block_size:
+    :return:
+    """
+    return np.concatenate([
+        np.argmax(np.asarray(vectors[i:i + block_size], dtype=np.float32) @ centroids.T, axis=1)
+        for i in range(0, len(vectors), block_size)
+    ]) if len(vectors) else np.zeros(0, dtype=np.int64)
+
+
+def spherical_kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Cluster unit vectors by cosine similarity.
+    :param vectors:
+    :param n_clusters:
+    :param iterations:
+    :param seed:
+    :return: Unit-normalized centroids
+    """
+    rng = np.random.default_rng(seed)
+    centroids = np.array(vectors[rng.choice(len(vectors), n_clusters, replace=False)], dtype=np.float32)
+
+    for _ in range(iterations):
+        labels = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        counts = np.bincount(labels, minlength=n_clusters)
+
+        # Empty clusters are restarted at a random vector
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """
+    Inverted file index over unit-normalized vectors, storing the vectors quantized to int8 or float16.
+
+    Vectors are partitioned by spherical k-means into `n_lists` lists. A search scores the `n_probe` lists whose
+    centroids are closest to the query on the quantized vectors, and optionally rescores the best `rescore * k`
+    candidates against the full-precision vectors. Raising `n_probe` and `rescore` trades latency for recall.
+    """
+
+    def __init__(
+            self,
+            centroids: np.ndarray,
+            offsets: np.ndarray,
+            rows: np.ndarray,
+            codes: np.ndarray,
+            scales: Optional[np.ndarray] = None,
+    ):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+        self.codes = codes
+        self.scales = scales
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.centroids, self.offsets, self.rows, self.codes)
+                   if array is not None) + (self.scales.nbytes if self.scales is not None else 0)
+
+    @classmethod
+    def build(
+            cls,
+            vectors: np.ndarray,
+            n_lists: Optional[int] = None,
+            dtype: str = 'int8',
+            sample_size: int = 256,
+            iterations: int = 10,
+            seed: int = 0,
+    ) -> 'IVFIndex':
+        """
+        Build an index over the rows of a matrix of unit vectors.
+        :param vectors:
+        :param n_lists: Number of inverted lists, defaults to 4 * sqrt(n)
+        :param dtype: `int8` (4x smaller than float32) or `float16` (2x smaller)
+        :param sample_size: Number of vectors per list sampled to train the centroids
+        :param iterations: Number of k-means iterations
+        :param seed:
+        :return:
+        """
+        if dtype not in DTYPES:
+            raise ValueError(f'Unexpected dtype: {dtype}, expected one of {DTYPES}')
+
+        n_lists = min(n_lists or max(1, int(4 * math.sqrt(len(vectors)))), len(vectors))
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(len(vectors), min(len(vectors), n_lists * sample_size), replace=False)
+        centroids = spherical_kmeans(np.asarray(vectors[np.sort(sample)], dtype=np.float32), n_lists,
+                                     iterations=iterations, seed=seed)
+
+        labels = _assign(vectors, centroids)
+        rows = np.argsort(labels, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))])
+
+        sorted_vectors = np.asarray(vectors[rows], dtype=np.float32)
+        if dtype == 'int8':
+            # Symmetric per-dimension scales map the largest absolute value of each dimension to 127
+            scales = np.abs(sorted_vectors).max(axis=0) / 127
+            scales[scales == 0] = 1
+            codes = np.round(sorted_vectors / scales).astype(np.int8)
+        else:
+            scales = None
+            codes = sorted_vectors.astype(np.float16)
+
+        return cls(centroids=centroids, offsets=offsets, rows=rows, codes=codes, scales=scales)
+
+    def search(
+            self,
+            query: np.ndarray,
+            k: int,
+            n_probe: int = 8,
+            rescore: int = 0,
+            vectors: Optional[np.ndarray] = None,
+            mask: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the approximate `k` nearest rows to a unit query vector.
+        :param query:
+        :param k:
+        :param n_probe: Number of lists to scan
+        :param rescore: If set with `vectors`, rescore the best `rescore * k` candidates with full precision
+        :param vectors: Full-precision matrix the index was built from
+        :param mask: Boolean mask of rows that may be returned
+        :return: Rows and their scores, best first
+        """
+        probes = np.argpartition(-(self.centroids @ query), min(n_probe, self.n_lists) - 1)[:n_probe]
+        positions = np.concatenate([np.arange(self.offsets[p], self.offsets[p + 1]) for p in probes])
+        rows = self.rows[positions]
+
+        weights = query * self.scales if self.scales is not None else query
+        scores = self.codes[positions].astype(np.float32) @ weights.astype(np.float32)
+        if mask is not None:
+            scores = np.where(mask[rows], scores, -np.inf)
+
+        n = min(max(k, rescore * k) if rescore and vectors is not None else k, int(np.isfinite(scores).sum()))
+        if n <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        top = np.argpartition(-scores, n - 1)[:n]
+        rows, scores = rows[top], scores[top]
+
+        if rescore and vectors is not None:
+            order = np.sort(rows)
+            scores = np.asarray(vectors[order], dtype=np.float32) @ query
+            rows = order
+
+        best = np.argsort(-scores)[:k]
+        return rows[best], scores[best]
+
+    def save(self, path: str):
+        arrays = dict(centroids=self.centroids, offsets=self.offsets, rows=self.rows, codes=self.codes)
+        if self.scales is not None:
+            arrays['scales'] = self.scales
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> 'IVFIndex':
+        with np.load(path) as data:
+            return cls(
+                centroids=data['centroids'],
+                offsets=data['offsets'],
+                rows=data['rows'],
+                codes=data['codes'],
+                scales=data['scales'] if 'scales' in data else None,
+            )
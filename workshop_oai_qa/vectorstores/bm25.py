@@ -0,0 +1,137 @@
+import heapq
+import math
+import re
+from collections import Counter
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+_TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+
+def _encode(terms: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    # Terms are stored as one UTF-8 blob with offsets, rather than a fixed width array padded to the longest term
+    encoded = [term.encode('utf-8') for term in terms]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(term) for term in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+class BM25Index:
+    """
+    Okapi BM25 inverted index with array-backed postings.
+
+    Postings of all terms are stored back to back in `doc_ids` (int32) and `tfs` (uint16), with `offsets` marking
+    where the postings of each term start, so the whole index is a handful of flat arrays that load in one go. The
+    sorted terms themselves are one UTF-8 byte array, `terms`, with `term_offsets` marking where each term starts.
+    """
+
+    def __init__(
+            self,
+            terms: np.ndarray,
+            term_offsets: np.ndarray,
+            offsets: np.ndarray,
+            doc_ids: np.ndarray,
+            tfs: np.ndarray,
+            doc_lengths: np.ndarray,
+            k1: float = 1.2,
+            b: float = 0.75,
+    ):
+        self.terms = terms
+        self.term_offsets = term_offsets
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+
+        blob = terms.tobytes()
+        bounds = term_offsets.tolist()
+        self._vocabulary = {
+            blob[start:end].decode('utf-8'): i for i, (start, end) in enumerate(zip(bounds, bounds[1:]))
+        }
+        self._avg_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, texts: List[str], **kwargs) -> 'BM25Index':
+        postings = {}
+        doc_lengths = np.zeros(len(texts), dtype=np.int32)
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc_id, tf))
+
+        terms = sorted(postings)
+        lengths = [len(postings[term]) for term in terms]
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        doc_ids = np.fromiter((doc_id for term in terms for doc_id, _ in postings[term]), np.int32, int(offsets[-1]))
+        tfs = np.fromiter((min(tf, 65535) for term in terms for _, tf in postings[term]), np.uint16, int(offsets[-1]))
+
+        return cls(*_encode(terms), offsets, doc_ids, tfs, doc_lengths, **kwargs)
+
+    def scores(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Score the documents containing any query term.
+        :param query:
+        :return: Document IDs and their BM25 scores
+        """
+        n = len(self.doc_lengths)
+        ids, scores = [], []
+        for term, count in Counter(tokenize(query)).items():
+            term_id = self._vocabulary.get(term)
+            if term_id is None:
+                continue
+
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            doc_ids, tfs = self.doc_ids[start:end], self.tfs[start:end].astype(np.float32)
+            df = end - start
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_ids] / self._avg_length)
+            ids.append(doc_ids)
+            scores.append(count * idf * tfs * (self.k1 + 1) / (tfs + norm))
+
+        if not ids:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+
+        # Sum the contributions of each term per document
+        ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        return ids, np.bincount(inverse, weights=np.concatenate(scores)).astype(np.float32)
+
+    def search(self, query: str, k: int, mask: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        Find the `k` best matching documents.
+        :param query:
+        :param k:
+        :param mask: Boolean mask of documents that may be returned
+        :return: Document IDs and scores, best first
+        """
+        ids, scores = self.scores(query)
+        if mask is not None:
+            keep = mask[ids]
+            ids, scores = ids[keep], scores[keep]
+        return heapq.nlargest(k, zip(ids.tolist(), scores.tolist()), key=lambda item: item[1])
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            np.savez(f, terms=self.terms, term_offsets=self.term_offsets, offsets=self.offsets, doc_ids=self.doc_ids,
+                     tfs=self.tfs, doc_lengths=self.doc_lengths)
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> 'BM25Index':
+        with np.load(path) as data:
+            if 'term_offsets' in data:
+                terms = data['terms'], data['term_offsets']
+            else:
+                # Indexes saved before terms were stored as UTF-8 hold a fixed width string array
+                terms = _encode(data['terms'].tolist())
+            return cls(*terms, data['offsets'], data['doc_ids'], data['tfs'], data['doc_lengths'], **kwargs)
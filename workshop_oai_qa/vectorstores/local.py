@@ -0,0 +1,467 @@
+import json
+import os
+import threading
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.vectorstore import VectorStore
+
+from workshop_oai_qa.utils import reciprocal_rank_fusion
+from workshop_oai_qa.vectorstores.ann import IVFIndex
+from workshop_oai_qa.vectorstores.bm25 import BM25Index
+
+Filter = Union[Dict[str, Any], Callable[[dict], bool]]
+
+VECTORS_FILE = 'vectors.f32'
+DOCUMENTS_FILE = 'documents.jsonl'
+CONFIG_FILE = 'store.json'
+ANN_FILE = 'ivf.npz'
+BM25_FILE = 'bm25.npz'
+SEARCH_TYPES = ['similarity', 'hybrid']
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _matches(metadata: dict, filter: Filter) -> bool:
+    if callable(filter):
+        return filter(metadata)
+    return all(
+        metadata.get(key) in value if isinstance(value, (list, tuple, set)) else metadata.get(key) == value
+        for key, value in filter.items()
+    )
+
+
+class LocalVectorStore(VectorStore):
+    """
+    In-process vector store keeping all embeddings in one contiguous float32 matrix memory-mapped from disk.
+
+    The store is a directory holding the unit-normalized vectors, appended row by row to a raw float32 file, and a
+    JSON lines log of added, updated and deleted documents. Search is a single matrix-vector product over the
+    mapped matrix followed by `argpartition`, so cosine similarity top-k runs without a network round trip.
+
+    For large corpora, `build_index` adds an approximate nearest neighbour index over quantized vectors, which is
+    then used by searches with `n_probe` lists scanned and the best `rescore * k` candidates rescored exactly.
+
+    With `search_type='hybrid'`, vector results are fused with BM25 keyword results by reciprocal rank fusion.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            embedding: Embeddings,
+            search_type: str = 'similarity',
+            n_probe: int = 8,
+            rescore: int = 4,
+    ):
+        if search_type not in SEARCH_TYPES:
+            raise ValueError(f'Unexpected search_type: {search_type}, expected one of {SEARCH_TYPES}')
+
+        self.path = path
+        self.embedding = embedding
+        self.search_type = search_type
+        self.n_probe = n_probe
+        self.rescore = rescore
+        os.makedirs(path, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._load()
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding
+
+    def _load(self):
+        self.ids: List[str] = []
+        self.contents: List[str] = []
+        self.metadatas: List[dict] = []
+        self._rows: Dict[str, int] = {}
+        self._deleted = set()
+        self._filters: Dict[str, np.ndarray] = {}
+        self._log_size = 0
+        self._log_inode: Optional[int] = None
+
+        self.dimensions: Optional[int] = None
+        config_path = os.path.join(self.path, CONFIG_FILE)
+        if os.path.exists(config_path):
+            with open(config_path) as f:
+                self.dimensions = json.load(f)['dimensions']
+
+        self._load_indexes()
+        self._read_log()
+        self._map_vectors()
+
+    def _stat(self, name: str) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(os.path.join(self.path, name))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _load_indexes(self):
+        ann_path = os.path.join(self.path, ANN_FILE)
+        self.ann: Optional[IVFIndex] = IVFIndex.load(ann_path) if os.path.exists(ann_path) else None
+        bm25_path = os.path.join(self.path, BM25_FILE)
+        self._bm25: Optional[BM25Index] = BM25Index.load(bm25_path) if os.path.exists(bm25_path) else None
+        self._index_stats = [self._stat(ANN_FILE), self._stat(BM25_FILE)]
+
+    def _read_log(self):
+        # Applies the records appended since the last read
+        documents_path = os.path.join(self.path, DOCUMENTS_FILE)
+        if not os.path.exists(documents_path):
+            return
+        with open(documents_path, 'rb') as f:
+            self._log_inode = os.fstat(f.fileno()).st_ino
+            f.seek(self._log_size)
+            for line in f:
+                # The last line may still be being written by the indexer, it is read by a later refresh
+                if not line.endswith(b'\n'):
+                    break
+                self._apply(json.loads(line))
+                self._log_size += len(line)
+
+        if self.dimensions is None and self.ids:
+            with open(os.path.join(self.path, CONFIG_FILE)) as f:
+                self.dimensions = json.load(f)['dimensions']
+
+    def _apply(self, record: dict):
+        id = record['id']
+        if record['op'] == 'add':
+            if id in self._rows:
+                self._deleted.add(self._rows[id])
+            self._rows[id] = len(self.ids)
+            self.ids.append(id)
+            self.contents.append(record['content'])
+            self.metadatas.append(record['metadata'])
+        elif record['op'] == 'update' and id in self._rows:
+            self.metadatas[self._rows[id]] = record['metadata']
+        elif record['op'] == 'delete' and id in self._rows:
+            self._deleted.add(self._rows.pop(id))
+
+    def _map_vectors(self):
+        rows = len(self.ids)
+        if not rows:
+            self.matrix = np.zeros((0, self.dimensions or 0), dtype=np.float32)
+        else:
+            # Rows written without a matching log entry (an interrupted write) are ignored
+            matrix = np.memmap(os.path.join(self.path, VECTORS_FILE), dtype=np.float32, mode='r')
+            self.matrix = matrix[:rows * self.dimensions].reshape(rows, self.dimensions)
+
+        self._valid = np.ones(rows, dtype=bool)
+        self._valid[list(self._deleted)] = False
+        self._filters.clear()
+
+    def refresh(self):
+        """
+        Pick up changes written by another process, such as the indexer. Records appended to the log are applied
+        incrementally, while a log rewritten by compaction is reloaded in full.
+        :return:
+        """
+        log = self._stat(DOCUMENTS_FILE)
+        indexes = [self._stat(ANN_FILE), self._stat(BM25_FILE)]
+        if (log or (None, 0))[:2] == (self._log_inode, self._log_size) and indexes == self._index_stats:
+            return
+
+        with self._lock:
+            if log is None or log[0] != self._log_inode or log[1] < self._log_size:
+                self._load()
+                return
+            if indexes != self._index_stats:
+                self._load_indexes()
+            if log[1] != self._log_size:
+                self._read_log()
+                self._map_vectors()
+
+    @property
+    def version(self) -> str:
+        """
+        Identifies the stored documents, changing whenever they are written, e.g. by the indexer.
+        :return:
+        """
+        documents_path = os.path.join(self.path, DOCUMENTS_FILE)
+        if not os.path.exists(documents_path):
+            return '0'
+        stat = os.stat(documents_path)
+        return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+    def _write(self, records: List[dict], vectors: Optional[np.ndarray] = None):
+        # Vectors are written before the log, so every logged row has its vector on disk
+        if vectors is not None and len(vectors):
+            with open(os.path.join(self.path, VECTORS_FILE), 'ab') as f:
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(os.path.join(self.path, DOCUMENTS_FILE), 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(record) + '\n' for record in records)
+
+        for record in records:
+            self._apply(record)
+        self._log_inode, self._log_size, _ = self._stat(DOCUMENTS_FILE)
+        self._map_vectors()
+
+    def add_embeddings(
+            self,
+            texts: List[str],
+            embeddings: List[List[float]],
+            metadatas: Optional[List[dict]] = None,
+            ids: Optional[List[str]] = None,
+    ) -> List[str]:
+        """
+        Add texts with precomputed embeddings, replacing documents with the same ID.
+        :param texts:
+        :param embeddings:
+        :param metadatas:
+        :param ids:
+        :return:
+        """
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float32))
+
+        with self._lock:
+            if self.dimensions is None:
+                self.dimensions = vectors.shape[1]
+                with open(os.path.join(self.path, CONFIG_FILE), 'w') as f:
+                    json.dump({'dimensions': self.dimensions}, f)
+            elif vectors.shape[1] != self.dimensions:
+                raise ValueError(f'Expected {self.dimensions} dimensional vectors, got {vectors.shape[1]}')
+            self._write([
+                {'op': 'add', 'id': id, 'content': text, 'metadata': metadata}
+                for id, text, metadata in zip(ids, texts, metadatas)
+            ], vectors)
+        return ids
+
+    def add_texts(
+            self,
+            texts: Iterable[str],
+            metadatas: Optional[List[dict]] = None,
+            ids: Optional[List[str]] = None,
+            **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        return self.add_embeddings(texts, self.embedding.embed_documents(texts), metadatas, ids or kwargs.get('keys'))
+
+    def update_metadata(self, metadatas: Dict[str, dict]):
+        with self._lock:
+            self._write([{'op': 'update', 'id': id, 'metadata': metadata} for id, metadata in metadatas.items()])
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        with self._lock:
+            self._write([{'op': 'delete', 'id': id} for id in ids or []])
+        return True
+
+    def compact(self):
+        """
+        Rewrite the store without deleted and replaced rows.
+        :return:
+        """
+        with self._lock:
+            rows = np.flatnonzero(self._valid)
+            vectors_path = os.path.join(self.path, VECTORS_FILE)
+            documents_path = os.path.join(self.path, DOCUMENTS_FILE)
+
+            with open(f'{vectors_path}.tmp', 'wb') as f:
+                f.write(np.ascontiguousarray(self.matrix[rows]).tobytes())
+            with open(f'{documents_path}.tmp', 'w', encoding='utf-8') as f:
+                f.writelines(
+                    json.dumps({
+                        'op': 'add', 'id': self.ids[row], 'content': self.contents[row],
+                        'metadata': self.metadatas[row],
+                    }) + '\n'
+                    for row in rows
+                )
+
+            # Rows are renumbered, so the approximate and keyword indexes have to be rebuilt
+            for name in (ANN_FILE, BM25_FILE):
+                if os.path.exists(os.path.join(self.path, name)):
+                    os.remove(os.path.join(self.path, name))
+            os.replace(f'{vectors_path}.tmp', vectors_path)
+            os.replace(f'{documents_path}.tmp', documents_path)
+            self._load()
+
+    def build_index(self, n_lists: Optional[int] = None, dtype: str = 'int8', **kwargs: Any) -> IVFIndex:
+        """
+        Build and persist an approximate nearest neighbour index over the stored vectors, see `IVFIndex.build`.
+        Rows added afterwards are searched exactly until the index is rebuilt.
+        :param n_lists:
+        :param dtype:
+        :return:
+        """
+        with self._lock:
+            ann = IVFIndex.build(self.matrix, n_lists=n_lists, dtype=dtype, **kwargs)
+            ann.save(os.path.join(self.path, ANN_FILE))
+            self.ann = ann
+            self._index_stats[0] = self._stat(ANN_FILE)
+            return ann
+
+    @property
+    def keyword_index(self) -> BM25Index:
+        """
+        BM25 index over the stored contents. A persisted index that does not cover all rows is rebuilt in memory.
+        :return:
+        """
+        with self._lock:
+            if self._bm25 is None or len(self._bm25) != len(self.ids):
+                self._bm25 = BM25Index.build(self.contents)
+            return self._bm25
+
+    def build_keyword_index(self) -> BM25Index:
+        """
+        Build and persist the BM25 index over the stored contents, so it does not have to be built at query time.
+        :return:
+        """
+        with self._lock:
+            self._bm25 = BM25Index.build(self.contents)
+            self._bm25.save(os.path.join(self.path, BM25_FILE))
+            self._index_stats[1] = self._stat(BM25_FILE)
+            return self._bm25
+
+    def __len__(self):
+        return int(self._valid.sum())
+
+    def _mask(self, filter: Optional[Filter]) -> np.ndarray:
+        if filter is None:
+            return self._valid
+        if callable(filter):
+            return self._valid & np.fromiter((_matches(m, filter) for m in self.metadatas), bool, len(self.metadatas))
+
+        # Masks of dictionary filters are cached until the store changes
+        key = json.dumps(filter, sort_keys=True, default=list)
+        if key not in self._filters:
+            self._filters[key] = self._valid & np.fromiter(
+                (_matches(m, filter) for m in self.metadatas), bool, len(self.metadatas)
+            )
+        return self._filters[key]
+
+    def _top_k(self, scores: np.ndarray, mask: np.ndarray, k: int) -> List[int]:
+        scores = np.where(mask, scores, -np.inf)
+        k = min(k, int(mask.sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])].tolist()
+
+    def _snapshot(self, filter: Optional[Filter]) -> Tuple[int, np.ndarray, List[str], List[dict]]:
+        # Taken with the lock held. Rows are only ever appended and arrays replaced rather than modified, so a search
+        # can run on the snapshot outside the lock while the store is refreshed or written to
+        return len(self.ids), self._mask(filter), self.contents, self.metadatas
+
+    @staticmethod
+    def _documents(rows: Iterable[int], contents: List[str], metadatas: List[dict]) -> List[Document]:
+        return [Document(page_content=contents[row], metadata=dict(metadatas[row])) for row in rows]
+
+    def similarity_search_by_vector_with_score(
+            self, embedding: List[float], k: int = 4, filter: Optional[Filter] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """
+        Find the `k` documents most similar to a vector by cosine similarity.
+        :param embedding:
+        :param k:
+        :param filter: Metadata values to match, e.g. `{'source': [...]}`, or a predicate on the metadata
+        :return:
+        """
+        query = _normalize(np.asarray(embedding, dtype=np.float32))
+        self.refresh()
+        with self._lock:
+            matrix, ann = self.matrix, self.ann
+            count, mask, contents, metadatas = self._snapshot(filter)
+        if not count:
+            return []
+
+        if ann is None:
+            scores = matrix @ query
+            rows = self._top_k(scores, mask, k)
+            return list(zip(self._documents(rows, contents, metadatas), scores[rows].tolist()))
+
+        rows, scores = ann.search(
+            query, k,
+            n_probe=kwargs.get('n_probe', self.n_probe),
+            rescore=kwargs.get('rescore', self.rescore),
+            vectors=matrix,
+            mask=mask,
+        )
+        results = dict(zip(rows.tolist(), scores.tolist()))
+
+        # Rows added after the index was built are searched exactly
+        offset = len(ann)
+        if offset < count:
+            tail_scores = matrix[offset:] @ query
+            for row in self._top_k(tail_scores, mask[offset:], k):
+                results[offset + row] = float(tail_scores[row])
+
+        rows = sorted(results, key=results.get, reverse=True)[:k]
+        return list(zip(self._documents(rows, contents, metadatas), [results[row] for row in rows]))
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, **kwargs)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self.embedding.embed_query(query), k, **kwargs)
+
+    def keyword_search_with_score(
+            self, query: str, k: int = 4, filter: Optional[Filter] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """
+        Find the `k` documents best matching the query terms by BM25.
+        :param query:
+        :param k:
+        :param filter:
+        :return:
+        """
+        self.refresh()
+        with self._lock:
+            index = self.keyword_index
+            _, mask, contents, metadatas = self._snapshot(filter)
+        results = index.search(query, k, mask=mask)
+        return list(zip(self._documents([row for row, _ in results], contents, metadatas), [score for _, score in results]))
+
+    def hybrid_search_with_score(
+            self, query: str, k: int = 4, fetch_k: Optional[int] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """
+        Fuse vector and keyword results by reciprocal rank fusion.
+        :param query:
+        :param k:
+        :param fetch_k: Number of results of each search to fuse, defaults to 4 * k
+        :return: Documents with their fusion scores
+        """
+        fetch_k = fetch_k or 4 * k
+        vector_results = self.similarity_search_with_score(query, fetch_k, **kwargs)
+        keyword_results = self.keyword_search_with_score(query, fetch_k, **kwargs)
+
+        documents = {}
+        rankings = []
+        for results in (vector_results, keyword_results):
+            ranking = []
+            for doc, _ in results:
+                key = (doc.page_content, json.dumps(doc.metadata, sort_keys=True, default=str))
+                documents[key] = doc
+                ranking.append(key)
+            rankings.append(ranking)
+
+        return [(documents[key], score) for key, score in reciprocal_rank_fusion(rankings)[:k]]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        if self.search_type == 'hybrid':
+            return [doc for doc, _ in self.hybrid_search_with_score(query, k, **kwargs)]
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # Scores are cosine similarities in [-1, 1]
+        return lambda score: (score + 1) / 2
+
+    @classmethod
+    def from_texts(
+            cls,
+            texts: List[str],
+            embedding: Embeddings,
+            metadatas: Optional[List[dict]] = None,
+            path: str = '.index',
+            **kwargs: Any,
+    ) -> 'LocalVectorStore':
+        store = cls(path=path, embedding=embedding)
+        store.add_texts(texts, metadatas=metadatas, **kwargs)
+        return store